@@ -0,0 +1,170 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import File, FileShare, ShareableLink
+
+VIEW = 'view'
+DOWNLOAD = 'download'
+SHARE = 'share'
+DELETE = 'delete'
+
+OWNER_ACTIONS = frozenset({VIEW, DOWNLOAD, SHARE, DELETE})
+# Shares created before permissions were recorded have a blank permission and were always downloadable
+SHARE_ACTIONS = {
+    'view': frozenset({VIEW}),
+    'download': frozenset({VIEW, DOWNLOAD}),
+    '': frozenset({VIEW, DOWNLOAD}),
+}
+NO_ACTIONS = frozenset()
+
+# Tries at a statement SQLite refused with a lock error, backing off from LOCK_RETRY_DELAY seconds and
+# doubling each time (about 0.6 s in all) before the error is raised
+LOCK_RETRIES = 8
+LOCK_RETRY_DELAY = 0.005
+# SQLite's messages for SQLITE_BUSY and SQLITE_LOCKED; any other OperationalError is raised at once
+SQLITE_LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def _cache_key(file_id, user_id):
+    return f"fileapp:acl:{file_id}:{user_id}"
+
+
+def _live_shares(user):
+    """Shares of any file with user that have not expired"""
+    return FileShare.objects.filter(shared_with=user).filter(
+        Q(expiration_date__isnull=True) | Q(expiration_date__gt=timezone.now())
+    )
+
+
+def _memo(request):
+    """Per-request answers, so repeated checks in one request never hit the cache or database"""
+    if not hasattr(request, '_file_access'):
+        request._file_access = {}
+    return request._file_access
+
+
+def _grants(shares):
+    """Fold (permission, expiration_date) pairs into actions and how long that answer holds"""
+    actions = NO_ACTIONS
+    ttl = getattr(settings, 'FILE_ACL_CACHE_TTL', 30)
+    for permission, expiration_date in shares:
+        actions = actions | SHARE_ACTIONS.get(permission, NO_ACTIONS)
+        if expiration_date is not None:
+            # An answer must not outlive the share it was derived from
+            ttl = min(ttl, max(int((expiration_date - timezone.now()).total_seconds()), 0))
+    return actions, ttl
+
+
+def allowed_actions(request, file):
+    """
+    Return the set of actions request.user may take on file.
+    Owners are decided from file.user_id without touching the database. Other users
+    cost one indexed FileShare lookup, remembered for the request and briefly cached.
+    Refusals are never cached, so a new share takes effect in every process at once.
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return NO_ACTIONS
+    if file.user_id == user.id:
+        return OWNER_ACTIONS
+
+    memo = _memo(request)
+    if file.pk in memo:
+        return memo[file.pk]
+
+    key = _cache_key(file.pk, user.id)
+    cached = cache.get(key)
+    if cached is not None:
+        actions = frozenset(cached)
+    else:
+        actions, ttl = _grants(
+            _live_shares(user).filter(file_id=file.pk).values_list('permission', 'expiration_date')
+        )
+        if actions and ttl > 0:
+            cache.set(key, sorted(actions), ttl)
+    memo[file.pk] = actions
+    return actions
+
+
+def can(request, file, action):
+    """Whether request.user may perform action on file"""
+    return action in allowed_actions(request, file)
+
+
+def annotate_access(request, files):
+    """
+    Set file.actions on every File in files with a single query for the whole batch,
+    and remember the answers for the rest of the request.
+    """
+    user = request.user
+    memo = _memo(request)
+    others = [file.pk for file in files if file.user_id != user.id and file.pk not in memo]
+
+    if others:
+        shares = {}
+        for file_id, permission, expiration_date in _live_shares(user).filter(file_id__in=others).values_list(
+            'file_id', 'permission', 'expiration_date'
+        ):
+            shares.setdefault(file_id, []).append((permission, expiration_date))
+        for file_id in others:
+            memo[file_id], _ = _grants(shares.get(file_id, []))
+
+    for file in files:
+        file.actions = OWNER_ACTIONS if file.user_id == user.id else memo[file.pk]
+    return files
+
+
+def invalidate_access(file_id, user_ids):
+    """Drop cached answers for these users on file_id; call after sharing or deleting it"""
+    invalidate_grants((file_id, user_id) for user_id in user_ids)
+
+
+def invalidate_grants(pairs):
+    """Drop cached answers for many (file_id, user_id) pairs in one cache round trip"""
+    keys = [_cache_key(file_id, user_id) for file_id, user_id in pairs]
+    if keys:
+        cache.delete_many(keys)
+
+
+def _is_sqlite_lock(error):
+    return connection.vendor == 'sqlite' and str(error).startswith(SQLITE_LOCK_ERRORS)
+
+
+def _retry_locked(query):
+    """
+    Run query() again while SQLite reports a lock. In shared-cache mode (the test database)
+    SQLite raises "database table is locked" at once rather than waiting on the busy timeout.
+    Inside a transaction the error has already aborted it, so it is re-raised as is.
+    """
+    for attempt in range(LOCK_RETRIES):
+        try:
+            return query()
+        except OperationalError as e:
+            if not _is_sqlite_lock(e) or connection.in_atomic_block or attempt == LOCK_RETRIES - 1:
+                raise
+            time.sleep(LOCK_RETRY_DELAY * 2 ** attempt)
+
+
+def redeem_link(token):
+    """
+    Claim a one-time link and return its File, or None if the link is unknown,
+    expired or already used. The claim is a single conditional UPDATE, so when
+    many requests race on one token exactly one of them wins.
+    """
+    token_hash = ShareableLink.hash_token(token)
+    # Each statement is retried on its own, so a claim that went through is never repeated
+    claimed = _retry_locked(lambda: ShareableLink.objects.filter(
+        token_hash=token_hash, is_used=False, expires_at__gt=timezone.now()
+    ).update(is_used=True, used_at=timezone.now()))
+    if not claimed:
+        return None
+    return _retry_locked(lambda: File.objects.filter(shareablelink__token_hash=token_hash).first())
+
+
+def release_link(token):
+    """Make a link claimed by redeem_link redeemable again, when serving it failed before any content was sent"""
+    ShareableLink.objects.filter(token_hash=ShareableLink.hash_token(token)).update(is_used=False, used_at=None)
@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import File , FileShare
+from .models import Blob, File, FileShare
 
 # Register your models here.
 admin.site.register(File)
-admin.site.register(FileShare)
\ No newline at end of file
+admin.site.register(FileShare)
+admin.site.register(Blob)
\ No newline at end of file
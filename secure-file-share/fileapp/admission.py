@@ -0,0 +1,203 @@
+import time
+import threading
+from collections import Counter, deque
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+
+class Saturated(Exception):
+    """Raised when a job could not be admitted before its queue timeout"""
+
+    def __init__(self, retry_after):
+        super().__init__("Server is busy, please retry shortly.")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """An admitted job's reservation; release() returns it and is safe to call more than once"""
+
+    def __init__(self, controller, cost):
+        self._controller = controller
+        self.cost = cost
+        self._holds_slot = controller is not None
+
+    def release_slot(self):
+        """Give back the job slot but keep the reserved bytes until release()"""
+        if self._holds_slot:
+            self._holds_slot = False
+            self._controller._release(0, slot=True)
+
+    def release(self):
+        controller, self._controller = self._controller, None
+        if controller is not None:
+            controller._release(self.cost, slot=self._holds_slot)
+            self._holds_slot = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Admits encryption and decryption jobs first come, first served, while fewer than max_jobs
+    are running and their memory costs fit in budget bytes. A job costing more than the whole
+    budget runs once no other holds memory. Jobs on files of at most bypass_size bytes are admitted
+    at once without counting against either limit. A job that cannot start within
+    queue_timeout seconds, or arrives to a queue of max_queue, raises Saturated.
+    Streamed responses give their slot back once admitted and only hold their bytes.
+    """
+
+    def __init__(self, budget, max_jobs, bypass_size=0, queue_timeout=2, max_queue=None, retry_after=5):
+        self.budget = budget
+        self.max_jobs = max_jobs
+        self.bypass_size = bypass_size
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue if max_queue is not None else 4 * max_jobs
+        self.retry_after = retry_after
+        self.running = 0
+        self.reserved = 0
+        self.outcomes = Counter()
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    def _fits(self, cost):
+        if self.running >= self.max_jobs:
+            return False
+        return self.reserved == 0 or self.reserved + cost <= self.budget
+
+    def admit(self, size, cost):
+        """
+        Reserve cost bytes for a job on a file of size bytes (None if unknown) and return its Ticket.
+        cost may be a callable, so jobs that bypass the queue never pay for estimating it.
+        Raises Saturated when the job cannot be admitted in time.
+        """
+        if size is not None and size <= self.bypass_size:
+            with self._cond:
+                self.outcomes['bypassed'] += 1
+            return Ticket(None, 0)
+
+        if callable(cost):
+            cost = cost()
+        started = time.monotonic()
+        with self._cond:
+            if not self._waiting and self._fits(cost):
+                return self._grant(cost, started)
+            if len(self._waiting) >= self.max_queue:
+                self.outcomes['rejected'] += 1
+                raise Saturated(self.retry_after)
+
+            waiter = object()
+            self._waiting.append(waiter)
+            try:
+                deadline = started + self.queue_timeout
+                while not (self._waiting[0] is waiter and self._fits(cost)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.outcomes['rejected'] += 1
+                        raise Saturated(self.retry_after)
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(waiter)
+                # The next waiter may now be at the head of the queue
+                self._cond.notify_all()
+            return self._grant(cost, started)
+
+    def _grant(self, cost, started):
+        self.running += 1
+        self.reserved += cost
+        self.outcomes['admitted'] += 1
+        if metrics.enabled():
+            metrics.observe('admission_wait', time.monotonic() - started)
+        return Ticket(self, cost)
+
+    def _release(self, cost, slot):
+        with self._cond:
+            if slot:
+                self.running -= 1
+            self.reserved -= cost
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'queued': len(self._waiting),
+                'running': self.running,
+                'reserved_bytes': self.reserved,
+                **{outcome: self.outcomes[outcome] for outcome in ('admitted', 'bypassed', 'rejected')},
+            }
+
+
+def guarded(chunks, ticket):
+    """
+    Stream chunks under ticket's memory reservation, released when the stream finishes, fails or is
+    closed early. The job slot is returned at once: responses go at the client's pace, and holding
+    slots that long would cap each process at FILE_CRYPTO_MAX_JOBS concurrent downloads.
+    """
+    ticket.release_slot()
+    return _stream(chunks, ticket)
+
+
+def _stream(chunks, ticket):
+    try:
+        yield from chunks
+    finally:
+        ticket.release()
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """The process-wide controller, built from the FILE_CRYPTO_* settings"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(
+                budget=getattr(settings, 'FILE_CRYPTO_MEMORY_BUDGET', 256 * 1024 * 1024),
+                max_jobs=getattr(settings, 'FILE_CRYPTO_MAX_JOBS', 32),
+                bypass_size=getattr(settings, 'FILE_CRYPTO_BYPASS_SIZE', 1024 * 1024),
+                queue_timeout=getattr(settings, 'FILE_CRYPTO_QUEUE_TIMEOUT', 2),
+                max_queue=getattr(settings, 'FILE_CRYPTO_MAX_QUEUE', None),
+                retry_after=getattr(settings, 'FILE_CRYPTO_RETRY_AFTER', 5),
+            )
+        return _controller
+
+
+@receiver(setting_changed)
+def _reset_controller(setting, **kwargs):
+    global _controller
+    if setting.startswith('FILE_CRYPTO_'):
+        with _controller_lock:
+            _controller = None
+
+
+def admit(size, cost):
+    return get_controller().admit(size, cost)
+
+
+def render():
+    """Queue depth, running jobs and outcomes in the Prometheus text exposition format"""
+    state = get_controller().snapshot()
+    lines = [
+        '# HELP fileapp_admission_queued_jobs Crypto jobs waiting for admission.',
+        '# TYPE fileapp_admission_queued_jobs gauge',
+        f"fileapp_admission_queued_jobs {state['queued']}",
+        '# HELP fileapp_admission_running_jobs Admitted crypto jobs still running.',
+        '# TYPE fileapp_admission_running_jobs gauge',
+        f"fileapp_admission_running_jobs {state['running']}",
+        '# HELP fileapp_admission_reserved_bytes Memory reserved by running crypto jobs.',
+        '# TYPE fileapp_admission_reserved_bytes gauge',
+        f"fileapp_admission_reserved_bytes {state['reserved_bytes']}",
+        '# HELP fileapp_admission_jobs_total Crypto jobs by admission outcome.',
+        '# TYPE fileapp_admission_jobs_total counter',
+    ]
+    for outcome in ('admitted', 'bypassed', 'rejected'):
+        lines.append(f'fileapp_admission_jobs_total{{outcome="{outcome}"}} {state[outcome]}')
+    return '\n'.join(lines) + '\n'
@@ -8,3 +8,18 @@ class FileappConfig(AppConfig):
     
     # Set the name of the application
     name = "fileapp"
+
+    def ready(self):
+        # Registers the query timer on every new database connection
+        from . import metrics  # noqa: F401
+
+        # Registers the upload job handlers, for inline runs and `manage.py run_workers` alike
+        from . import processing  # noqa: F401
+
+        # Periodic cleanup runs in-process only when JANITOR_INTERVAL is configured
+        from .janitor import start_janitor_worker
+        start_janitor_worker()
+
+        # Likewise for integrity scrubbing, only when SCRUB_INTERVAL is configured
+        from .scrubber import start_scrubber_worker
+        start_scrubber_worker()
@@ -0,0 +1,96 @@
+"""
+ASGI request bodies without plaintext on disk. Django's ASGI handler receives the whole body
+before any view runs and spools it to a temp file once it outgrows FILE_UPLOAD_MAX_MEMORY_SIZE,
+which would leave multipart uploads on disk in the clear. This handler spools the same bytes
+encrypted under a key that only lives in memory for the one request.
+"""
+import io
+import os
+import tempfile
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.conf import settings
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+
+BLOCK_SIZE = 16
+
+
+class EncryptedSpool(io.RawIOBase):
+    """
+    Seekable temp file that holds its content AES-CTR encrypted under a throwaway key.
+    Writes must append; reads and seeks work anywhere. file is the ciphertext spool.
+    """
+
+    def __init__(self, max_size):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b')
+        self._key = os.urandom(32)
+        # The low half counts blocks, so the counter never wraps within one body
+        self._nonce = int.from_bytes(os.urandom(8) + bytes(8), 'big')
+        self._position = 0
+        self._size = 0
+        self._keystream = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _cipher(self):
+        """CTR cipher positioned at the current offset; CTR encrypts and decrypts alike"""
+        if self._keystream is None:
+            block, skip = divmod(self._position, BLOCK_SIZE)
+            counter = (self._nonce + block).to_bytes(BLOCK_SIZE, 'big')
+            self._keystream = Cipher(algorithms.AES(self._key), modes.CTR(counter)).encryptor()
+            self._keystream.update(bytes(skip))
+        return self._keystream
+
+    def write(self, data):
+        if self._position != self._size:
+            raise io.UnsupportedOperation("EncryptedSpool only appends")
+        self.file.seek(self._position)
+        self.file.write(self._cipher().update(bytes(data)))
+        self._position = self._size = self._position + len(data)
+        return len(data)
+
+    def readinto(self, buffer):
+        self.file.seek(self._position)
+        data = self._cipher().update(self.file.read(len(buffer)))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._size}[whence]
+        if base + offset != self._position:
+            self._position = base + offset
+            self._keystream = None
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class EncryptedBodyASGIHandler(ASGIHandler):
+    """ASGIHandler that spools request bodies through an EncryptedSpool"""
+
+    async def read_body(self, receive):
+        spool = EncryptedSpool(settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                spool.close()
+                raise RequestAborted()
+            if 'body' in message:
+                spool.write(message['body'])
+            if not message.get('more_body', False):
+                break
+        spool.seek(0)
+        return io.BufferedReader(spool)
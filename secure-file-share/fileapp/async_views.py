@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from . import views
+
+_executor = None
+_executor_lock = threading.Lock()
+_DONE = object()
+
+
+def get_transfer_executor():
+    """Return the shared pool that runs blocking view code, decryption and disk reads for async views"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FILE_TRANSFER_WORKERS', 16), thread_name_prefix='transfer'
+            )
+        return _executor
+
+
+def _call_view(view, request, *args, **kwargs):
+    """Run a sync view on a pool thread with the same connection lifecycle as a WSGI request"""
+    close_old_connections()
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def _run_view(view, request, *args, **kwargs):
+    run = sync_to_async(_call_view, thread_sensitive=False, executor=get_transfer_executor())
+    return await run(view, request, *args, **kwargs)
+
+
+async def _offloaded(iterator):
+    """Async iterator that pulls each chunk of a blocking iterator on the transfer pool"""
+    loop = asyncio.get_running_loop()
+    executor = get_transfer_executor()
+    while True:
+        chunk = await loop.run_in_executor(executor, next, iterator, _DONE)
+        if chunk is _DONE:
+            return
+        yield chunk
+
+
+def _stream_async(response):
+    """
+    Hand a streaming response's body to the event loop. The sync iterator is still
+    registered for closing, so open ciphertext files are released when the response ends.
+    """
+    if isinstance(response, StreamingHttpResponse) and not response.is_async:
+        response.streaming_content = _offloaded(iter(response.streaming_content))
+    return response
+
+
+# The sync views keep their own login, method and permission checks; these wrappers only
+# move the blocking parts off the event loop, so a slow client holds a socket, not a thread
+
+async def download_file(request, file_id):
+    return _stream_async(await _run_view(views.download_file, request, file_id))
+
+
+async def export_files(request):
+    return _stream_async(await _run_view(views.export_files, request))
+
+
+async def access_shared_file(request, token):
+    return _stream_async(await _run_view(views.access_shared_file, request, token))
+
+
+@csrf_exempt
+async def upload_file(request):
+    # Not streamed: Django's ASGI handler receives the whole body before any view runs, so
+    # parsing and encryption only start on the pool once the last byte is in. The body waits
+    # in an EncryptedSpool (see fileapp/asgi.py), never as plaintext, but takes temp space the
+    # size of the upload; large files belong on the resumable endpoint or a WSGI server.
+    # CSRF is still checked by the sync view
+    return await _run_view(views.upload_file, request)
@@ -0,0 +1,80 @@
+from collections import Counter
+from django.db import transaction
+from django.db.models import F
+
+from .models import Blob, File
+from .storage import delete_many, get_storage
+from .utils import merkle_root, unpack_leaves
+
+
+def attach_blobs(pending):
+    """
+    Point each unsaved File in pending at a shared Blob keyed by its plaintext hash.
+    pending is a list of (uploaded_file, File) pairs. Content that is already stored
+    reuses the existing blob and the freshly written ciphertext is removed once the
+    transaction commits, unless the scrubber found the stored copy corrupt, in which
+    case the new ciphertext replaces it. Must run inside transaction.atomic().
+    """
+    counts = Counter(file.file_hash for _, file in pending)
+    blobs = Blob.objects.select_for_update().in_bulk(list(counts), field_name='content_hash')
+
+    # Content seen for the first time adopts the ciphertext of its first upload
+    new_blobs = {}
+    for uploaded_file, file in pending:
+        if file.file_hash not in blobs and file.file_hash not in new_blobs:
+            new_blobs[file.file_hash] = Blob(
+                content_hash=file.file_hash,
+                file=uploaded_file.storage_name,
+                size=uploaded_file.stored_size,
+                refcount=counts[file.file_hash],
+                integrity_manifest=uploaded_file.integrity_manifest,
+                merkle_root=merkle_root(unpack_leaves(uploaded_file.integrity_manifest)),
+            )
+        elif file.file_hash in blobs and blobs[file.file_hash].corrupted_at is not None:
+            _repair(blobs[file.file_hash], uploaded_file)
+    Blob.objects.bulk_create(new_blobs.values())
+    for content_hash, blob in blobs.items():
+        Blob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + counts[content_hash])
+    blobs.update(new_blobs)
+
+    for uploaded_file, file in pending:
+        blob = blobs[file.file_hash]
+        file.blob = blob
+        if blob.file.name != uploaded_file.storage_name:
+            file.file = blob.file.name
+            transaction.on_commit(uploaded_file.discard)
+
+
+def _repair(blob, uploaded_file):
+    """Swap a corrupt blob's ciphertext for a fresh upload of the same content"""
+    old_name = blob.file.name
+    blob.file = uploaded_file.storage_name
+    blob.size = uploaded_file.stored_size
+    blob.integrity_manifest = uploaded_file.integrity_manifest
+    blob.merkle_root = merkle_root(unpack_leaves(uploaded_file.integrity_manifest))
+    blob.corrupted_at = blob.verified_at = None
+    blob.save(update_fields=['file', 'size', 'integrity_manifest', 'merkle_root', 'corrupted_at', 'verified_at'])
+    File.objects.filter(blob=blob).update(file=blob.file.name, corrupted_at=None)
+    transaction.on_commit(lambda: get_storage().delete(old_name))
+
+
+def release_blobs(blob_ids):
+    """
+    Drop one reference per entry in blob_ids (a blob may appear several times) with one
+    UPDATE per distinct decrement, and delete the blobs left unreferenced; their ciphertext
+    is removed in parallel once the transaction commits. Returns how many blobs were deleted.
+    Must run inside transaction.atomic().
+    """
+    counts = Counter(blob_ids)
+    by_decrement = {}
+    for blob_id, count in counts.items():
+        by_decrement.setdefault(count, []).append(blob_id)
+    for decrement, pks in by_decrement.items():
+        Blob.objects.filter(pk__in=pks).update(refcount=F('refcount') - decrement)
+
+    unused = Blob.objects.filter(pk__in=list(counts), refcount=0)
+    names = list(unused.values_list('file', flat=True))
+    if names:
+        unused.delete()
+        transaction.on_commit(lambda: delete_many(names))
+    return len(names)
@@ -0,0 +1,126 @@
+import secrets
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .access import VIEW, annotate_access, invalidate_grants
+from .blobs import release_blobs
+from .chunking import release_file_chunks
+from .models import File, FileShare, ShareableLink
+from .storage import delete_many
+
+# How long a one-time link stays redeemable
+LINK_LIFETIME = timedelta(hours=24)
+
+
+def new_link(file):
+    """Return an unsaved one-time ShareableLink for file and the token that redeems it"""
+    token = secrets.token_urlsafe(32)
+    # Only a hash of the token is stored, so the database alone cannot be used to redeem links
+    link = ShareableLink(
+        file=file, token_hash=ShareableLink.hash_token(token), expires_at=timezone.now() + LINK_LIFETIME
+    )
+    return link, token
+
+
+def parse_file_ids(values):
+    """
+    Validate a list of file ids from a bulk request; returns them deduplicated in request order.
+    Raises ValueError for a missing, malformed or oversized list.
+    """
+    if not isinstance(values, list) or not values:
+        raise ValueError("file_ids must be a non-empty list.")
+    limit = getattr(settings, 'BULK_MAX_FILES', 500)
+    try:
+        file_ids = list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise ValueError("file_ids must be integers.")
+    if len(file_ids) > limit:
+        raise ValueError(f"At most {limit} files can be changed per request.")
+    return file_ids
+
+
+def failure(file_id, error, **extra):
+    return {'id': file_id, 'success': False, 'error': error, **extra}
+
+
+def load_files(request, file_ids, action):
+    """
+    Fetch the requested files and their permissions with at most two queries.
+    Returns (files request.user may perform action on, results for every other id).
+    Files the user cannot see are reported as missing, so ids of other users' files leak nothing.
+    """
+    files = File.objects.in_bulk(file_ids)
+    annotate_access(request, list(files.values()))
+
+    allowed, refused = [], []
+    for file_id in file_ids:
+        file = files.get(file_id)
+        if file is None or VIEW not in file.actions:
+            refused.append(failure(file_id, "File not found."))
+        elif action not in file.actions:
+            refused.append(failure(file_id, f"You don't have permission to {action} this file."))
+        else:
+            allowed.append(file)
+    return allowed, refused
+
+
+def delete_files(files):
+    """
+    Delete files with set-based queries: their shares, chunk references, rows and blob
+    references go in one transaction, and unreferenced ciphertext is unlinked in parallel
+    after it commits. Returns a result per file.
+    """
+    if not files:
+        return []
+    file_ids = [file.pk for file in files]
+    with transaction.atomic():
+        shares = FileShare.objects.filter(file_id__in=file_ids)
+        grants = list(shares.values_list('file_id', 'shared_with_id'))
+        shares.delete()
+        release_file_chunks([file.pk for file in files if file.chunked])
+        File.objects.filter(pk__in=file_ids).delete()
+        release_blobs([file.blob_id for file in files if file.blob_id is not None])
+
+        # Rows that predate the blob store own their ciphertext outright
+        legacy = [str(file.file) for file in files if file.blob_id is None and not file.chunked and file.file]
+        if legacy:
+            transaction.on_commit(lambda: delete_many(legacy))
+    invalidate_grants(grants)
+    return [{'id': file.pk, 'success': True} for file in files]
+
+
+def share_files(files, shared_by, shared_with, permission='download', force=False):
+    """
+    Share files with one user using a single bulk INSERT. Files already shared with them
+    are skipped unless force is set, matching the single-file "Share Anyway" flow.
+    """
+    if not files:
+        return []
+    already = set(
+        FileShare.objects.filter(file__in=files, shared_with=shared_with).values_list('file_id', flat=True)
+    )
+    results, shares = [], []
+    for file in files:
+        if file.pk in already and not force:
+            results.append(failure(
+                file.pk, f"This file is already shared with {shared_with.username}.", already_shared=True
+            ))
+            continue
+        shares.append(FileShare(file=file, shared_by=shared_by, shared_with=shared_with, permission=permission))
+        results.append({'id': file.pk, 'success': True})
+
+    FileShare.objects.bulk_create(shares)
+    invalidate_grants((share.file_id, shared_with.id) for share in shares)
+    return results
+
+
+def create_links(files, build_url):
+    """Create a one-time link for every file with a single bulk INSERT; build_url turns a token into a URL"""
+    links = [new_link(file) for file in files]
+    ShareableLink.objects.bulk_create([link for link, _ in links])
+    return [
+        {'id': link.file_id, 'success': True, 'link': build_url(token), 'expires_at': link.expires_at.isoformat()}
+        for link, token in links
+    ]
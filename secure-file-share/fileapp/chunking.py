@@ -0,0 +1,184 @@
+import io
+import hashlib
+from collections import Counter
+from django.db import transaction
+from django.db.models import F
+
+from .models import Chunk, FileChunk
+from .storage import delete_many, get_storage, sharded_name
+from .utils import FileEncryptor
+
+CHUNK_DIR = 'chunks'
+
+# Content-defined chunk bounds; cut points depend only on nearby bytes, so an edit
+# only changes the chunks around it and the rest of a revised file deduplicates
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# 16 mask bits give an average of 64 KiB past the minimum. Gear hash bit k only
+# depends on the last k + 1 bytes, so the mask uses the high bits
+CUT_MASK = ((1 << 16) - 1) << 48
+HASH_MASK = (1 << 64) - 1
+
+# Fixed pseudo-random table; changing it would change every cut point
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+class Chunker:
+    """Splits a byte stream into content-defined chunks with a Gear rolling hash"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = MIN_CHUNK_SIZE
+        self._hash = 0
+
+    def _find_cut(self):
+        """Scan forward from where the last call stopped; return a cut offset or None"""
+        buffer = self._buffer
+        end = min(len(buffer), MAX_CHUNK_SIZE)
+        h = self._hash
+        position = self._position
+        while position < end:
+            h = ((h << 1) + GEAR[buffer[position]]) & HASH_MASK
+            position += 1
+            if not h & CUT_MASK:
+                return position
+        self._hash = h
+        self._position = position
+        if len(buffer) >= MAX_CHUNK_SIZE:
+            return MAX_CHUNK_SIZE
+        return None
+
+    def _emit(self, cut):
+        chunk = bytes(self._buffer[:cut])
+        del self._buffer[:cut]
+        self._position = MIN_CHUNK_SIZE
+        self._hash = 0
+        return chunk
+
+    def update(self, data):
+        """Feed bytes and return the chunks that are now complete"""
+        self._buffer += data
+        chunks = []
+        while len(self._buffer) > MIN_CHUNK_SIZE:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunks.append(self._emit(cut))
+        return chunks
+
+    def finalize(self):
+        """Return whatever is left as the final chunk(s)"""
+        chunks = self.update(b'')
+        if self._buffer:
+            chunks.append(self._emit(len(self._buffer)))
+        return chunks
+
+
+def chunk_name(chunk_hash):
+    """Storage name of a chunk's ciphertext, sharded by hash prefix"""
+    return sharded_name(CHUNK_DIR, chunk_hash)
+
+
+def store_chunk(data, filename=None, data_key=None):
+    """
+    Encrypt and write a chunk unless identical content is already stored.
+    filename is only a hint for whether compressing the chunk is worthwhile.
+    data_key (a keys.PlainDataKey, or a callable returning one) seals the chunk; by default it gets its own.
+    Returns the chunk hash; unchanged chunks of a revised file cost only a hash and a row lookup.
+    """
+    chunk_hash = hashlib.sha256(data).hexdigest()
+    # Only a referenced chunk is safe to reuse: anything else may be reclaimed at any moment,
+    # so it is written again, which also makes it young enough for the janitor to leave alone
+    if Chunk.objects.filter(chunk_hash=chunk_hash, refcount__gt=0).exists():
+        return chunk_hash
+
+    with get_storage().open_write(chunk_name(chunk_hash)) as destination:
+        FileEncryptor.encrypt_stream(
+            io.BytesIO(data), destination, filename=filename, data_key=data_key() if callable(data_key) else data_key
+        )
+    return chunk_hash
+
+
+def attach_chunks(files):
+    """
+    Write manifest rows for saved chunked Files and take a reference on every chunk.
+    files is a list of (File, manifest) pairs, where manifest lists (chunk_hash, size).
+    Must run inside transaction.atomic(). The chunk rows stay locked until it commits,
+    so reclaim_chunks cannot remove ciphertext this upload is about to reference.
+    Returns the hashes of the chunks it created, whose ciphertext this upload wrote.
+    """
+    counts = Counter(chunk_hash for _, manifest in files for chunk_hash, _ in manifest)
+    sizes = {chunk_hash: size for _, manifest in files for chunk_hash, size in manifest}
+    chunks = Chunk.objects.select_for_update().in_bulk(list(counts), field_name='chunk_hash')
+
+    # Inserting the new rows first claims their hashes against a concurrent reclaim
+    new_chunks = [
+        Chunk(chunk_hash=chunk_hash, size=sizes[chunk_hash], refcount=count)
+        for chunk_hash, count in counts.items() if chunk_hash not in chunks
+    ]
+    Chunk.objects.bulk_create(new_chunks)
+    unreferenced = [chunk.chunk_hash for chunk in new_chunks]
+    unreferenced += [chunk_hash for chunk_hash, chunk in chunks.items() if chunk.refcount == 0]
+    for chunk_hash in unreferenced:
+        # The ciphertext may have been reclaimed after this upload found it stored
+        if not get_storage().exists(chunk_name(chunk_hash)):
+            raise Exception("Chunk was removed during upload; please retry.")
+
+    # Most chunks gain one reference, so group the increments by amount
+    by_increment = {}
+    for chunk_hash, chunk in chunks.items():
+        by_increment.setdefault(counts[chunk_hash], []).append(chunk.pk)
+    for increment, pks in by_increment.items():
+        Chunk.objects.filter(pk__in=pks).update(refcount=F('refcount') + increment)
+
+    chunks = Chunk.objects.in_bulk(list(counts), field_name='chunk_hash')
+    entries = []
+    for file, manifest in files:
+        offset = 0
+        for index, (chunk_hash, size) in enumerate(manifest):
+            entries.append(FileChunk(file=file, chunk=chunks[chunk_hash], index=index, offset=offset))
+            offset += size
+    FileChunk.objects.bulk_create(entries)
+    return {chunk.chunk_hash for chunk in new_chunks}
+
+
+def release_file_chunks(file_ids):
+    """
+    Drop the references the given chunked Files hold with a fixed number of queries;
+    chunks left without references are handed to reclaim_chunks once the transaction
+    commits. Must run inside transaction.atomic(), before the File rows are deleted.
+    """
+    entries = FileChunk.objects.filter(file_id__in=file_ids)
+    counts = Counter(entries.values_list('chunk_id', flat=True))
+    by_decrement = {}
+    for chunk_id, count in counts.items():
+        by_decrement.setdefault(count, []).append(chunk_id)
+    for decrement, pks in by_decrement.items():
+        Chunk.objects.filter(pk__in=pks).update(refcount=F('refcount') - decrement)
+    entries.delete()
+
+    unused = list(Chunk.objects.filter(pk__in=list(counts), refcount=0).values_list('chunk_hash', flat=True))
+    if unused:
+        transaction.on_commit(lambda: reclaim_chunks(unused))
+    return len(unused)
+
+
+def reclaim_chunks(chunk_hashes):
+    """
+    Remove the rows and ciphertext of the given chunks that nothing references, and return
+    how many objects were deleted. Each chunk is re-checked under the row lock attach_chunks
+    takes; hashes without a row get a placeholder row first, which keeps an upload from
+    attaching them while their ciphertext is deleted.
+    """
+    with transaction.atomic():
+        Chunk.objects.bulk_create(
+            [Chunk(chunk_hash=chunk_hash, size=0) for chunk_hash in chunk_hashes], ignore_conflicts=True
+        )
+        unused = dict(
+            Chunk.objects.select_for_update().filter(chunk_hash__in=chunk_hashes, refcount=0)
+            .values_list('pk', 'chunk_hash')
+        )
+        if not unused:
+            return 0
+        Chunk.objects.filter(pk__in=list(unused)).delete()
+        return delete_many(chunk_name(chunk_hash) for chunk_hash in unused.values())
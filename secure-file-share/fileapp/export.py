@@ -0,0 +1,66 @@
+import os
+import zipfile
+
+
+class _Sink:
+    """Write-only, unseekable buffer that ZipFile writes into and the response drains"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_names(files):
+    """Pick a unique, flat archive path for each File; repeated names get ' (n)' before the extension"""
+    names, seen = [], set()
+    for file in files:
+        base, ext = os.path.splitext(file.filename.replace('/', '_').replace('\\', '_') or 'file')
+        name, n = base + ext, 1
+        while name.lower() in seen:
+            n += 1
+            name = f"{base} ({n}){ext}"
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def iter_zip(members, deflate=False):
+    """
+    Stream a ZIP archive built from members, an iterable of (name, modified datetime,
+    plaintext size or None, chunk iterator). Nothing is seekable, so each entry is followed
+    by a data descriptor; ZIP64 records are used for entries and offsets past 4 GiB, and
+    for entries of unknown size. Only the chunk being written and the central directory
+    (one record per entry) are held in memory.
+    """
+    sink = _Sink()
+    compression = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+    with zipfile.ZipFile(sink, 'w', compression=compression, allowZip64=True) as archive:
+        for name, modified, size, chunks in members:
+            info = zipfile.ZipInfo(name, date_time=max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = compression
+            info.external_attr = 0o644 << 16
+            if size is not None:
+                info.file_size = size
+            with archive.open(info, 'w', force_zip64=size is None) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield from _drained(sink)
+            yield from _drained(sink)
+    yield from _drained(sink)
+
+
+def _drained(sink):
+    data = sink.drain()
+    if data:
+        yield data
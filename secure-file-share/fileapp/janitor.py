@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+from django.conf import settings
+from datetime import timedelta
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .chunking import CHUNK_DIR, reclaim_chunks
+from .models import Blob, Chunk, File, FileShare, Job, ShareableLink, UploadSession
+from .resumable import SESSION_DIR, discard_session
+from .storage import BLOB_DIR, LocalStorage, get_storage
+from .uploadhandlers import UPLOAD_DIR
+from .utils import DECRYPT_TEMP_PREFIX
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# Files younger than this may belong to an upload whose database rows are not committed yet
+ORPHAN_GRACE_PERIOD = 60 * 60
+
+
+class RateLimiter:
+    """Sleeps just enough to keep consumed units under rate per second; rate 0 means unlimited"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._start = time.monotonic()
+        self._consumed = 0
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        self._consumed += amount
+        delay = self._consumed / self.rate - (time.monotonic() - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _delete_in_batches(queryset, batch_size):
+    """Delete queryset a bounded batch at a time so no single statement locks the table for long"""
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=pks).delete()[1].get(queryset.model._meta.label, 0)
+
+
+def sweep_rows(now=None, batch_size=BATCH_SIZE):
+    """Delete expired or used links, expired shares, expired upload sessions and old finished jobs"""
+    now = now or timezone.now()
+    stats = Counter()
+    stats['links'] = _delete_in_batches(ShareableLink.objects.filter(expires_at__lt=now), batch_size)
+    stats['links'] += _delete_in_batches(ShareableLink.objects.filter(is_used=True), batch_size)
+    stats['shares'] = _delete_in_batches(FileShare.objects.filter(expiration_date__lt=now), batch_size)
+    # Failed jobs are kept as long as finished ones, so there is time to look into them
+    stats['jobs'] = _delete_in_batches(Job.objects.filter(
+        status__in=[Job.DONE, Job.FAILED],
+        finished_at__lt=now - timedelta(seconds=getattr(settings, 'JOB_RETENTION', 7 * 24 * 60 * 60)),
+    ), batch_size)
+
+    # Sessions own a staging file, so they go one by one through discard_session
+    while True:
+        sessions = list(UploadSession.objects.filter(expires_at__lt=now)[:batch_size])
+        if not sessions:
+            break
+        for session in sessions:
+            discard_session(session)
+        stats['sessions'] += len(sessions)
+    return stats
+
+
+def _old_files(storage, directory, cutoff):
+    """Yield (name, size) for objects under directory in storage last modified before cutoff"""
+    for name, size, modified in storage.list(directory):
+        if modified < cutoff:
+            yield name, size
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def referenced_names(directory, names):
+    """The subset of storage names that a File, Blob, Chunk or UploadSession still uses"""
+    if directory in (UPLOAD_DIR, BLOB_DIR):
+        return set(File.objects.filter(file__in=names).values_list('file', flat=True)) | set(
+            Blob.objects.filter(file__in=names).values_list('file', flat=True)
+        )
+    keys = {name: os.path.basename(name) for name in names}
+    if directory == CHUNK_DIR:
+        used = set(
+            Chunk.objects.filter(chunk_hash__in=keys.values(), refcount__gt=0).values_list('chunk_hash', flat=True)
+        )
+    else:
+        ids = [key[:-len('.part')] for key in keys.values() if key.endswith('.part')]
+        used = {f"{pk}.part" for pk in UploadSession.objects.filter(pk__in=ids).values_list('pk', flat=True)}
+    return {name for name, key in keys.items() if key in used}
+
+
+def _remove(remove, target, size, limiter, stats, kind):
+    try:
+        if remove(target) is False:
+            return
+    except FileNotFoundError:
+        return
+    stats[f'{kind}_files'] += 1
+    stats[f'{kind}_bytes'] += size
+    limiter.consume(size)
+
+
+def _reclaim_chunk(name):
+    """Delete an orphaned chunk through reclaim_chunks, which re-checks it under the row lock"""
+    return bool(reclaim_chunks([os.path.basename(name)]))
+
+
+def sweep_files(limiter=None, batch_size=BATCH_SIZE, grace_period=ORPHAN_GRACE_PERIOD):
+    """
+    Remove ciphertext, chunk and staging files that no row refers to, and
+    plaintext temp files leaked by releases that decrypted downloads to disk.
+    Only files older than grace_period are considered.
+    """
+    limiter = limiter or RateLimiter(0)
+    cutoff = time.time() - grace_period
+    stats = Counter()
+
+    # Legacy uploads and staging files only ever live on local disk
+    local, storage = LocalStorage(), get_storage()
+    for backend, directory in ((storage, BLOB_DIR), (storage, CHUNK_DIR), (local, UPLOAD_DIR), (local, SESSION_DIR)):
+        for batch in _batches(_old_files(backend, directory, cutoff), batch_size):
+            used = referenced_names(directory, [name for name, _ in batch])
+            remove = _reclaim_chunk if directory == CHUNK_DIR else backend.delete
+            for name, size in batch:
+                if name not in used:
+                    _remove(remove, name, size, limiter, stats, 'orphan')
+
+    temp_dir = tempfile.gettempdir()
+    for entry in os.scandir(temp_dir):
+        if entry.name.startswith(DECRYPT_TEMP_PREFIX) and entry.is_file():
+            stat = entry.stat()
+            if stat.st_mtime < cutoff:
+                _remove(os.remove, entry.path, stat.st_size, limiter, stats, 'temp')
+    return stats
+
+
+def run_janitor(io_rate=None, batch_size=BATCH_SIZE, grace_period=ORPHAN_GRACE_PERIOD):
+    """
+    Run one full sweep and return counts of what was reclaimed.
+    io_rate caps file deletion in bytes per second (default JANITOR_IO_RATE, 0 for no limit).
+    """
+    started = time.monotonic()
+    if io_rate is None:
+        io_rate = getattr(settings, 'JANITOR_IO_RATE', 0)
+    stats = sweep_rows(batch_size=batch_size)
+    stats.update(sweep_files(RateLimiter(io_rate), batch_size, grace_period))
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_janitor_worker(interval=None):
+    """
+    Start a daemon thread that runs the janitor every interval seconds (default JANITOR_INTERVAL).
+    Does nothing if the interval is unset or a worker is already running in this process.
+    """
+    global _worker
+    interval = interval if interval is not None else getattr(settings, 'JANITOR_INTERVAL', None)
+    if not interval:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                stats = run_janitor()
+                logger.info("Janitor reclaimed %s", dict(stats))
+            except Exception:
+                logger.exception("Janitor sweep failed")
+            finally:
+                close_old_connections()
+
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=loop, name='janitor', daemon=True)
+            _worker.start()
+        return _worker
@@ -0,0 +1,208 @@
+"""
+Durable background jobs kept in the database, so no broker is needed. Handlers register with
+@handler(kind) and take the job payload as keyword arguments. Workers (`manage.py run_workers`)
+lease the due job with the highest priority and keep extending the lease while its handler runs.
+A failed job is retried with exponential backoff until it runs out of attempts. A worker that
+dies stops extending its lease, and the job becomes visible again once the lease (the
+visibility timeout) passes. Handlers can therefore run more than once and must be idempotent.
+"""
+import os
+import socket
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Longest wait between two attempts of a failing job, in seconds
+MAX_BACKOFF = 60 * 60
+
+_handlers = {}
+
+
+def handler(kind, on_failure=None):
+    """
+    Register the decorated function as the handler for jobs of kind.
+    on_failure(error, **payload) runs once when the job fails for good.
+    """
+    def register(func):
+        _handlers[kind] = (func, on_failure)
+        return func
+    return register
+
+
+def _visibility_timeout(value):
+    return value or getattr(settings, 'JOB_VISIBILITY_TIMEOUT', 300)
+
+
+def enqueue(kind, payloads, priority=0, delay=0):
+    """
+    Queue one job of kind per payload with a single INSERT and return them. Queued inside a
+    transaction, the jobs commit together with the rows they refer to, or not at all.
+    """
+    run_after = timezone.now() + timedelta(seconds=delay)
+    max_attempts = getattr(settings, 'JOB_MAX_ATTEMPTS', 5)
+    return Job.objects.bulk_create([
+        Job(kind=kind, payload=payload, priority=priority, run_after=run_after, max_attempts=max_attempts)
+        for payload in payloads
+    ])
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _owned(job):
+    """The job's row, as long as this lease on it is still the current one"""
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING, lease_owner=job.lease_owner, attempts=job.attempts)
+
+
+def _claim(job, owner, visibility_timeout, now):
+    """Lease job unless another worker got there first; attempts serves as the row version"""
+    leased_until = now + timedelta(seconds=visibility_timeout)
+    claimed = Job.objects.filter(
+        Q(status=Job.QUEUED) | Q(status=Job.RUNNING, leased_until__lt=now), pk=job.pk, attempts=job.attempts,
+    ).update(status=Job.RUNNING, attempts=F('attempts') + 1, leased_until=leased_until, lease_owner=owner)
+    if claimed:
+        job.status, job.attempts, job.leased_until, job.lease_owner = Job.RUNNING, job.attempts + 1, leased_until, owner
+    return bool(claimed)
+
+
+def lease(owner, limit=1, visibility_timeout=None):
+    """
+    Lease up to limit due jobs, highest priority first, for visibility_timeout seconds
+    (default JOB_VISIBILITY_TIMEOUT). A lease that ran out counts as an attempt, so a job
+    that keeps crashing its workers is failed instead of being handed out forever.
+    """
+    visibility_timeout = _visibility_timeout(visibility_timeout)
+    now = timezone.now()
+    due = Job.objects.filter(
+        Q(status=Job.QUEUED, run_after__lte=now) | Q(status=Job.RUNNING, leased_until__lt=now)
+    ).order_by('-priority', 'run_after', 'id')
+    leased = []
+    # Other workers race for the same rows, so look past the ones they win
+    for job in due[:limit * 4]:
+        if job.status == Job.RUNNING and job.attempts >= job.max_attempts:
+            expired = Job.objects.filter(pk=job.pk, status=Job.RUNNING, attempts=job.attempts, leased_until__lt=now)
+            if expired.update(status=Job.FAILED, finished_at=now, leased_until=None, last_error="Lease expired"):
+                _gave_up(job, "Lease expired")
+        elif _claim(job, owner, visibility_timeout, now):
+            leased.append(job)
+            if len(leased) == limit:
+                break
+    return leased
+
+
+def _gave_up(job, error):
+    logger.error("Job %s (%s) failed for good: %s", job.pk, job.kind, error)
+    on_failure = _handlers.get(job.kind, (None, None))[1]
+    if on_failure is not None:
+        on_failure(error, **job.payload)
+
+
+def _keep_leased(job, visibility_timeout, stop):
+    """Push job's lease forward every third of the timeout until stop is set"""
+    try:
+        while not stop.wait(visibility_timeout / 3):
+            _owned(job).update(leased_until=timezone.now() + timedelta(seconds=visibility_timeout))
+    finally:
+        connection.close()
+
+
+def run(job, visibility_timeout=None):
+    """Run a leased job and record whether it is done, due for a retry or failed; returns True on success"""
+    visibility_timeout = _visibility_timeout(visibility_timeout)
+    func = _handlers.get(job.kind, (None, None))[0]
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_keep_leased, args=(job, visibility_timeout, stop), daemon=True)
+    heartbeat.start()
+    try:
+        if func is None:
+            raise Exception(f"No handler is registered for {job.kind!r} jobs")
+        func(**job.payload)
+        error = None
+    except Exception as e:
+        logger.warning("Job %s (%s) attempt %s failed: %s", job.pk, job.kind, job.attempts, e)
+        error = str(e) or type(e).__name__
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    now = timezone.now()
+    if error is None:
+        finished = _owned(job).update(status=Job.DONE, finished_at=now, leased_until=None, last_error='')
+    elif job.attempts >= job.max_attempts:
+        finished = _owned(job).update(status=Job.FAILED, finished_at=now, leased_until=None, last_error=error)
+        if finished:
+            _gave_up(job, error)
+    else:
+        backoff = min(getattr(settings, 'JOB_RETRY_BACKOFF', 10) * 2 ** (job.attempts - 1), MAX_BACKOFF)
+        finished = _owned(job).update(
+            status=Job.QUEUED, run_after=now + timedelta(seconds=backoff), leased_until=None, last_error=error
+        )
+    if not finished:
+        logger.warning("Job %s (%s) outlived its lease; another worker has taken it over", job.pk, job.kind)
+    return error is None
+
+
+def dispatch(jobs):
+    """
+    With JOB_RUN_INLINE set, run freshly queued jobs in this process as if a worker had leased
+    them at once; otherwise leave them to `manage.py run_workers`. Call once the transaction
+    that queued them has committed. A failed inline attempt is retried by the workers.
+    """
+    if not getattr(settings, 'JOB_RUN_INLINE', True):
+        return
+    owner = worker_name()
+    visibility_timeout = _visibility_timeout(None)
+    for job in jobs:
+        if _claim(job, owner, visibility_timeout, timezone.now()):
+            run(job, visibility_timeout)
+
+
+def work(stop=None, once=False, poll_interval=None, visibility_timeout=None):
+    """
+    Lease and run jobs one at a time until stop (a threading.Event) is set; with once, return
+    as soon as no job is due. Returns how many jobs were run.
+    """
+    stop = stop or threading.Event()
+    poll_interval = poll_interval or getattr(settings, 'JOB_POLL_INTERVAL', 1)
+    owner = worker_name()
+    processed = 0
+    while not stop.is_set():
+        try:
+            leased = lease(owner, 1, visibility_timeout)
+            for job in leased:
+                run(job, visibility_timeout)
+                processed += 1
+        except Exception:
+            logger.exception("Job worker could not lease")
+            leased = []
+        finally:
+            close_old_connections()
+        if not leased:
+            if once:
+                break
+            stop.wait(poll_interval)
+    return processed
+
+
+def render():
+    """Unfinished and failed jobs by kind in the Prometheus text exposition format"""
+    counts = (
+        Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING, Job.FAILED])
+        .values_list('kind', 'status').annotate(Count('id')).order_by()
+    )
+    lines = [
+        '# HELP fileapp_jobs Background jobs not yet done, by kind and status.',
+        '# TYPE fileapp_jobs gauge',
+    ]
+    for kind, status, count in counts:
+        lines.append(f'fileapp_jobs{{kind="{kind}",status="{status}"}} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,176 @@
+"""
+Envelope encryption. Every stored ciphertext is sealed under a random data key, and the data
+key is kept in a DataKey row wrapped by a master key from the key ring (FILE_MASTER_KEYS).
+The segmented header names the DataKey row, so rotating a master key only re-wraps rows
+(see `manage.py rotate_keys`) and never rewrites stored ciphertext.
+"""
+import os
+import time
+import base64
+import threading
+from collections import OrderedDict, namedtuple
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+from .models import DataKey
+
+DATA_KEY_SIZE = 32
+WRAP_NONCE_SIZE = 12
+# Id of the master key used when FILE_MASTER_KEYS is empty: the FERNET_KEY from .env
+DEFAULT_MASTER_KEY_ID = 'fernet'
+SEGMENT_KEY_INFO = b"secure-file-share segment key"
+WRAPPING_KEY_INFO = b"secure-file-share key wrapping"
+
+# A data key together with the id of the DataKey row that stores it wrapped
+PlainDataKey = namedtuple('PlainDataKey', 'id key')
+
+
+def derive_key(material, salt, info):
+    """HKDF-SHA256 a 32-byte key from raw key material"""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(material)
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps the maxsize most recently used entries for at most ttl seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """Return the cached value for key, computing it with factory() on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class KeyRing:
+    """Master keys by id; the active one wraps new data keys, any of them unwraps"""
+
+    def __init__(self, master_keys, active_id):
+        if active_id not in master_keys:
+            raise ImproperlyConfigured(f"Active master key {active_id!r} is not in the key ring")
+        self.active_id = active_id
+        # Wrapping keys are derived, so a master key is never used directly as an AES key
+        self._wrapping = {
+            key_id: AESGCM(derive_key(base64.urlsafe_b64decode(key), None, WRAPPING_KEY_INFO))
+            for key_id, key in master_keys.items()
+        }
+
+    def __contains__(self, key_id):
+        return key_id in self._wrapping
+
+    def wrap(self, data_key, key_id=None):
+        """Return (master key id, nonce | sealed data key); the id is bound as associated data"""
+        key_id = key_id or self.active_id
+        nonce = os.urandom(WRAP_NONCE_SIZE)
+        return key_id, nonce + self._wrapping[key_id].encrypt(nonce, data_key, key_id.encode())
+
+    def unwrap(self, key_id, wrapped):
+        if key_id not in self._wrapping:
+            raise Exception(f"Master key {key_id!r} is not in the key ring")
+        wrapped = bytes(wrapped)
+        return self._wrapping[key_id].decrypt(wrapped[:WRAP_NONCE_SIZE], wrapped[WRAP_NONCE_SIZE:], key_id.encode())
+
+
+_ring = None
+_cache = None
+_lock = threading.Lock()
+
+
+def get_key_ring():
+    """The process-wide key ring, built once from FILE_MASTER_KEYS and FILE_ACTIVE_MASTER_KEY"""
+    global _ring
+    with _lock:
+        if _ring is None:
+            master_keys = dict(getattr(settings, 'FILE_MASTER_KEYS', None) or {})
+            if not master_keys:
+                from .utils import FileEncryptor
+                master_keys = {DEFAULT_MASTER_KEY_ID: FileEncryptor.get_key()}
+            active_id = getattr(settings, 'FILE_ACTIVE_MASTER_KEY', None) or list(master_keys)[-1]
+            _ring = KeyRing(master_keys, active_id)
+        return _ring
+
+
+def _get_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = LRUCache(
+                getattr(settings, 'FILE_KEY_CACHE_SIZE', 1024), getattr(settings, 'FILE_KEY_CACHE_TTL', 300)
+            )
+        return _cache
+
+
+def clear_cache():
+    """Forget every unwrapped data key and cipher held by this process"""
+    _get_cache().clear()
+
+
+@receiver(setting_changed)
+def _reset_keys(setting, **kwargs):
+    global _ring, _cache
+    if setting in ('FILE_MASTER_KEYS', 'FILE_ACTIVE_MASTER_KEY', 'FILE_KEY_CACHE_SIZE', 'FILE_KEY_CACHE_TTL'):
+        with _lock:
+            _ring = _cache = None
+
+
+def new_data_key():
+    """Create a random data key, store it wrapped under the active master key and return it"""
+    key = os.urandom(DATA_KEY_SIZE)
+    key_id, wrapped = get_key_ring().wrap(key)
+    row = DataKey.objects.create(key_id=key_id, wrapped_key=wrapped)
+    # Overwrite rather than get: a rolled-back row's id can be handed out again
+    _get_cache().set(('data', row.pk), key)
+    return PlainDataKey(row.pk, key)
+
+
+def _unwrap(data_key_id):
+    with metrics.span('key_load'):
+        row = DataKey.objects.filter(pk=data_key_id).values_list('key_id', 'wrapped_key').first()
+        if row is None:
+            raise Exception(f"Data key {data_key_id} is missing")
+        return get_key_ring().unwrap(*row)
+
+
+def load_data_key(data_key_id):
+    """The data key stored in a DataKey row, unwrapped once and then served from the cache"""
+    return PlainDataKey(data_key_id, _get_cache().get(('data', data_key_id), lambda: _unwrap(data_key_id)))
+
+
+def cached_cipher(name, salt, make_key):
+    """An AES-GCM cipher for one ciphertext's salt, built from make_key() on a cache miss"""
+    return _get_cache().get(('cipher', name, salt), lambda: AESGCM(derive_key(make_key(), salt, SEGMENT_KEY_INFO)))
+
+
+def segment_cipher(data_key_id, salt):
+    """The cipher sealing the segments of a ciphertext written under a data key"""
+    return cached_cipher(data_key_id, salt, lambda: load_data_key(data_key_id).key)
@@ -0,0 +1,468 @@
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import platform
+import resource
+import tempfile
+import subprocess
+import threading
+import contextlib
+import statistics
+import multiprocessing
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from fileapp import keys
+from fileapp.access import redeem_link
+from fileapp.models import File, ShareableLink
+from fileapp.uploadhandlers import EncryptingUploadHandler, reset_encryption_executor
+from fileapp.utils import FileEncryptor
+
+CHUNK_SIZE = 64 * 1024
+
+
+def bench_batch_upload(files, size, workers):
+    """
+    Push a multi-file batch through EncryptingUploadHandler the way the multipart
+    parser does, once encrypting inline and once on a pool of the given size.
+    """
+    payload = os.urandom(size)
+    results = {}
+    for label, worker_count in (('inline', 0), ('pooled', workers)):
+        with tempfile.TemporaryDirectory() as media, \
+                override_settings(MEDIA_ROOT=media, FILE_ENCRYPTION_WORKERS=worker_count):
+            reset_encryption_executor()
+            handler = EncryptingUploadHandler(RequestFactory().post('/upload/'))
+            started = time.perf_counter()
+            uploaded = []
+            for index in range(files):
+                handler.new_file('files', f'file{index}.bin', 'application/octet-stream', size)
+                for offset in range(0, size, CHUNK_SIZE):
+                    handler.receive_data_chunk(payload[offset:offset + CHUNK_SIZE], offset)
+                uploaded.append(handler.file_complete(size))
+            for uploaded_file in uploaded:
+                uploaded_file.file_hash
+                uploaded_file.close()
+            results[label] = time.perf_counter() - started
+    reset_encryption_executor()
+
+    megabytes = files * size / 2 ** 20
+    return {
+        'files': files,
+        'file_size': size,
+        'workers': workers,
+        'cpu_count': os.cpu_count(),
+        'inline_seconds': round(results['inline'], 4),
+        'pooled_seconds': round(results['pooled'], 4),
+        'inline_mb_per_s': round(megabytes / results['inline'], 1),
+        'pooled_mb_per_s': round(megabytes / results['pooled'], 1),
+        'speedup': round(results['inline'] / results['pooled'], 2),
+    }
+
+
+def sample_text(size, seed=0):
+    """Deterministic word soup standing in for .txt/.csv style uploads"""
+    rng = random.Random(seed)
+    words = [
+        'invoice', 'total', 'customer', 'account', 'report', 'quarter', 'revenue', 'the',
+        'and', 'of', 'to', 'in', 'status', 'pending', 'approved', 'region', 'north', 'south',
+    ]
+    out = io.StringIO()
+    while out.tell() < size:
+        out.write(' '.join(rng.choice(words) for _ in range(12)))
+        out.write(f',{rng.randint(0, 99999)}\n')
+    return out.getvalue().encode()[:size]
+
+
+def bench_compression(size):
+    """Compare stored bytes and throughput with the compression stage against raw segments and Fernet"""
+    key = FileEncryptor.get_key()
+    data_key = keys.new_data_key()
+    corpora = {
+        'text': ('sample.txt', sample_text(size)),
+        'incompressible': ('sample.txt', os.urandom(size)),
+        'jpg': ('photo.jpg', sample_text(size)),
+    }
+    results = {}
+    for label, (filename, data) in corpora.items():
+        destination = io.BytesIO()
+        started = time.perf_counter()
+        FileEncryptor.encrypt_stream(io.BytesIO(data), destination, filename=filename, data_key=data_key)
+        elapsed = time.perf_counter() - started
+        stored = destination.getbuffer().nbytes
+        results[label] = {
+            'plaintext_bytes': size,
+            'stored_bytes': stored,
+            'fernet_bytes': len(Fernet(key).encrypt(data)),
+            'saved_vs_plaintext_pct': round(100 * (1 - stored / size), 1),
+            'encrypt_mb_per_s': round(size / 2 ** 20 / elapsed, 1),
+        }
+    return results
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_sizes(text):
+    """Parse a comma-separated list such as '1K,1M,1G' into byte counts"""
+    sizes = []
+    for item in text.split(','):
+        item = item.strip().upper()
+        try:
+            sizes.append(int(item[:-1]) * SIZE_UNITS[item[-1]] if item[-1] in SIZE_UNITS else int(item))
+        except (ValueError, IndexError):
+            raise CommandError(f"Invalid size: {item!r}")
+    return sizes
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or 0 where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def median(values):
+    return round(statistics.median(values), 4)
+
+
+def _crypto_child(path, data_key, results):
+    """Runs in a fresh process so its peak RSS covers one size only"""
+    baseline = current_rss()
+    encrypted = path + '.enc'
+    started = time.perf_counter()
+    with open(path, 'rb') as source, open(encrypted, 'wb') as destination:
+        file_hash = FileEncryptor.encrypt_stream(source, destination, filename='sample.bin', data_key=data_key)
+    encrypt_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in FileEncryptor.iter_verified(encrypted, file_hash):
+        pass
+    decrypt_seconds = time.perf_counter() - started
+    os.remove(encrypted)
+    results.put({
+        'encrypt_seconds': encrypt_seconds,
+        'decrypt_seconds': decrypt_seconds,
+        'peak_rss_growth_mb': round(max(peak_rss() - baseline, 0) / 2 ** 20, 1),
+    })
+
+
+def bench_crypto(sizes):
+    """Encrypt and verified-decrypt throughput plus memory growth for each file size, file to file"""
+    # Created before forking, so children find the key in their inherited cache and never use the database
+    data_key = keys.new_data_key()
+    context = multiprocessing.get_context('fork')
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'sample.bin')
+        for size in sizes:
+            with open(path, 'wb') as f:
+                for offset in range(0, size, 2 ** 20):
+                    f.write(os.urandom(min(2 ** 20, size - offset)))
+            queue = context.Queue()
+            child = context.Process(target=_crypto_child, args=(path, data_key, queue))
+            child.start()
+            measured = queue.get()
+            child.join()
+            megabytes = size / 2 ** 20
+            results.append({
+                'size': size,
+                'encrypt_mb_per_s': round(megabytes / measured['encrypt_seconds'], 1),
+                'decrypt_mb_per_s': round(megabytes / measured['decrypt_seconds'], 1),
+                'encrypt_seconds': round(measured['encrypt_seconds'], 4),
+                'decrypt_seconds': round(measured['decrypt_seconds'], 4),
+                'peak_rss_growth_mb': measured['peak_rss_growth_mb'],
+            })
+    return results
+
+
+@contextlib.contextmanager
+def temp_environment():
+    """A throwaway SQLite database file and MEDIA_ROOT for benchmarks that go through Django"""
+    with tempfile.TemporaryDirectory() as workdir:
+        test_settings = settings.DATABASES['default'].setdefault('TEST', {})
+        previous_name = test_settings.get('NAME')
+        test_settings['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media')):
+                yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            test_settings['NAME'] = previous_name
+
+
+def bench_transfers(sizes, repeats):
+    """End-to-end upload and streamed download latency through the test client"""
+    user = User.objects.create_user('bench-transfers')
+    client = Client()
+    client.force_login(user)
+    results = []
+    for size in sizes:
+        uploads, downloads = [], []
+        for _ in range(repeats):
+            # Fresh content each time so deduplication does not skip the work
+            upload = SimpleUploadedFile('sample.bin', os.urandom(size))
+            started = time.perf_counter()
+            client.post(reverse('upload_file'), {'files': upload})
+            uploads.append(time.perf_counter() - started)
+
+            file_id = File.objects.filter(user=user).latest('id').id
+            started = time.perf_counter()
+            response = client.get(reverse('download_file', args=[file_id]))
+            received = sum(len(chunk) for chunk in response.streaming_content)
+            downloads.append(time.perf_counter() - started)
+            if received != size:
+                raise CommandError(f"Downloaded {received} of {size} bytes")
+        results.append({
+            'size': size,
+            'upload_seconds_p50': median(uploads),
+            'download_seconds_p50': median(downloads),
+            'upload_mb_per_s': round(size / 2 ** 20 / statistics.median(uploads), 1),
+            'download_mb_per_s': round(size / 2 ** 20 / statistics.median(downloads), 1),
+        })
+    return results
+
+
+def bench_file_list(counts, repeats):
+    """file_list render time and query count as the user's file count grows"""
+    user = User.objects.create_user('bench-list')
+    client = Client()
+    client.force_login(user)
+    results = []
+    for count in counts:
+        existing = File.objects.filter(user=user).count()
+        File.objects.bulk_create(
+            File(user=user, file='x', filename=f'file{i}.txt', file_hash='0' * 64) for i in range(existing, count)
+        )
+        timings = []
+        for _ in range(repeats):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                client.get(reverse('file_list'))
+                timings.append(time.perf_counter() - started)
+        results.append({'files': count, 'render_seconds_p50': median(timings), 'queries': len(queries)})
+    return results
+
+
+def bench_link_redemption(links, threads):
+    """Redemption throughput of distinct links, and how many racers win a single link"""
+    user = User.objects.create_user('bench-links')
+    file = File.objects.create(user=user, file='x', filename='x.txt', file_hash='0' * 64)
+    expires_at = timezone.now() + timezone.timedelta(hours=1)
+    ShareableLink.objects.bulk_create(
+        ShareableLink(file=file, token_hash=ShareableLink.hash_token(f'token{i}'), expires_at=expires_at)
+        for i in range(links + 1)
+    )
+
+    def run(targets):
+        barrier = threading.Barrier(threads)
+        wins = []
+
+        def worker(tokens):
+            try:
+                barrier.wait()
+                wins.extend(token for token in tokens if redeem_link(token) is not None)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(targets[i::threads],)) for i in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return wins, time.perf_counter() - started
+
+    wins, elapsed = run([f'token{i}' for i in range(links)])
+    race_wins, _ = run([f'token{links}'] * threads)
+    return {
+        'links': links,
+        'threads': threads,
+        'redeemed': len(wins),
+        'redemptions_per_s': round(len(wins) / elapsed, 1),
+        'racers': threads,
+        'race_winners': len(race_wins),
+    }
+
+
+# Database configurations compared by the db_writes suite, as DB_* environment overrides.
+# The postgres modes use the DB_NAME/DB_HOST/... of the calling environment and need a throwaway database
+DB_MODES = {
+    'sqlite_default': {'DB_ENGINE': 'sqlite', 'DB_SQLITE_TUNING': '0', 'DB_CONN_MAX_AGE': '0'},
+    'sqlite_wal': {'DB_ENGINE': 'sqlite'},
+    'postgres': {'DB_ENGINE': 'postgres'},
+    'postgres_pool': {'DB_ENGINE': 'postgres', 'DB_POOL': '1'},
+}
+
+
+def db_write_child(threads, uploads, size):
+    """
+    Entry point of one db_writes subprocess: concurrent small uploads through the full view,
+    so each one runs the real version lookup, blob attach and File insert transaction
+    """
+    from django.core.management import call_command
+    from django.db import connections
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    setup_test_environment()
+    prefix = uuid.uuid4().hex[:8]
+    clients = []
+    for index in range(threads):
+        client = Client()
+        client.force_login(User.objects.create_user(f'bench-db-{prefix}-{index}'))
+        clients.append(client)
+    connections.close_all()
+
+    barrier = threading.Barrier(threads)
+    latencies, failures = [], []
+
+    def worker(client, index):
+        try:
+            barrier.wait()
+            for upload in range(uploads):
+                # Distinct content so every upload creates a blob rather than deduplicating
+                payload = SimpleUploadedFile(f'file{upload}.bin', os.urandom(size))
+                started = time.perf_counter()
+                results = client.post(
+                    reverse('upload_file'), {'files': payload}, HTTP_ACCEPT='application/json'
+                ).json()['results']
+                latencies.append(time.perf_counter() - started)
+                failures.extend(result['error'] for result in results if not result['success'])
+        finally:
+            connections.close_all()
+
+    with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+        workers = [threading.Thread(target=worker, args=(client, i)) for i, client in enumerate(clients)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(json.dumps({
+        'uploads': len(latencies),
+        'failed': len(failures),
+        'errors': sorted(set(failures))[:3],
+        'uploads_per_s': round((len(latencies) - len(failures)) / elapsed, 1),
+        'latency_p50_s': round(latencies[len(latencies) // 2], 4),
+        'latency_p95_s': round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 4),
+    }))
+
+
+def bench_db_writes(modes, threads, uploads, size):
+    """Write throughput of concurrent uploads under each database mode, one fresh process per mode"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in modes:
+            env = dict(os.environ, **DB_MODES[mode])
+            if env['DB_ENGINE'] == 'sqlite':
+                env['DB_NAME'] = os.path.join(workdir, f'{mode}.sqlite3')
+            child = subprocess.run(
+                [sys.executable, '-c',
+                 'import django; django.setup(); '
+                 'from fileapp.management.commands.benchmark import db_write_child; '
+                 f'db_write_child({threads}, {uploads}, {size})'],
+                env=env, cwd=settings.BASE_DIR, capture_output=True, text=True,
+            )
+            if child.returncode:
+                results[mode] = {'error': child.stderr.strip().splitlines()[-1]}
+            else:
+                results[mode] = json.loads(child.stdout.strip().splitlines()[-1])
+    return {'threads': threads, 'uploads_per_thread': uploads, 'file_size': size, 'modes': results}
+
+
+SUITES = ['crypto', 'batch_upload', 'compression', 'transfers', 'file_list', 'links', 'db_writes']
+
+
+class Command(BaseCommand):
+    help = (
+        "Run offline performance benchmarks against a temp SQLite database and MEDIA_ROOT "
+        "and print the results as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', action='append', choices=SUITES, help="Run only this suite (repeatable)")
+        parser.add_argument('--files', type=int, default=50, help="Files per upload batch")
+        parser.add_argument('--size', type=int, default=1024 * 1024, help="Bytes per file")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Encryption pool size")
+        parser.add_argument('--crypto-sizes', default='1K,1M,64M,1G', help="File sizes for the crypto suite")
+        parser.add_argument('--transfer-sizes', default='1K,1M,16M', help="File sizes for the transfers suite")
+        parser.add_argument('--list-counts', default='10,100,1000', help="User file counts for the file_list suite")
+        parser.add_argument('--links', type=int, default=500, help="Links redeemed by the links suite")
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent redeemers or uploaders")
+        parser.add_argument(
+            '--db-modes', default='sqlite_default,sqlite_wal',
+            help=f"Database modes for the db_writes suite, from {', '.join(DB_MODES)}",
+        )
+        parser.add_argument('--db-uploads', type=int, default=50, help="Uploads per thread in the db_writes suite")
+        parser.add_argument('--repeats', type=int, default=3, help="Timed repetitions per measurement")
+        parser.add_argument('--output', help="Write the JSON report to this file as well")
+
+    def handle(self, *args, **options):
+        suites = options['suite'] or SUITES
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'created_at': timezone.now().isoformat(),
+            },
+        }
+        if 'db_writes' in suites:
+            modes = options['db_modes'].split(',')
+            unknown = set(modes) - set(DB_MODES)
+            if unknown:
+                raise CommandError(f"Unknown database mode(s): {', '.join(sorted(unknown))}")
+
+        # Every other suite stores data keys, so they share one throwaway database
+        if set(suites) - {'db_writes'}:
+            with temp_environment():
+                # The crypto suite forks per size, so it runs before anything grows this process
+                if 'crypto' in suites:
+                    report['crypto'] = bench_crypto(parse_sizes(options['crypto_sizes']))
+                if 'batch_upload' in suites:
+                    report['batch_upload'] = bench_batch_upload(options['files'], options['size'], options['workers'])
+                if 'compression' in suites:
+                    report['compression'] = bench_compression(options['size'] * 8)
+                if 'transfers' in suites:
+                    report['transfers'] = bench_transfers(parse_sizes(options['transfer_sizes']), options['repeats'])
+                if 'file_list' in suites:
+                    counts = [int(count) for count in options['list_counts'].split(',')]
+                    report['file_list'] = bench_file_list(counts, options['repeats'])
+                if 'links' in suites:
+                    report['links'] = bench_link_redemption(options['links'], options['threads'])
+
+        if 'db_writes' in suites:
+            report['db_writes'] = bench_db_writes(modes, options['threads'], options['db_uploads'], 1024)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
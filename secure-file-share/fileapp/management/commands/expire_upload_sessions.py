@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from fileapp.models import UploadSession
+from fileapp.resumable import discard_session
+
+
+class Command(BaseCommand):
+    help = "Delete resumable upload sessions that have expired, along with their staged chunks"
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.filter(expires_at__lt=timezone.now())
+        count = 0
+        for session in expired.iterator():
+            discard_session(session)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Removed {count} expired upload session(s)."))
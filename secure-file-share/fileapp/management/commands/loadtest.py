@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Settings for the throwaway project both servers run against; the database comes from DB_NAME
+SETTINGS_TEMPLATE = """from secure_file_sharing.settings import *
+DEBUG = False
+ALLOWED_HOSTS = ['127.0.0.1', 'testserver']
+MEDIA_ROOT = {media!r}
+"""
+
+# Run through `manage.py shell` against those settings: one user, one file, one logged-in session
+SEED_SCRIPT = """
+import os, json
+from django.contrib.auth.models import User
+from django.test import Client
+from fileapp.models import File
+from fileapp.utils import FileEncryptor
+
+user = User.objects.create_user('loadtest')
+path = os.path.join({media!r}, 'encrypted_files', 'payload.bin')
+os.makedirs(os.path.dirname(path), exist_ok=True)
+with open(path, 'wb') as f:
+    f.write(os.urandom({size}))
+file = File.objects.create(
+    user=user, file='encrypted_files/payload.bin', filename='payload.bin', file_hash=FileEncryptor.encrypt_file(path)
+)
+client = Client()
+client.force_login(user)
+print(json.dumps({{'file_id': file.id, 'session': client.cookies['sessionid'].value}}))
+"""
+
+# Small receive buffers keep the kernel from absorbing the whole response on behalf of a slow reader
+CLIENT_RECEIVE_BUFFER = 16 * 1024
+READ_SIZE = 16 * 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    WSGI server with a fixed number of request threads, standing in for a
+    thread-per-request deployment such as gunicorn with a bounded thread count.
+    """
+    request_queue_size = 1024
+
+    def __init__(self, address, threads):
+        super().__init__(address, QuietHandler)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve_wsgi(port, threads):
+    """Entry point of the WSGI server subprocess"""
+    from django.core.wsgi import get_wsgi_application
+    server = PooledWSGIServer(('127.0.0.1', port), threads)
+    server.set_app(get_wsgi_application())
+    server.serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f"Server exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f"Server did not start listening on port {port}")
+
+
+async def slow_download(port, path, session, rate, timeout):
+    """Download path while reading at most rate bytes per second; returns one result dict"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    result = {'status': None, 'ttfb': None, 'bytes': 0, 'completed': False}
+
+    async def run():
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CLIENT_RECEIVE_BUFFER)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, ('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        try:
+            writer.write(
+                f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: sessionid={session}\r\n"
+                f"Connection: close\r\n\r\n".encode()
+            )
+            headers = await reader.readuntil(b'\r\n\r\n')
+            result['ttfb'] = loop.time() - started
+            result['status'] = int(headers.split()[1])
+            while True:
+                chunk = await reader.read(READ_SIZE)
+                if not chunk:
+                    break
+                result['bytes'] += len(chunk)
+                await asyncio.sleep(len(chunk) / rate)
+            result['completed'] = True
+        finally:
+            writer.close()
+
+    try:
+        await asyncio.wait_for(run(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    except OSError as e:
+        result['error'] = str(e)
+    return result
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * fraction), len(values) - 1)], 3)
+
+
+async def run_clients(port, path, session, clients, rate, timeout):
+    started = time.monotonic()
+    results = await asyncio.gather(*(slow_download(port, path, session, rate, timeout) for _ in range(clients)))
+    elapsed = time.monotonic() - started
+    ttfbs = [r['ttfb'] for r in results if r['ttfb'] is not None]
+    return {
+        'clients': clients,
+        'completed': sum(r['completed'] and r['status'] == 200 for r in results),
+        'timed_out': sum(not r['completed'] and 'error' not in r for r in results),
+        'errors': sum('error' in r for r in results),
+        'streaming_within_1s': sum(t <= 1 for t in ttfbs),
+        'ttfb_p50_s': percentile(ttfbs, 0.5),
+        'ttfb_p95_s': percentile(ttfbs, 0.95),
+        'wall_seconds': round(elapsed, 2),
+        'aggregate_mb_per_s': round(sum(r['bytes'] for r in results) / 2 ** 20 / elapsed, 1),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a throwaway project under a thread-pooled WSGI server and under uvicorn, "
+        "hold many slow concurrent downloads open against each and print the results as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=64, help="Concurrent slow downloads")
+        parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help="Bytes in the downloaded file")
+        parser.add_argument('--rate', type=int, default=512 * 1024, help="Bytes per second each client reads")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds before a download counts as timed out")
+        parser.add_argument('--wsgi-threads', type=int, default=8, help="Request threads of the WSGI server")
+        parser.add_argument('--output', help="Write the JSON report to this file as well")
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError("The ASGI side of the load test needs uvicorn: pip install uvicorn")
+
+        with tempfile.TemporaryDirectory() as workdir:
+            media = os.path.join(workdir, 'media')
+            with open(os.path.join(workdir, 'loadtest_settings.py'), 'w') as f:
+                f.write(SETTINGS_TEMPLATE.format(media=media))
+            env = dict(
+                os.environ,
+                DB_ENGINE='sqlite',
+                DB_NAME=os.path.join(workdir, 'db.sqlite3'),
+                DJANGO_SETTINGS_MODULE='loadtest_settings',
+                PYTHONPATH=os.pathsep.join([workdir, str(settings.BASE_DIR)]),
+            )
+            manage = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py')]
+            subprocess.run(manage + ['migrate', '--run-syncdb', '-v', '0'], env=env, check=True)
+            seeded = subprocess.run(
+                manage + ['shell', '-c', SEED_SCRIPT.format(media=media, size=options['size'])],
+                env=env, check=True, capture_output=True, text=True, cwd=settings.BASE_DIR,
+            )
+            seed = json.loads(seeded.stdout.strip().splitlines()[-1])
+
+            servers = {
+                'wsgi': (
+                    [sys.executable, '-c',
+                     'import django; django.setup(); '
+                     'from fileapp.management.commands.loadtest import serve_wsgi; '
+                     f"serve_wsgi({{port}}, {options['wsgi_threads']})"],
+                    dict(env, ASYNC_TRANSFERS='0'),
+                ),
+                'asgi': (
+                    [sys.executable, '-m', 'uvicorn', 'secure_file_sharing.asgi:application',
+                     '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+                    dict(env, ASYNC_TRANSFERS='1'),
+                ),
+            }
+            report = {'file_size': options['size'], 'client_rate': options['rate'], 'cpu_count': os.cpu_count()}
+            for label, (command, server_env) in servers.items():
+                port = free_port()
+                process = subprocess.Popen(
+                    [part.format(port=port) for part in command], env=server_env, cwd=settings.BASE_DIR
+                )
+                try:
+                    wait_for_port(port, process)
+                    report[label] = asyncio.run(run_clients(
+                        port, f"/download/{seed['file_id']}/", seed['session'],
+                        options['clients'], options['rate'], options['timeout'],
+                    ))
+                finally:
+                    process.terminate()
+                    process.wait()
+            report['wsgi']['threads'] = options['wsgi_threads']
+            report['asgi']['transfer_workers'] = getattr(settings, 'FILE_TRANSFER_WORKERS', 16)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from fileapp.models import Blob, File
+from fileapp.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = "Move File rows that predate the blob store onto shared, refcounted blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows migrated per transaction")
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        migrated = deduplicated = reclaimed = 0
+        while True:
+            with transaction.atomic():
+                # Chunked files keep their content in manifests and never get a blob
+                files = list(
+                    File.objects.filter(blob__isnull=True, chunked=False).exclude(file_hash='')
+                    .order_by('id')[:options['batch_size']]
+                )
+                if not files:
+                    break
+
+                for file in files:
+                    blob = Blob.objects.filter(content_hash=file.file_hash).first()
+                    name = str(file.file)
+                    exists = storage.exists(name)
+                    if blob is None:
+                        blob = Blob.objects.create(
+                            content_hash=file.file_hash,
+                            file=file.file.name,
+                            size=storage.size(name) if exists else 0,
+                            refcount=1,
+                        )
+                    else:
+                        Blob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+                        if file.file.name != blob.file.name and exists:
+                            # Identical content is already stored; drop the duplicate ciphertext
+                            reclaimed += storage.size(name)
+                            transaction.on_commit(lambda name=name: storage.delete(name))
+                            deduplicated += 1
+                        file.file = blob.file.name
+                    file.blob = blob
+                File.objects.bulk_update(files, ['blob', 'file'])
+                migrated += len(files)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {migrated} file(s), removed {deduplicated} duplicate(s), reclaimed {reclaimed} bytes."
+        ))
@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fileapp.chunking import CHUNK_DIR
+from fileapp.janitor import referenced_names
+from fileapp.models import Blob, File
+from fileapp.storage import BLOB_DIR, LocalStorage, get_storage, new_blob_name
+from fileapp.uploadhandlers import UPLOAD_DIR
+
+COPY_SIZE = 1024 * 1024
+
+
+def copy_object(source, source_name, target, target_name):
+    """Stream one object between backends; the target only appears once it is complete"""
+    with source.open_read(source_name) as reader, target.open_write(target_name) as writer:
+        while True:
+            data = reader.read(COPY_SIZE)
+            if not data:
+                break
+            writer.write(data)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move ciphertext from the flat encrypted_files/ directory into the sharded layout of the "
+        "configured storage backend, and with --all also copy local blobs and chunks into it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help="Objects relocated per transaction")
+        parser.add_argument(
+            '--all', action='store_true',
+            help="Also move the sharded blobs and chunks in MEDIA_ROOT that rows refer to, e.g. when switching to an object store",
+        )
+
+    def handle(self, *args, **options):
+        source, target = LocalStorage(), get_storage()
+        legacy = f"{UPLOAD_DIR}/"
+        relocated = missing = 0
+
+        # Blobs first, then rows that predate the blob store; each pass renames objects
+        for model in (Blob, File):
+            last_id = 0
+            while True:
+                rows = list(
+                    model.objects.filter(id__gt=last_id, file__startswith=legacy)
+                    .order_by('id').values_list('id', 'file')[:options['batch_size']]
+                )
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                moves = {}
+                for row_id, name in rows:
+                    if not source.exists(name):
+                        missing += 1
+                        continue
+                    moves[row_id] = (name, new_blob_name())
+                    copy_object(source, name, target, moves[row_id][1])
+
+                with transaction.atomic():
+                    if model is Blob:
+                        # Locking the blobs keeps concurrent uploads from deduplicating onto the old names
+                        list(Blob.objects.select_for_update().filter(id__in=list(moves)))
+                    for row_id, (old, new) in moves.items():
+                        model.objects.filter(id=row_id).update(file=new)
+                        File.objects.filter(file=old).update(file=new)
+                    transaction.on_commit(
+                        lambda moves=list(moves.values()): [source.delete(old) for old, _ in moves]
+                    )
+                relocated += len(moves)
+
+        copied = skipped = 0
+        if options['all'] and not (isinstance(target, LocalStorage) and target.root == source.root):
+            # Names are unchanged, so no rows need updating. Only objects a row refers to move;
+            # in-flight uploads (.partial-*, or not committed yet) and orphans stay for the janitor
+            for directory in (BLOB_DIR, CHUNK_DIR):
+                names = [name for name, _, _ in source.list(directory)]
+                for start in range(0, len(names), options['batch_size']):
+                    batch = names[start:start + options['batch_size']]
+                    used = referenced_names(directory, batch)
+                    for name in batch:
+                        if name not in used:
+                            skipped += 1
+                            continue
+                        copy_object(source, name, target, name)
+                        source.delete(name)
+                        copied += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Relocated {relocated} file(s) into the sharded layout, copied {copied} object(s) to the "
+            f"storage backend; {missing} referenced file(s) were missing, {skipped} unreferenced object(s) "
+            f"were left in place."
+        ))
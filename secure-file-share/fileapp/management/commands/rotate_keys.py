@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from fileapp.keys import get_key_ring
+from fileapp.models import DataKey
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-wrap per-file data keys under the active master key (or --to). Only the small "
+        "DataKey rows change; stored ciphertext is never read or rewritten"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Data keys re-wrapped per transaction")
+        parser.add_argument('--to', help="Master key id to wrap under; defaults to FILE_ACTIVE_MASTER_KEY")
+
+    def handle(self, *args, **options):
+        ring = get_key_ring()
+        target = options['to'] or ring.active_id
+        if target not in ring:
+            raise CommandError(f"Master key {target!r} is not in FILE_MASTER_KEYS.")
+
+        rewrapped = 0
+        unavailable = set()
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                # Locked, so a concurrent rotation cannot re-wrap the same rows from stale values
+                rows = list(
+                    DataKey.objects.select_for_update().filter(id__gt=last_id).exclude(key_id=target)
+                    .order_by('id')[:options['batch_size']]
+                )
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                now = timezone.now()
+                changed = []
+                for row in rows:
+                    if row.key_id not in ring:
+                        unavailable.add(row.key_id)
+                        continue
+                    row.key_id, row.wrapped_key = ring.wrap(ring.unwrap(row.key_id, row.wrapped_key), target)
+                    row.rewrapped_at = now
+                    changed.append(row)
+                DataKey.objects.bulk_update(changed, ['key_id', 'wrapped_key', 'rewrapped_at'])
+            rewrapped += len(changed)
+
+        remaining = dict(
+            DataKey.objects.exclude(key_id=target).values_list('key_id').annotate(count=Count('id'))
+        )
+        self.stdout.write(self.style.SUCCESS(f"Re-wrapped {rewrapped} data key(s) under {target!r}."))
+        if remaining:
+            details = ', '.join(f"{key_id}: {count}" for key_id, count in sorted(remaining.items()))
+            self.stdout.write(self.style.WARNING(
+                f"Data keys still wrapped under other master keys ({details}); keep those keys in the ring."
+            ))
+        if unavailable:
+            self.stdout.write(self.style.WARNING(
+                f"Missing master key(s) {', '.join(sorted(unavailable))}: add them to FILE_MASTER_KEYS and rerun."
+            ))
@@ -0,0 +1,30 @@
+import json
+from django.core.management.base import BaseCommand
+
+from fileapp.janitor import BATCH_SIZE, ORPHAN_GRACE_PERIOD, run_janitor
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired links, shares and upload sessions, unreferenced ciphertext "
+        "and leaked plaintext temp files, then print what was reclaimed as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Rows or files handled per query")
+        parser.add_argument(
+            '--io-rate', type=int, default=None,
+            help="Maximum bytes deleted per second (default JANITOR_IO_RATE; 0 for no limit)",
+        )
+        parser.add_argument(
+            '--grace-period', type=int, default=ORPHAN_GRACE_PERIOD,
+            help="Seconds an unreferenced file must be left untouched before it is removed",
+        )
+
+    def handle(self, *args, **options):
+        stats = run_janitor(
+            io_rate=options['io_rate'],
+            batch_size=options['batch_size'],
+            grace_period=options['grace_period'],
+        )
+        self.stdout.write(json.dumps(dict(stats), sort_keys=True))
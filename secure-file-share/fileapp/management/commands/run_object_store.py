@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from fileapp.objectstore import ObjectStoreServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local S3-compatible object store for development, e.g. with "
+        "FILE_STORAGE_BACKEND = {'driver': 's3', 'endpoint': 'http://127.0.0.1:9000', ...}"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('root', help="Directory holding one subdirectory per bucket")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9000)
+
+    def handle(self, *args, **options):
+        server = ObjectStoreServer((options['host'], options['port']), options['root'])
+        self.stdout.write(f"Serving objects from {options['root']} at {server.endpoint}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
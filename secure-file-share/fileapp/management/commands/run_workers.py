@@ -0,0 +1,73 @@
+import signal
+import threading
+import multiprocessing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from fileapp import jobs
+
+
+def _work(options, results=None):
+    """Run one worker until SIGINT or SIGTERM, letting the job in progress finish first"""
+    stop = threading.Event()
+    previous = {signum: signal.signal(signum, lambda *args: stop.set()) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        processed = jobs.work(
+            stop, once=options['once'], poll_interval=options['poll_interval'],
+            visibility_timeout=options['visibility_timeout'],
+        )
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    if results is not None:
+        results.put(processed)
+    return processed
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background job workers that lease queued jobs from the database and process them "
+        "until interrupted, or with --once until no job is due"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help="Worker processes to run")
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due instead of polling")
+        parser.add_argument(
+            '--poll-interval', type=float, default=None,
+            help="Seconds an idle worker waits between polls (default JOB_POLL_INTERVAL)",
+        )
+        parser.add_argument(
+            '--visibility-timeout', type=int, default=None,
+            help="Seconds a lease hides a job from other workers (default JOB_VISIBILITY_TIMEOUT)",
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError("--processes must be at least 1.")
+        if options['processes'] == 1:
+            processed = _work(options)
+        else:
+            # Each worker opens its own connections; inherited ones would be shared across processes
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            workers = [
+                context.Process(target=_work, args=(options, results), name=f'job-worker-{index}')
+                for index in range(options['processes'])
+            ]
+            for worker in workers:
+                worker.start()
+
+            def forward(signum, frame):
+                for worker in workers:
+                    if worker.is_alive():
+                        worker.terminate()
+            signal.signal(signal.SIGTERM, forward)
+            # Ctrl-C reaches the whole process group already, so the parent only has to wait
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            for worker in workers:
+                worker.join()
+            processed = sum(results.get() for worker in workers if worker.exitcode == 0)
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} job(s)."))
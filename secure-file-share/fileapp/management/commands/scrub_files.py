@@ -0,0 +1,22 @@
+import json
+from django.core.management.base import BaseCommand
+
+from fileapp.scrubber import BATCH_SIZE, run_scrubber
+
+
+class Command(BaseCommand):
+    help = (
+        "Read every stored blob and chunk back, verify it against its integrity manifest or hash, "
+        "flag the files whose content is corrupt and print what was checked as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Blobs or chunks loaded per query")
+        parser.add_argument(
+            '--io-rate', type=int, default=None,
+            help="Maximum bytes read per second (default SCRUB_IO_RATE; 0 for no limit)",
+        )
+
+    def handle(self, *args, **options):
+        stats = run_scrubber(io_rate=options['io_rate'], batch_size=options['batch_size'])
+        self.stdout.write(json.dumps(dict(stats), sort_keys=True))
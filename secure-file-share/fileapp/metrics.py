@@ -0,0 +1,172 @@
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Upper bounds in seconds; the implicit last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}  # phase -> [bucket counts..., +Inf count], sum
+_bytes = {}  # phase -> bytes processed
+# Phase totals of the request being served in this context, for the Server-Timing header
+_request_phases = contextvars.ContextVar('request_phases', default=None)
+
+
+def _load_setting():
+    global _enabled
+    _enabled = bool(getattr(settings, 'FILE_METRICS_ENABLED', False))
+
+
+@receiver(setting_changed)
+def _reload(setting, **kwargs):
+    if setting == 'FILE_METRICS_ENABLED':
+        _load_setting()
+
+
+def enabled():
+    return _enabled
+
+
+def observe(phase, seconds, nbytes=0):
+    """Record one measurement of phase in the histograms and the current request's totals"""
+    with _lock:
+        counts, total = _histograms.get(phase) or ([0] * (len(BUCKETS) + 1), 0.0)
+        counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        _histograms[phase] = (counts, total + seconds)
+        if nbytes:
+            _bytes[phase] = _bytes.get(phase, 0) + nbytes
+    phases = _request_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _bytes.clear()
+
+
+@contextlib.contextmanager
+def _span(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - started)
+
+
+_disabled_span = contextlib.nullcontext()
+
+
+def span(phase):
+    """Context manager timing a single operation; free when metrics are disabled"""
+    return _span(phase) if _enabled else _disabled_span
+
+
+class PhaseTimer:
+    """
+    Accumulates time and bytes per phase across the many small steps of one file
+    operation (e.g. every segment of a download) and records them once in finish().
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.nbytes = {}
+
+    def wrap(self, phase, func, count_result=True):
+        """Return func timed under phase, counting the length of its result (or first argument)"""
+        seconds, nbytes = self.seconds, self.nbytes
+        seconds.setdefault(phase, 0.0)
+        nbytes.setdefault(phase, 0)
+
+        def timed(*args):
+            started = time.perf_counter()
+            result = func(*args)
+            seconds[phase] += time.perf_counter() - started
+            nbytes[phase] += len(result if count_result else args[0])
+            return result
+        return timed
+
+    def finish(self):
+        """Record the phases that ran since the last finish() and start counting afresh"""
+        for phase, seconds in self.seconds.items():
+            if seconds or self.nbytes[phase]:
+                observe(phase, seconds, self.nbytes[phase])
+            # Reset in place: the functions wrap() returned keep adding to these dicts
+            self.seconds[phase] = 0.0
+            self.nbytes[phase] = 0
+
+
+def start_timer():
+    """A PhaseTimer when metrics are enabled, otherwise None so callers keep their plain fast path"""
+    return PhaseTimer() if _enabled else None
+
+
+def _time_query(execute, sql, params, many, context):
+    if not _enabled:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        observe('db', time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def _install_query_timer(connection, **kwargs):
+    # Installed on every connection so queries made on pool threads are timed too
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def begin_request():
+    """Start collecting phase totals for the request in this context; returns a token for end_request()"""
+    phases = {}
+    return phases, _request_phases.set(phases)
+
+
+def end_request(token):
+    _request_phases.reset(token)
+
+
+def server_timing(phases):
+    """Format phase totals as a Server-Timing header value, in milliseconds"""
+    return ', '.join(f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in phases.items())
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _lock:
+        histograms = {phase: (list(counts), total) for phase, (counts, total) in _histograms.items()}
+        processed = dict(_bytes)
+
+    lines = [
+        '# HELP fileapp_phase_seconds Time spent in each phase of request handling and file processing.',
+        '# TYPE fileapp_phase_seconds histogram',
+    ]
+    for phase in sorted(histograms):
+        counts, total = histograms[phase]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'fileapp_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'fileapp_phase_seconds_sum{{phase="{phase}"}} {total}')
+        lines.append(f'fileapp_phase_seconds_count{{phase="{phase}"}} {cumulative}')
+
+    lines += [
+        '# HELP fileapp_phase_bytes_total Bytes processed in each phase.',
+        '# TYPE fileapp_phase_bytes_total counter',
+    ]
+    for phase in sorted(processed):
+        lines.append(f'fileapp_phase_bytes_total{{phase="{phase}"}} {processed[phase]}')
+    return '\n'.join(lines) + '\n'
+
+
+_load_setting()
@@ -1,3 +1,5 @@
+import uuid
+import hashlib
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -17,14 +19,66 @@ class UserRole(models.Model):
         return f"{self.user.username} - {self.role}"
 
 
+# Model representing a per-file data key, stored wrapped by a master key from the key ring
+class DataKey(models.Model):
+    key_id = models.CharField(
+        max_length=64, db_index=True
+    )  # Id of the master key in FILE_MASTER_KEYS that wraps this data key
+    wrapped_key = models.BinaryField()  # AES-GCM nonce followed by the sealed data key
+    created_at = models.DateTimeField(default=timezone.now)
+    rewrapped_at = models.DateTimeField(null=True, blank=True)  # Last master key rotation that touched this row
+
+    def __str__(self):
+        return f"Data key {self.pk} ({self.key_id})"
+
+
+# Model representing one stored ciphertext, shared by every File with the same content
+class Blob(models.Model):
+    content_hash = models.CharField(
+        max_length=64, unique=True
+    )  # SHA-256 of the plaintext; identical uploads resolve to the same blob
+    file = models.FileField(
+        upload_to='blobs/'
+    )  # Name of the encrypted content in the storage backend, sharded as blobs/ab/cd/<id>
+    size = models.BigIntegerField(
+        default=0
+    )  # Size of the ciphertext in bytes
+    refcount = models.PositiveIntegerField(
+        default=0
+    )  # Number of File rows referencing this blob; the blob is removed when it drops to zero
+    created_at = models.DateTimeField(default=timezone.now)
+    integrity_manifest = models.BinaryField(
+        blank=True, default=b''
+    )  # Packed SHA-256 leaves of the header and each sealed segment; empty for blobs stored before manifests
+    merkle_root = models.CharField(
+        max_length=64, blank=True
+    )  # Merkle root over the manifest leaves
+    verified_at = models.DateTimeField(
+        null=True, blank=True, db_index=True
+    )  # Last time the scrubber read the blob back; the least recently verified are scrubbed first
+    corrupted_at = models.DateTimeField(
+        null=True, blank=True
+    )  # Set when the stored ciphertext no longer matches; the next upload of the same content replaces it
+
+    def __str__(self):
+        return f"{self.content_hash} ({self.refcount} refs)"
+
+
 # Model representing a file uploaded by a user
 class File(models.Model):
+    PENDING, PROCESSING, READY, FAILED = 'pending', 'processing', 'ready', 'failed'
+    PROCESSING_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
     user = models.ForeignKey(
         User, on_delete=models.CASCADE
     )  # ForeignKey relationship to the User model; if the user is deleted, their files are also deleted
     file = models.FileField(
-        upload_to='encrypted_files/'
-    )  # FileField to store the uploaded file; files are saved in the 'encrypted_files/' directory
+        upload_to='blobs/'
+    )  # FileField naming the ciphertext in the storage backend; older rows may still point into 'encrypted_files/'
     filename = models.CharField(
         max_length=255
     )  # Stores the name of the file as a string with a max length of 255 characters
@@ -37,11 +91,71 @@ class File(models.Model):
     is_encrypted = models.BooleanField(
         default=True
     )  # Boolean to indicate whether the file is encrypted
+    blob = models.ForeignKey(
+        Blob, related_name='files', null=True, blank=True, on_delete=models.PROTECT
+    )  # Shared ciphertext; file always mirrors blob.file. Null for rows not yet migrated to blobs
+    size = models.BigIntegerField(
+        null=True, blank=True
+    )  # Plaintext size in bytes; compressed content cannot derive it from the ciphertext
+    chunked = models.BooleanField(
+        default=False
+    )  # True when the content is stored as a manifest of deduplicated chunks instead of a blob
+    version = models.PositiveIntegerField(
+        default=1
+    )  # Revision number among the user's uploads with the same filename
+    corrupted_at = models.DateTimeField(
+        null=True, blank=True
+    )  # Set by the scrubber when the stored content fails its integrity check
+    processing_status = models.CharField(
+        max_length=10, choices=PROCESSING_CHOICES, default=READY
+    )  # Progress of the upload's background jobs; only ready files can be downloaded
+    processing_error = models.CharField(
+        max_length=255, blank=True
+    )  # Why processing failed, shown on the file list
+
+    class Meta:
+        indexes = [
+            # Serves the "My Files" page: newest first, keyset-paginated on (upload_date, id)
+            models.Index(fields=['user', '-upload_date', '-id'], name='file_user_upload_date_idx'),
+        ]
 
     def __str__(self):
         
         return self.filename
 
+# Model representing one content-defined chunk, encrypted and stored once under chunks/
+class Chunk(models.Model):
+    chunk_hash = models.CharField(
+        max_length=64, unique=True
+    )  # SHA-256 of the chunk plaintext; also determines where the ciphertext lives
+    size = models.PositiveIntegerField()  # Plaintext size of the chunk in bytes
+    refcount = models.PositiveIntegerField(
+        default=0
+    )  # Number of manifest entries referencing this chunk
+    verified_at = models.DateTimeField(
+        null=True, blank=True, db_index=True
+    )  # Last time the scrubber decrypted the chunk and checked its hash
+
+    def __str__(self):
+        return f"{self.chunk_hash} ({self.refcount} refs)"
+
+
+# Model representing one entry in a chunked file's manifest
+class FileChunk(models.Model):
+    file = models.ForeignKey(
+        File, related_name='manifest', on_delete=models.CASCADE
+    )  # The chunked file this entry belongs to
+    chunk = models.ForeignKey(
+        Chunk, related_name='entries', on_delete=models.PROTECT
+    )  # Stored chunk holding this part of the content
+    index = models.PositiveIntegerField()  # Position of the chunk within the file
+    offset = models.BigIntegerField()  # Plaintext offset of the chunk within the file
+
+    class Meta:
+        ordering = ['index']
+        unique_together = [('file', 'index')]
+
+
 # Model representing the sharing of a file between users
 class FileShare(models.Model):
     file = models.ForeignKey(
@@ -59,7 +173,15 @@ class FileShare(models.Model):
     shared_date = models.DateTimeField(
         default=timezone.now
     )  # Timestamp for when the file was shared, defaults to the current time
-    expiration_date = models.DateTimeField(null=True, blank=True)
+    expiration_date = models.DateTimeField(null=True, blank=True, db_index=True)  # Swept by the janitor once passed
+
+    class Meta:
+        indexes = [
+            # Serves the "Shared With Me" page: newest first, keyset-paginated on (shared_date, id)
+            models.Index(fields=['shared_with', '-shared_date', '-id'], name='share_with_date_idx'),
+            # Serves access checks: the live shares of one file with one user
+            models.Index(fields=['file', 'shared_with'], name='share_file_with_idx'),
+        ]
 
     def is_expired(self):
         return timezone.now() > self.expiration_date
@@ -70,12 +192,82 @@ class FileShare(models.Model):
     
 class ShareableLink(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE)
-    token = models.CharField(max_length=64, unique=True)
+    token_hash = models.CharField(
+        max_length=64, unique=True
+    )  # SHA-256 of the URL token; the token itself is only ever shown to the link's creator
     created_at = models.DateTimeField(auto_now_add=True)
-    expires_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
     is_used = models.BooleanField(default=False)
-    
+    used_at = models.DateTimeField(null=True, blank=True)  # When the one-time link was redeemed
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def has_expired(self):
+        return self.expires_at < timezone.now()
+    def __str__(self):
+        return f"Link for {self.file.filename}"
+
+
+# Model tracking a resumable upload whose chunks arrive over several requests
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    length = models.BigIntegerField()  # Total plaintext size declared by the client
+    offset = models.BigIntegerField(default=0)  # Plaintext bytes received and committed so far
+    staged_size = models.BigIntegerField(
+        default=0
+    )  # Bytes of the staging file covered by offset; anything past it is an interrupted write
+    salt = models.CharField(max_length=32)  # Hex salt for the staging key
+    data_key = models.ForeignKey(
+        DataKey, null=True, blank=True, on_delete=models.PROTECT
+    )  # Data key sealing the staging file and the final ciphertext; empty for sessions that predate data keys
+    file = models.ForeignKey(
+        File, null=True, blank=True, on_delete=models.SET_NULL
+    )  # Pending File created once every byte arrived; a finalize_upload job turns the staging file into its content
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)  # Pushed forward on every chunk; expired sessions are garbage-collected
+
     def has_expired(self):
         return self.expires_at < timezone.now()
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.length})"
+
+
+# Model representing a unit of background work, leased and run by `manage.py run_workers` (see jobs.py)
+class Job(models.Model):
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    kind = models.CharField(max_length=50)  # Name of the registered handler, e.g. 'finalize_upload'
+    payload = models.JSONField(default=dict)  # Keyword arguments for the handler
+    priority = models.SmallIntegerField(default=0)  # Due jobs with a higher priority are leased first
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(
+        default=0
+    )  # Leases taken so far, including ones whose worker died; also the row version leases compare against
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)  # Not leased before this time; pushed back between retries
+    leased_until = models.DateTimeField(
+        null=True, blank=True
+    )  # Visibility timeout of a running job; once it passes, another worker may take the job over
+    lease_owner = models.CharField(max_length=100, blank=True)  # Worker holding the lease, as host:pid:thread
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Serves lease(): due jobs of a status, highest priority first
+            models.Index(fields=['status', '-priority', 'run_after'], name='job_queue_idx'),
+        ]
+
     def __str__(self):
-        return f"Link for {self.file.filename} shared by {self.shared_by.username}"
\ No newline at end of file
+        return f"{self.kind} #{self.pk} ({self.status})"
@@ -0,0 +1,240 @@
+"""
+A minimal S3-compatible object store for local development and tests.
+Implements the path-style subset ObjectStorage uses: PUT, GET (with Range),
+HEAD and DELETE of objects, ListObjectsV2 and multipart uploads. Objects are
+files under a root directory. Requests must carry a SigV4 Authorization header,
+but signatures are not verified; use a real store such as MinIO beyond local testing.
+"""
+import os
+import re
+import uuid
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+COPY_SIZE = 64 * 1024
+LIST_PAGE_SIZE = 1000
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    # Routing
+
+    def _parse(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        query = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def _authorized(self):
+        if not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 '):
+            self._reply(403, b'<Error><Code>AccessDenied</Code></Error>')
+            return False
+        return True
+
+    def do_HEAD(self):
+        bucket, key, _ = self._parse()
+        if not self._authorized():
+            return
+        path = self.server.object_path(bucket, key)
+        if not os.path.isfile(path):
+            self._reply(404, head=True)
+            return
+        self._reply(200, head=True, length=os.path.getsize(path))
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not self._authorized():
+            return
+        if not key:
+            self._list(bucket, query)
+            return
+        path = self.server.object_path(bucket, key)
+        if not os.path.isfile(path):
+            self._reply(404, b'<Error><Code>NoSuchKey</Code></Error>')
+            return
+
+        size = os.path.getsize(path)
+        start, stop = 0, size
+        status = 200
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            stop = min(int(match.group(2)) + 1, size) if match.group(2) else size
+            if start >= size:
+                self._reply(416, b'')
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(stop - start))
+        self.send_header('Content-Type', 'application/octet-stream')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{size}')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining:
+                data = f.read(min(COPY_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        if not self._authorized():
+            return
+        if 'uploadId' in query:
+            path = os.path.join(self.server.upload_dir(query['uploadId']), f"{int(query['partNumber']):05d}")
+        else:
+            path = self.server.object_path(bucket, key)
+        etag = self._receive(path)
+        self._reply(200, headers={'ETag': f'"{etag}"'})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        if not self._authorized():
+            return
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self.server.upload_dir(upload_id))
+            self._reply(200, (
+                f'<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>'
+                f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+            ).encode())
+            return
+
+        # CompleteMultipartUpload: concatenate the parts in order into the object
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        directory = self.server.upload_dir(query['uploadId'])
+        path = self.server.object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as destination:
+            for part in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, part), 'rb') as source:
+                    shutil.copyfileobj(source, destination, COPY_SIZE)
+        os.replace(temp_path, path)
+        shutil.rmtree(directory)
+        self._reply(200, f'<CompleteMultipartUploadResult><Key>{escape(key)}</Key></CompleteMultipartUploadResult>'.encode())
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if not self._authorized():
+            return
+        if 'uploadId' in query:
+            shutil.rmtree(self.server.upload_dir(query['uploadId']), ignore_errors=True)
+        else:
+            path = self.server.object_path(bucket, key)
+            if os.path.isfile(path):
+                os.remove(path)
+        self._reply(204)
+
+    # Helpers
+
+    def _receive(self, path):
+        """Stream the request body into path and return its MD5, like an S3 ETag"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        remaining = int(self.headers.get('Content-Length', 0))
+        digest = hashlib.md5()
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            while remaining:
+                data = self.rfile.read(min(COPY_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+                remaining -= len(data)
+        os.replace(temp_path, path)
+        return digest.hexdigest()
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        keys = sorted(self.server.keys(bucket, prefix))
+        after = query.get('continuation-token', '')
+        keys = [key for key in keys if key > after]
+        page, truncated = keys[:LIST_PAGE_SIZE], len(keys) > LIST_PAGE_SIZE
+
+        entries = []
+        for key in page:
+            stat = os.stat(self.server.object_path(bucket, key))
+            modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            entries.append(
+                f'<Contents><Key>{escape(key)}</Key><LastModified>{modified}</LastModified>'
+                f'<Size>{stat.st_size}</Size></Contents>'
+            )
+        token = f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>' if truncated else ''
+        self._reply(200, (
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f'<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>'
+            f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>{token}{"".join(entries)}'
+            '</ListBucketResult>'
+        ).encode())
+
+    def _reply(self, status, body=b'', head=False, length=None, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length if length is not None else len(body)))
+        self.send_header('Date', formatdate(usegmt=True))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+
+class ObjectStoreServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root):
+        super().__init__(address, ObjectStoreHandler)
+        self.root = root
+
+    def handle_error(self, request, client_address):
+        # Clients drop streamed downloads on seek or close; that is not an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def object_path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(os.path.normpath(self.root), bucket)):
+            raise ValueError("Key escapes the bucket")
+        return path
+
+    def upload_dir(self, upload_id):
+        if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+            raise ValueError("Invalid upload id")
+        return os.path.join(self.root, '.uploads', upload_id)
+
+    def keys(self, bucket, prefix):
+        base = os.path.join(self.root, bucket)
+        for directory, _, names in os.walk(base):
+            for name in names:
+                key = os.path.relpath(os.path.join(directory, name), base).replace(os.sep, '/')
+                if key.startswith(prefix) and not name.startswith('tmp'):
+                    yield key
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_object_store(root, host='127.0.0.1', port=0):
+    """Serve an object store from root on a background thread; returns the server"""
+    server = ObjectStoreServer((host, port), root)
+    threading.Thread(target=server.serve_forever, name='objectstore', daemon=True).start()
+    return server
@@ -0,0 +1,39 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque cursor pointing just past the row with this (timestamp, pk)"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, pk) for a cursor, or None if it is missing or malformed"""
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (AttributeError, ValueError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(queryset, date_field, cursor, page_size):
+    """
+    Return (rows, next_cursor) for a newest-first page of queryset.
+    Rows are ordered on (date_field, id) and the cursor seeks past the previous
+    page, so each page costs one indexed range scan regardless of depth.
+    """
+    queryset = queryset.order_by(f'-{date_field}', '-id')
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        timestamp, pk = position
+        queryset = queryset.filter(
+            Q(**{f'{date_field}__lt': timestamp}) | Q(**{date_field: timestamp, 'id__lt': pk})
+        )
+
+    rows = list(queryset[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, date_field), last.pk)
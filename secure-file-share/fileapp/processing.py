@@ -0,0 +1,174 @@
+"""
+Post-upload processing. Uploads are encrypted and hashed while their bytes arrive, so plaintext
+never rests on disk. Everything after that runs as background jobs (see jobs.py), which move the
+File's processing_status from pending to ready, or to failed with a reason. Uploads with nothing
+left to do are ready as soon as they are saved.
+"""
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from . import jobs
+from .blobs import attach_blobs
+from .chunking import attach_chunks
+from .janitor import RateLimiter
+from .models import Chunk, File, UploadSession
+from .resumable import discard_session, finalize_session
+from .scrubber import check_blob, check_chunk
+
+# A finished resumable upload has no content until it is finalized, so that runs ahead of checks
+FINALIZE_PRIORITY = 10
+PROCESS_PRIORITY = 0
+
+
+def new_file(user, uploaded_file):
+    """Build the unsaved File row for an upload produced by one of our upload handlers"""
+    chunked = hasattr(uploaded_file, 'manifest')
+    return File(
+        user=user,
+        filename=uploaded_file.name,
+        file='' if chunked else uploaded_file.storage_name,
+        file_hash=uploaded_file.file_hash,
+        size=uploaded_file.size,
+        chunked=chunked,
+        processing_status=File.PENDING,
+    )
+
+
+def _assign_versions(user, files):
+    """Make each upload of an existing filename its next version; must run inside transaction.atomic()"""
+    names = {file.filename for file in files}
+    latest = dict(
+        File.objects.filter(user=user, filename__in=names)
+        .values_list('filename').annotate(Max('version'))
+    )
+    for file in files:
+        file.version = latest.get(file.filename, 0) + 1
+        latest[file.filename] = file.version
+
+
+def save_uploads(user, pending):
+    """
+    Persist a batch of uploads in one transaction. Blob uploads share ciphertext for content
+    already stored; chunked uploads get manifests. Ciphertext this request wrote needs no
+    read-back, so only uploads that landed on stored content nobody has verified yet stay
+    pending with a process_upload job; the rest are ready at once. With JOB_RUN_INLINE that
+    read-back would run inside the request, so every upload is ready and the scrubber, which
+    reads unverified content first, checks the stored content instead.
+    Returns the created File rows and the jobs to pass to jobs.dispatch() once committed.
+    """
+    written = {uploaded.storage_name for uploaded, file in pending if not file.chunked}
+    with transaction.atomic():
+        _assign_versions(user, [file for _, file in pending])
+        attach_blobs([(uploaded, file) for uploaded, file in pending if not file.chunked])
+        created = File.objects.bulk_create([file for _, file in pending])
+        new_chunks = attach_chunks([(file, uploaded.manifest) for uploaded, file in pending if file.chunked])
+
+        deferred = not getattr(settings, 'JOB_RUN_INLINE', True)
+        reused = {
+            chunk_hash for uploaded, file in pending if deferred and file.chunked for chunk_hash, _ in uploaded.manifest
+        }
+        unverified = set(
+            Chunk.objects.filter(chunk_hash__in=reused - new_chunks, verified_at__isnull=True)
+            .values_list('chunk_hash', flat=True)
+        ) if reused else set()
+        ready, unchecked = [], []
+        for uploaded, file in pending:
+            if file.chunked:
+                check = any(chunk_hash in unverified for chunk_hash, _ in uploaded.manifest)
+            else:
+                check = file.blob.file.name not in written and file.blob.verified_at is None
+            (unchecked if deferred and check else ready).append(file)
+
+        File.objects.filter(pk__in=[file.pk for file in ready]).update(processing_status=File.READY)
+        for file in ready:
+            file.processing_status = File.READY
+        queued = jobs.enqueue('process_upload', [{'file_id': file.id} for file in unchecked], PROCESS_PRIORITY)
+    return created, queued
+
+
+def complete_session(session):
+    """
+    Create the pending File for a resumable upload whose bytes have all arrived, and queue
+    the job that re-encrypts the staging file into it. Returns the File and the job.
+    """
+    with transaction.atomic():
+        file = File(
+            user=session.user, filename=session.filename, file='', file_hash='',
+            size=session.length, processing_status=File.PENDING,
+        )
+        _assign_versions(session.user, [file])
+        file.save()
+        UploadSession.objects.filter(pk=session.pk).update(file=file)
+        job, = jobs.enqueue(
+            'finalize_upload', [{'session_id': str(session.id), 'file_id': file.id}], FINALIZE_PRIORITY
+        )
+    return file, job
+
+
+def _mark_failed(error, file_id, **payload):
+    File.objects.filter(pk=file_id).update(processing_status=File.FAILED, processing_error=error[:255])
+
+
+def _finalize_failed(error, session_id, file_id):
+    _mark_failed(error, file_id)
+    session = UploadSession.objects.filter(pk=session_id).first()
+    if session is not None:
+        discard_session(session)
+
+
+@jobs.handler('finalize_upload', on_failure=_finalize_failed)
+def finalize_upload(session_id, file_id):
+    """Re-encrypt a completed resumable upload into the stored format and attach it to its File"""
+    session = UploadSession.objects.filter(pk=session_id).first()
+    if session is None:
+        # An earlier attempt finished and removed the session
+        if File.objects.filter(pk=file_id, processing_status__in=[File.PENDING, File.PROCESSING]).exists():
+            raise Exception("The upload session is gone.")
+        return
+
+    File.objects.filter(pk=file_id).update(processing_status=File.PROCESSING)
+    uploaded = finalize_session(session)
+    try:
+        with transaction.atomic():
+            # Locked, so the File cannot be deleted between attaching the blob and saving
+            file = File.objects.select_for_update().filter(pk=file_id).first()
+            if file is not None:
+                file.file, file.file_hash = uploaded.storage_name, uploaded.file_hash
+                attach_blobs([(uploaded, file)])
+                # The bytes were just written by this job, so they need no read-back check
+                file.processing_status = File.READY
+                file.save(update_fields=['file', 'file_hash', 'blob', 'processing_status'])
+    except Exception:
+        uploaded.discard()
+        raise
+    if file is None:
+        uploaded.discard()
+    discard_session(session)
+
+
+@jobs.handler('process_upload', on_failure=_mark_failed)
+def process_upload(file_id):
+    """
+    Read back the stored content an upload was deduplicated onto and authenticate it, then
+    mark the File ready. Content verified in the meantime is not read again.
+    """
+    file = File.objects.select_related('blob').filter(pk=file_id).first()
+    if file is None or file.processing_status == File.READY:
+        return
+    File.objects.filter(pk=file_id).update(processing_status=File.PROCESSING)
+
+    limiter, stats = RateLimiter(0), Counter()
+    if file.chunked:
+        chunks = Chunk.objects.filter(entries__file_id=file_id, verified_at__isnull=True).distinct()
+        intact = all([check_chunk(chunk, limiter, stats) for chunk in chunks])
+    elif file.blob is not None and file.blob.verified_at is None:
+        intact = check_blob(file.blob, limiter, stats)
+    else:
+        intact = True
+
+    if intact:
+        File.objects.filter(pk=file_id).update(processing_status=File.READY, processing_error='')
+    else:
+        _mark_failed("The stored content failed verification.", file_id)
@@ -0,0 +1,92 @@
+import bisect
+import hashlib
+from django.utils.functional import cached_property
+
+from .chunking import chunk_name
+from .storage import stored_file
+from .utils import SEGMENT_SIZE, FileEncryptor, verify_chunks
+
+# Memory a streamed decrypt holds at once: the ciphertext segment, its plaintext and what the
+# response is still sending; legacy Fernet content holds the token, its decoding and the plaintext
+STREAM_WORKING_SET = 4 * SEGMENT_SIZE
+LEGACY_WORKING_SET_FACTOR = 3
+
+
+class BlobReader:
+    """Reads a File whose content is a single ciphertext in the storage backend"""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.source = stored_file(str(file_obj.file))
+
+    def exists(self):
+        return self.source.exists()
+
+    @cached_property
+    def size(self):
+        """Plaintext size, or None when neither the ciphertext nor the File row records it"""
+        size = FileEncryptor.plaintext_size(self.source)
+        return size if size is not None else self.file_obj.size
+
+    def memory_cost(self):
+        """Bytes held in memory while the content is decrypted, for admission control"""
+        if FileEncryptor.is_segmented(self.source):
+            return min(self.size if self.size is not None else STREAM_WORKING_SET, STREAM_WORKING_SET)
+        return LEGACY_WORKING_SET_FACTOR * self.source.size()
+
+    def iter_verified(self):
+        return FileEncryptor.iter_verified(self.source, self.file_obj.file_hash)
+
+    def iter_range(self, start, stop):
+        # Blobs uploaded with a manifest have every segment of the range checked against it
+        manifest = self.file_obj.blob.integrity_manifest if self.file_obj.blob_id else None
+        return FileEncryptor.iter_decrypt_range(self.source, start, stop, manifest)
+
+
+class ManifestReader:
+    """Reads a chunked File by streaming its manifest of encrypted chunks in order"""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.entries = list(file_obj.manifest.select_related('chunk'))
+        self.offsets = [entry.offset for entry in self.entries]
+
+    def exists(self):
+        return all(stored_file(chunk_name(entry.chunk.chunk_hash)).exists() for entry in self.entries)
+
+    @cached_property
+    def size(self):
+        if not self.entries:
+            return 0
+        return self.entries[-1].offset + self.entries[-1].chunk.size
+
+    def memory_cost(self):
+        # Chunks are small and decrypted one segment at a time
+        return min(self.size, STREAM_WORKING_SET)
+
+    def iter_verified(self):
+        hasher = hashlib.sha256()
+        return verify_chunks(self._iter_plaintext(hasher), hasher, self.file_obj.file_hash)
+
+    def _iter_plaintext(self, hasher):
+        for entry in self.entries:
+            yield from FileEncryptor.iter_decrypt(stored_file(chunk_name(entry.chunk.chunk_hash)), hasher)
+
+    def iter_range(self, start, stop):
+        # Locate the first chunk covering start, then decrypt only the segments needed
+        index = max(bisect.bisect_right(self.offsets, start) - 1, 0)
+        for entry in self.entries[index:]:
+            if entry.offset >= stop:
+                break
+            local_start = max(start - entry.offset, 0)
+            local_stop = min(stop - entry.offset, entry.chunk.size)
+            yield from FileEncryptor.iter_decrypt_range(
+                stored_file(chunk_name(entry.chunk.chunk_hash)), local_start, local_stop
+            )
+
+
+def open_reader(file_obj):
+    """Return the reader matching how the File's content is stored"""
+    if file_obj.chunked:
+        return ManifestReader(file_obj)
+    return BlobReader(file_obj)
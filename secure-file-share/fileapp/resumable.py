@@ -0,0 +1,176 @@
+import os
+import struct
+import contextlib
+from concurrent.futures import Future
+from datetime import timedelta
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.utils import timezone
+
+from . import keys
+from .models import UploadSession
+from .uploadhandlers import EncryptedUploadedFile, create_ciphertext_file
+from .utils import FileEncryptor, SEGMENT_SIZE, derive_segment_key
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the database offset check alone
+    fcntl = None
+
+SESSION_DIR = 'uploads'
+
+# Staged chunks are sealed as independent records: length (4 bytes) | nonce (12 bytes) | ciphertext.
+# Random nonces keep a retried chunk from reusing a nonce with different data, and the
+# record's plaintext offset is bound as associated data so records cannot be reordered.
+RECORD_HEADER = struct.Struct(">I12s")
+
+
+class UploadConflict(Exception):
+    """The client's Upload-Offset does not match what the server has committed"""
+
+
+def session_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, 'UPLOAD_SESSION_EXPIRY', 24 * 60 * 60))
+
+
+def staging_path(session):
+    return os.path.join(settings.MEDIA_ROOT, SESSION_DIR, f"{session.id}.part")
+
+
+def create_session(user, filename, length):
+    """Start a resumable upload and create its empty staging file"""
+    session = UploadSession.objects.create(
+        user=user,
+        filename=filename,
+        length=length,
+        salt=os.urandom(16).hex(),
+        data_key_id=keys.new_data_key().id,
+        expires_at=session_expiry(),
+    )
+    os.makedirs(os.path.dirname(staging_path(session)), exist_ok=True)
+    open(staging_path(session), 'wb').close()
+    return session
+
+
+def discard_session(session):
+    """Delete a session and its staged ciphertext"""
+    path = staging_path(session)
+    session.delete()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _staging_cipher(session):
+    salt = bytes.fromhex(session.salt)
+    if session.data_key_id is None:
+        return AESGCM(derive_segment_key(FileEncryptor.get_key(), salt))
+    return keys.segment_cipher(session.data_key_id, salt)
+
+
+def _associated_data(session, offset):
+    return session.id.bytes + offset.to_bytes(8, 'big')
+
+
+@contextlib.contextmanager
+def _locked_staging(session):
+    """Open the staging file with an exclusive lock so concurrent PATCHes cannot interleave"""
+    with open(staging_path(session), 'r+b') as staging:
+        if fcntl is not None:
+            fcntl.flock(staging.fileno(), fcntl.LOCK_EX)
+        yield staging
+
+
+def append_chunk(session, offset, stream):
+    """
+    Encrypt a chunk read from stream onto the session's staging file.
+    Only offset committed in the database counts; bytes from an interrupted
+    earlier write are truncated first. Returns the refreshed session.
+    """
+    with _locked_staging(session) as staging:
+        session.refresh_from_db()
+        if offset != session.offset:
+            raise UploadConflict(f"Expected offset {session.offset}, got {offset}")
+
+        staging.truncate(session.staged_size)
+        staging.seek(session.staged_size)
+        cipher = _staging_cipher(session)
+        position = offset
+        while True:
+            piece = stream.read(SEGMENT_SIZE)
+            if not piece:
+                break
+            if position + len(piece) > session.length:
+                raise ValueError("Chunk exceeds the declared upload length")
+            nonce = os.urandom(12)
+            sealed = cipher.encrypt(nonce, piece, _associated_data(session, position))
+            staging.write(RECORD_HEADER.pack(len(sealed), nonce) + sealed)
+            position += len(piece)
+        staging.flush()
+        os.fsync(staging.fileno())
+
+        UploadSession.objects.filter(pk=session.pk, offset=offset).update(
+            offset=position, staged_size=staging.tell(), expires_at=session_expiry()
+        )
+    session.refresh_from_db()
+    return session
+
+
+class StagedReader:
+    """File-like reader that decrypts a complete staging file record by record"""
+
+    def __init__(self, session):
+        self.session = session
+        self._cipher = _staging_cipher(session)
+        self._file = open(staging_path(session), 'rb')
+        self._position = 0
+        self._buffer = b''
+
+    def _next_record(self):
+        if self._file.tell() >= self.session.staged_size:
+            return b''
+        length, nonce = RECORD_HEADER.unpack(self._file.read(RECORD_HEADER.size))
+        piece = self._cipher.decrypt(
+            nonce, self._file.read(length), _associated_data(self.session, self._position)
+        )
+        self._position += len(piece)
+        return piece
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            piece = self._next_record()
+            if not piece:
+                break
+            self._buffer += piece
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def finalize_session(session):
+    """
+    Re-encrypt the staged chunks into the regular stored format in one streaming pass.
+    Returns an EncryptedUploadedFile ready to be saved like a normal upload.
+    """
+    destination, name = create_ciphertext_file()
+    leaves = []
+    # The final ciphertext reuses the session's data key, so finishing an upload adds no key row
+    data_key = keys.load_data_key(session.data_key_id) if session.data_key_id is not None else None
+    with StagedReader(session) as source, destination:
+        file_hash = FileEncryptor.encrypt_stream(
+            source, destination, filename=session.filename, leaves=leaves, data_key=data_key
+        )
+
+    future = Future()
+    future.set_result((file_hash, b''.join(leaves)))
+    return EncryptedUploadedFile(
+        name, session.filename, 'application/octet-stream',
+        session.length, None, future,
+    )
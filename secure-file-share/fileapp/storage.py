@@ -0,0 +1,407 @@
+import os
+import hmac
+import uuid
+import hashlib
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+BLOB_DIR = 'blobs'
+
+
+def sharded_name(prefix, key):
+    """Object name under prefix fanned out by the first hex digits of key, e.g. blobs/ab/cd/abcd..."""
+    return f"{prefix}/{key[:2]}/{key[2:4]}/{key}"
+
+
+def new_blob_name():
+    """A fresh, uniformly sharded name for ciphertext whose content hash is not known yet"""
+    return sharded_name(BLOB_DIR, uuid.uuid4().hex)
+
+
+class StoredFile:
+    """Handle on one stored object; FileEncryptor reads these as well as plain paths"""
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def open_read(self):
+        return self.storage.open_read(self.name)
+
+    def size(self):
+        return self.storage.size(self.name)
+
+    def exists(self):
+        return self.storage.exists(self.name)
+
+
+class LocalWriter:
+    """
+    Writes to a temp file next to the target and renames it into place on close,
+    so readers never see a partial object. abort() discards it instead.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=directory, prefix='.partial-')
+        self._file = os.fdopen(fd, 'wb')
+        self.path = path
+        self.closed = False
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+            os.replace(self._temp_path, self.path)
+
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+            os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class LocalStorage:
+    """Objects stored as files under a root directory (MEDIA_ROOT by default)"""
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return str(self._root or settings.MEDIA_ROOT)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def open_read(self, name):
+        return open(self.path(name), 'rb')
+
+    def open_write(self, name):
+        return LocalWriter(self.path(name))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def delete(self, name):
+        """Remove an object; returns False if it was already gone"""
+        try:
+            os.remove(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self, prefix):
+        """Yield (name, size, modified timestamp) for every object under prefix"""
+        for root, _, names in os.walk(self.path(prefix)):
+            for filename in names:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), stat.st_size, stat.st_mtime
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class ObjectStorage:
+    """
+    Driver for an S3-compatible object store, signed with AWS Signature V4 and using
+    path-style URLs, so it works against MinIO or the local stand-in in objectstore.py.
+    Reads stream a single GET and writes stream through multipart upload, so no object
+    is ever held in memory whole.
+    """
+
+    # S3 rejects multipart parts below 5 MiB except the last
+    PART_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1'):
+        parts = urlsplit(endpoint)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+
+    def _sign(self, method, path, query, headers):
+        now = datetime.now(dt_timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = amz_date[:8]
+        headers.update({'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': 'UNSIGNED-PAYLOAD'})
+
+        signed = sorted(headers)
+        canonical = '\n'.join([
+            method,
+            path,
+            '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted(query.items())),
+            ''.join(f"{name}:{str(headers[name]).strip()}\n" for name in signed),
+            ';'.join(signed),
+            'UNSIGNED-PAYLOAD',
+        ])
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()
+        ])
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(signed)}, Signature={signature}"
+        )
+        return headers
+
+    def _request(self, method, name='', query=None, body=None, headers=None, expect=(200,)):
+        """Send one signed request; returns the open response, whose body the caller must read"""
+        query = query or {}
+        path = '/' + quote(f"{self.bucket}/{name}" if name else self.bucket, safe='/-_.~')
+        headers = self._sign(method, path, query, dict(headers or {}))
+        if body is not None:
+            headers['content-length'] = str(len(body))
+        # Connections are not pooled, so let the server release each one with its response
+        headers['connection'] = 'close'
+        url = path
+        if query:
+            url += '?' + '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in query.items())
+
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        connection = connection_class(self.host, timeout=60)
+        connection.request(method, url, body=body, headers=headers)
+        response = connection.getresponse()
+        if response.status not in expect:
+            detail = response.read()[:200]
+            connection.close()
+            raise ObjectStoreError(f"{method} {name or self.bucket} failed: {response.status} {detail!r}")
+        return response
+
+    def open_read(self, name):
+        return ObjectReader(self, name)
+
+    def open_write(self, name):
+        return MultipartWriter(self, name)
+
+    def exists(self, name):
+        return self._request('HEAD', name, expect=(200, 404)).status == 200
+
+    def size(self, name):
+        response = self._request('HEAD', name)
+        return int(response.getheader('Content-Length'))
+
+    def delete(self, name):
+        existed = self.exists(name)
+        self._request('DELETE', name, expect=(204, 200)).read()
+        return existed
+
+    def list(self, prefix):
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix.rstrip('/') + '/'}
+            if token:
+                query['continuation-token'] = token
+            root = ElementTree.fromstring(self._request('GET', query=query).read())
+            for item in root.iterfind('{*}Contents'):
+                modified = datetime.strptime(
+                    item.findtext('{*}LastModified')[:19], '%Y-%m-%dT%H:%M:%S'
+                ).replace(tzinfo=dt_timezone.utc)
+                yield item.findtext('{*}Key'), int(item.findtext('{*}Size')), modified.timestamp()
+            if root.findtext('{*}IsTruncated') != 'true':
+                return
+            token = root.findtext('{*}NextContinuationToken')
+
+
+class ObjectReader:
+    """
+    Seekable reader over one object. Sequential reads stream from a single ranged GET;
+    a seek drops it and the next read starts a new GET from the new position.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self._position = 0
+        self._response = None
+
+    def _open(self):
+        self._response = self.storage._request(
+            'GET', self.name, headers={'range': f'bytes={self._position}-'}, expect=(200, 206, 416)
+        )
+        if self._response.status == 416:
+            self._response.read()
+
+    def read(self, size=-1):
+        if self._response is None:
+            self._open()
+        if self._response.status == 416:
+            return b''
+        data = self._response.read() if size is None or size < 0 else self._response.read(size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.storage.size(self.name)
+        if offset != self._position:
+            self._drop()
+            self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def _drop(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def close(self):
+        self._drop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MultipartWriter:
+    """
+    Streams an object into the store in PART_SIZE parts. Small objects become a single
+    PUT; the object only appears once close() completes the upload.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self.closed = False
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.storage.PART_SIZE:
+            self._upload_part(bytes(self._buffer[:self.storage.PART_SIZE]))
+            del self._buffer[:self.storage.PART_SIZE]
+        return len(data)
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            root = ElementTree.fromstring(self.storage._request('POST', self.name, query={'uploads': ''}).read())
+            self._upload_id = root.findtext('{*}UploadId')
+        number = len(self._parts) + 1
+        response = self.storage._request(
+            'PUT', self.name, query={'partNumber': number, 'uploadId': self._upload_id}, body=data
+        )
+        response.read()
+        self._parts.append((number, response.getheader('ETag')))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is None:
+            self.storage._request('PUT', self.name, body=bytes(self._buffer)).read()
+            return
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+        body = '<CompleteMultipartUpload>' + ''.join(
+            f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>' for number, etag in self._parts
+        ) + '</CompleteMultipartUpload>'
+        self.storage._request('POST', self.name, query={'uploadId': self._upload_id}, body=body.encode()).read()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is not None:
+            self.storage._request('DELETE', self.name, query={'uploadId': self._upload_id}, expect=(204, 200)).read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def build_storage(config):
+    """Create a backend from a FILE_STORAGE_BACKEND style dict"""
+    config = dict(config or {})
+    driver = config.pop('driver', 'local')
+    if driver == 'local':
+        return LocalStorage(config.get('root'))
+    if driver == 's3':
+        return ObjectStorage(**config)
+    raise ValueError(f"Unknown storage driver: {driver}")
+
+
+def get_storage():
+    """The configured backend for ciphertext, built once per process from FILE_STORAGE_BACKEND"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = build_storage(getattr(settings, 'FILE_STORAGE_BACKEND', None))
+        return _storage
+
+
+@receiver(setting_changed)
+def _reset_storage(setting, **kwargs):
+    global _storage
+    if setting in ('FILE_STORAGE_BACKEND', 'MEDIA_ROOT'):
+        with _storage_lock:
+            _storage = None
+
+
+def stored_file(name):
+    return StoredFile(get_storage(), name)
+
+
+def delete_many(names, storage=None):
+    """
+    Remove many objects at once, FILE_DELETE_WORKERS at a time; returns how many existed.
+    Deletes are latency-bound (an unlink or a DELETE request each), so they overlap well.
+    """
+    storage = storage or get_storage()
+    names = list(names)
+    workers = min(getattr(settings, 'FILE_DELETE_WORKERS', 8), len(names))
+    if workers <= 1:
+        return sum(storage.delete(name) for name in names)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='delete') as pool:
+        return sum(pool.map(storage.delete, names))
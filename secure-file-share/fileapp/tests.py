@@ -1,3 +1,1274 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import base64
+import hashlib
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from cryptography.fernet import Fernet
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIRequest
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import OperationalError, close_old_connections, connection
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from secure_file_sharing.database import database_config
+
+from . import admission, async_views, jobs, keys, metrics, views
+from .access import DELETE, DOWNLOAD, VIEW, _retry_locked, allowed_actions, annotate_access, redeem_link
+from .admission import AdmissionController, Saturated
+from .asgi import EncryptedBodyASGIHandler
+from .bulk import new_link
+from .janitor import run_janitor
+from .scrubber import run_scrubber
+from .chunking import Chunker, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, chunk_name
+from .models import Blob, Chunk, DataKey, File, FileShare, Job, ShareableLink, UploadSession
+from .objectstore import start_object_store
+from .readers import open_reader
+from .storage import get_storage
+from .uploadhandlers import EncryptingUploadHandler, reset_encryption_executor
+from .utils import (
+    DECRYPT_TEMP_PREFIX, FileEncryptor, SEGMENT_SIZE, HEADER_SIZE, TAG_SIZE, CODEC_NONE, CODEC_ZLIB, choose_codec, parse_range_header, read_header,
+    parse_header, merkle_root, unpack_leaves,
+)
+
+
+class FileEncryptorTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, data, name='sample.txt'):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_round_trip_across_segment_boundaries(self):
+        for size in (0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 3 * SEGMENT_SIZE):
+            data = os.urandom(size)
+            path = self.write(data)
+            file_hash = FileEncryptor.encrypt_file(path)
+            self.assertEqual(file_hash, hashlib.sha256(data).hexdigest())
+            self.assertTrue(FileEncryptor.is_segmented(path))
+            self.assertEqual(b''.join(FileEncryptor.iter_decrypt(path)), data)
+
+    def test_legacy_fernet_files_stay_readable(self):
+        data = b'legacy payload'
+        path = self.write(Fernet(FileEncryptor.get_key()).encrypt(data))
+        self.assertFalse(FileEncryptor.is_segmented(path))
+        hasher = hashlib.sha256()
+        self.assertEqual(b''.join(FileEncryptor.iter_decrypt(path, hasher)), data)
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(data).hexdigest())
+
+    def test_range_decrypts_only_requested_bytes(self):
+        data = os.urandom(3 * SEGMENT_SIZE + 7)
+        path = self.write(data)
+        FileEncryptor.encrypt_file(path)
+        for start, stop in ((0, 1), (SEGMENT_SIZE - 3, SEGMENT_SIZE + 3), (len(data) - 5, len(data))):
+            chunk = b''.join(FileEncryptor.iter_decrypt_range(path, start, stop))
+            self.assertEqual(chunk, data[start:stop])
+
+    def test_compressible_files_are_compressed(self):
+        data = b'quarterly report line item\n' * 50000
+        path = self.write(data, 'report.txt')
+        FileEncryptor.encrypt_file(path)
+        with open(path, 'rb') as f:
+            self.assertEqual(parse_header(read_header(f))[2], CODEC_ZLIB)
+        self.assertLess(os.path.getsize(path), len(data) // 10)
+        self.assertIsNone(FileEncryptor.plaintext_size(path))
+        self.assertEqual(b''.join(FileEncryptor.iter_decrypt(path)), data)
+        self.assertEqual(b''.join(FileEncryptor.iter_decrypt_range(path, 70000, 70100)), data[70000:70100])
+
+    def test_choose_codec(self):
+        text = b'plain text compresses well ' * 100
+        self.assertEqual(choose_codec('notes.txt', text), CODEC_ZLIB)
+        self.assertEqual(choose_codec('photo.jpg', text), CODEC_NONE)
+        self.assertEqual(choose_codec('notes.txt', os.urandom(4096)), CODEC_NONE)
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 10)])
+        self.assertEqual(parse_range_header('bytes=90-,-5', 100), [(90, 100), (95, 100)])
+        self.assertEqual(parse_range_header('bytes=0-999', 100), [(0, 100)])
+        self.assertEqual(parse_range_header('bytes=200-300', 100), [])
+        self.assertIsNone(parse_range_header('bytes=9-1', 100))
+        self.assertIsNone(parse_range_header('items=0-1', 100))
+
+    def test_truncation_and_tampering_are_detected(self):
+        path = self.write(os.urandom(2 * SEGMENT_SIZE + 10))
+        FileEncryptor.encrypt_file(path)
+        with open(path, 'rb') as f:
+            ciphertext = f.read()
+
+        truncated = self.write(ciphertext[:HEADER_SIZE + SEGMENT_SIZE + 16], 'truncated.txt')
+        with self.assertRaises(Exception):
+            b''.join(FileEncryptor.iter_decrypt(truncated))
+
+        flipped = bytearray(ciphertext)
+        flipped[HEADER_SIZE + 5] ^= 1
+        tampered = self.write(bytes(flipped), 'tampered.txt')
+        with self.assertRaises(Exception):
+            b''.join(FileEncryptor.iter_decrypt(tampered))
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_limits_bypass_and_fifo_queueing(self):
+        controller = AdmissionController(budget=100, max_jobs=2, bypass_size=10, queue_timeout=0.05)
+        self.assertEqual(controller.admit(5, lambda: self.fail("bypassed jobs are not costed")).cost, 0)
+
+        first = controller.admit(1000, 60)
+        with self.assertRaises(Saturated):
+            controller.admit(1000, 60)  # over budget
+        second = controller.admit(1000, 40)
+        with self.assertRaises(Saturated) as raised:
+            controller.admit(1000, 1)  # over the job limit
+        self.assertEqual(raised.exception.retry_after, 5)
+
+        # A queued job starts as soon as a running one finishes
+        admitted = []
+        controller.queue_timeout = 5
+        waiter = threading.Thread(target=lambda: admitted.append(controller.admit(1000, 90)))
+        waiter.start()
+        while not controller.snapshot()['queued']:
+            pass
+        first.release()
+        second.release()
+        second.release()
+        waiter.join()
+        self.assertEqual(controller.snapshot()['reserved_bytes'], 90)
+        admitted[0].release()
+        self.assertEqual(controller.snapshot(), {
+            'queued': 0, 'running': 0, 'reserved_bytes': 0, 'admitted': 3, 'bypassed': 1, 'rejected': 2,
+        })
+
+        # A job larger than the whole budget still runs, alone
+        controller.queue_timeout = 0.05
+        with controller.admit(1000, 500):
+            with self.assertRaises(Saturated):
+                controller.admit(1000, 1)
+
+        # A ticket that gave back its slot only holds its bytes
+        streaming = controller.admit(1000, 60)
+        streaming.release_slot()
+        with controller.admit(1000, 40), controller.admit(1000, 0):
+            with self.assertRaises(Saturated):
+                controller.admit(1000, 1)  # over budget
+        streaming.release()
+        self.assertEqual(controller.snapshot()['reserved_bytes'], 0)
+
+
+class DatabaseConfigTests(SimpleTestCase):
+    def test_environment_selects_and_tunes_the_database(self):
+        config = database_config('/srv', {})
+        self.assertEqual(config['NAME'], os.path.join('/srv', 'db.sqlite3'))
+        self.assertIn('journal_mode=WAL', config['OPTIONS']['init_command'])
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertEqual(database_config('/srv', {'DB_SQLITE_TUNING': '0'})['OPTIONS'], {})
+
+        config = database_config('/srv', {'DB_ENGINE': 'postgres', 'DB_HOST': 'db', 'DB_CONN_MAX_AGE': '300'})
+        self.assertEqual(config['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual((config['HOST'], config['CONN_MAX_AGE'], config['CONN_HEALTH_CHECKS']), ('db', 300, True))
+        with self.assertRaises(ValueError):
+            database_config('/srv', {'DB_ENGINE': 'oracle'})
+
+
+class EncryptedFileTestCase(TestCase):
+    """Runs against a throwaway MEDIA_ROOT and logs in as the file owner"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=self.media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.owner = User.objects.create_user('owner', password='pass12345')
+        self.client.force_login(self.owner)
+
+    def create_file(self, data, filename='report.txt', user=None):
+        name = os.path.join('encrypted_files', filename)
+        path = os.path.join(self.media.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        file_hash = FileEncryptor.encrypt_file(path)
+        return File.objects.create(
+            user=user or self.owner, file=name, filename=filename, file_hash=file_hash
+        )
+
+
+class DownloadTests(EncryptedFileTestCase):
+    def test_download_streams_plaintext(self):
+        data = os.urandom(2 * SEGMENT_SIZE + 123)
+        file_obj = self.create_file(data)
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], str(len(data)))
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_integrity_failure_redirects_before_streaming(self):
+        file_obj = self.create_file(b'small file')
+        file_obj.file_hash = '0' * 64
+        file_obj.save()
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+    def test_single_and_multi_range_requests(self):
+        data = os.urandom(2 * SEGMENT_SIZE + 500)
+        file_obj = self.create_file(data)
+        url = reverse('download_file', args=[file_obj.id])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={SEGMENT_SIZE}-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes {SEGMENT_SIZE}-{len(data) - 1}/{len(data)}')
+        self.assertEqual(b''.join(response.streaming_content), data[SEGMENT_SIZE:])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9,-10')
+        self.assertEqual(response.status_code, 206)
+        body = b''.join(response.streaming_content)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        self.assertIn(data[:10], body)
+        self.assertIn(data[-10:], body)
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(data)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_stale_if_range_serves_full_file(self):
+        data = b'x' * 100
+        file_obj = self.create_file(data)
+        response = self.client.get(
+            reverse('download_file', args=[file_obj.id]),
+            HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+
+@override_settings(FILE_CRYPTO_MAX_JOBS=1, FILE_CRYPTO_QUEUE_TIMEOUT=0, FILE_CRYPTO_BYPASS_SIZE=1000)
+class AdmissionTests(EncryptedFileTestCase):
+    def test_saturated_server_answers_503_but_small_files_pass(self):
+        data = os.urandom(5000)
+        large = self.create_file(data, 'large.bin')
+        small = self.create_file(b'small', 'small.txt')
+        link, token = new_link(large)
+        link.save()
+
+        with admission.admit(None, 1):
+            response = self.client.get(reverse('download_file', args=[large.id]))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '5')
+            self.assertEqual(self.client.get(reverse('download_file', args=[small.id])).status_code, 200)
+            self.assertEqual(self.client.get(reverse('access_shared_file', args=[token])).status_code, 503)
+            upload = self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('u.bin', os.urandom(5000))]})
+            self.assertEqual(upload.status_code, 503)
+
+        # The reservation is returned once the stream is consumed, and the link survived the 503
+        response = self.client.get(reverse('access_shared_file', args=[token]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.assertEqual(admission.get_controller().snapshot()['running'], 0)
+
+    @override_settings(FILE_CRYPTO_BYPASS_SIZE=0)
+    def test_closing_a_stream_early_returns_its_reservation(self):
+        file_obj = self.create_file(os.urandom(3 * SEGMENT_SIZE), 'big.bin')
+        link, token = new_link(file_obj)
+        link.save()
+        request = RequestFactory().get('/')
+        request.user = self.owner
+        for view, arg in ((views.download_file, file_obj.id), (views.access_shared_file, token)):
+            response = view(request, arg)
+            next(iter(response.streaming_content))
+            # A stream keeps its memory but not its job slot, so other transfers are still admitted
+            state = admission.get_controller().snapshot()
+            self.assertEqual(state['running'], 0)
+            self.assertGreater(state['reserved_bytes'], 0)
+            other = self.client.get(reverse('download_file', args=[file_obj.id]))
+            self.assertEqual(other.status_code, 200)
+            b''.join(other.streaming_content)
+            # What the server does when the client disconnects; keep request_finished
+            # from closing the connection the test runs in
+            request_finished.disconnect(close_old_connections)
+            try:
+                response.close()
+            finally:
+                request_finished.connect(close_old_connections)
+            self.assertEqual(admission.get_controller().snapshot()['reserved_bytes'], 0)
+
+class ConditionalGetTests(EncryptedFileTestCase):
+    def test_revalidation_is_answered_without_touching_ciphertext(self):
+        file_obj = self.create_file(b'cached content')
+        url = reverse('download_file', args=[file_obj.id])
+        response = self.client.get(url)
+        self.assertEqual(response['ETag'], f'"{file_obj.file_hash}"')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        last_modified = response['Last-Modified']
+
+        # With the ciphertext gone, only an answer that never opens it can succeed
+        os.remove(os.path.join(self.media.name, file_obj.file.name))
+        for headers in ({'HTTP_IF_NONE_MATCH': response['ETag']}, {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            not_modified = self.client.get(url, **headers)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified['ETag'], response['ETag'])
+            self.assertEqual(not_modified['Last-Modified'], last_modified)
+
+        stale = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertRedirects(stale, reverse('file_list'), fetch_redirect_response=False)
+
+    @override_settings(FILE_DOWNLOAD_CACHE_CONTROL='private, max-age=600')
+    def test_cache_policy_and_date_if_range(self):
+        data = os.urandom(100)
+        file_obj = self.create_file(data)
+        url = reverse('download_file', args=[file_obj.id])
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=600')
+
+        partial = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=response['Last-Modified'])
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(b''.join(partial.streaming_content), data[:10])
+
+
+class AccessControlTests(EncryptedFileTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.reader = User.objects.create_user('reader', password='pass12345')
+        self.file = self.create_file(b'shared text')
+
+    def request_as(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def share(self, permission='download', expiration_date=None):
+        return FileShare.objects.create(
+            file=self.file, shared_by=self.owner, shared_with=self.reader,
+            permission=permission, expiration_date=expiration_date,
+        )
+
+    def test_permission_and_expiry_are_enforced(self):
+        self.share(permission='view')
+        self.assertEqual(allowed_actions(self.request_as(self.reader), self.file), {VIEW})
+        cache.clear()
+
+        FileShare.objects.update(permission='download', expiration_date=timezone.now() - timedelta(minutes=1))
+        self.assertFalse(allowed_actions(self.request_as(self.reader), self.file))
+
+        self.client.force_login(self.reader)
+        response = self.client.get(reverse('download_file', args=[self.file.id]))
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+    def test_answers_are_memoized_and_invalidated_by_sharing(self):
+        self.share(permission='view')
+        request = self.request_as(self.reader)
+        with self.assertNumQueries(1):
+            self.assertEqual(allowed_actions(request, self.file), {VIEW})
+            self.assertEqual(allowed_actions(request, self.file), {VIEW})
+        # A fresh request is served from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(allowed_actions(self.request_as(self.reader), self.file), {VIEW})
+
+        FileShare.objects.all().delete()
+        response = self.client.post(reverse('share_file', args=[self.file.id]), {'username': 'reader'})
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+        self.assertIn(DOWNLOAD, allowed_actions(self.request_as(self.reader), self.file))
+
+    def test_refusals_are_not_cached(self):
+        self.assertFalse(allowed_actions(self.request_as(self.reader), self.file))
+        # Shared from another process, whose invalidation never reaches this cache
+        self.share()
+        self.assertIn(DOWNLOAD, allowed_actions(self.request_as(self.reader), self.file))
+
+    def test_batch_annotation_uses_one_query(self):
+        self.share()
+        others = [self.create_file(b'x', f'other{i}.txt') for i in range(3)]
+        mine = self.create_file(b'y', 'mine.txt', user=self.reader)
+        with self.assertNumQueries(1):
+            annotate_access(self.request_as(self.reader), [self.file, mine] + others)
+        self.assertIn(DOWNLOAD, self.file.actions)
+        self.assertIn(DELETE, mine.actions)
+        self.assertFalse(others[0].actions)
+
+
+class ShareableLinkTests(EncryptedFileTestCase):
+    def test_link_streams_once_and_stores_only_a_hash(self):
+        data = os.urandom(SEGMENT_SIZE + 10)
+        file_obj = self.create_file(data)
+        link = self.client.get(reverse('generate_share_link', args=[file_obj.id])).json()['link']
+        token = link.rstrip('/').rsplit('/', 1)[1]
+        self.assertFalse(ShareableLink.objects.filter(token_hash=token).exists())
+
+        self.client.logout()
+        response = self.client.get(link)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.assertEqual(self.client.get(link).status_code, 403)
+
+    def test_refused_links_stay_usable(self):
+        data = b'kept for later'
+        file_obj = self.create_file(data)
+        link, token = new_link(file_obj)
+        link.save()
+        url = reverse('access_shared_file', args=[token])
+        path = os.path.join(self.media.name, file_obj.file.name)
+        os.rename(path, path + '.moved')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        os.rename(path + '.moved', path)
+
+        File.objects.filter(pk=file_obj.pk).update(corrupted_at=timezone.now())
+        self.assertContains(self.client.get(url), 'failed an integrity check', status_code=409)
+        File.objects.filter(pk=file_obj.pk).update(corrupted_at=None)
+
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), data)
+
+    def test_only_the_owner_can_create_links(self):
+        file_obj = self.create_file(b'private', user=User.objects.create_user('other'))
+        response = self.client.get(reverse('generate_share_link', args=[file_obj.id]))
+        self.assertEqual(response.status_code, 403)
+
+
+class BulkOperationTests(EncryptedFileTestCase):
+    def upload(self, count, duplicates=0):
+        files = [SimpleUploadedFile(f'bulk{i}.bin', os.urandom(2000)) for i in range(count)]
+        files += [SimpleUploadedFile(f'copy{i}.bin', b'same content') for i in range(duplicates)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_file'), {'files': files})
+        return list(File.objects.filter(user=self.owner).order_by('id').values_list('id', flat=True))
+
+    def post(self, name, **payload):
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse(name), payload, content_type='application/json')
+        return response, len(queries)
+
+    def test_bulk_delete_reports_each_file_and_scales_by_set(self):
+        other = self.create_file(b'not mine', user=User.objects.create_user('other'))
+        few = self.upload(2, duplicates=2)
+        _, few_queries = self.post('bulk_delete_files', file_ids=few + [other.id])
+
+        ids = self.upload(6, duplicates=2)
+        response, many_queries = self.post('bulk_delete_files', file_ids=ids + [other.id, 999999])
+        self.assertEqual(many_queries, few_queries)
+        results = {result['id']: result for result in response.json()['results']}
+        self.assertTrue(all(results[file_id]['success'] for file_id in ids))
+        self.assertEqual(results[other.id]['error'], "File not found.")
+        self.assertFalse(results[999999]['success'])
+
+        self.assertFalse(File.objects.filter(user=self.owner).exists())
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(list(get_storage().list('blobs')), [])
+        self.assertTrue(File.objects.filter(id=other.id).exists())
+
+    def test_bulk_share_and_links(self):
+        ids = self.upload(3)
+        recipient = User.objects.create_user('recipient')
+        FileShare.objects.create(file_id=ids[0], shared_by=self.owner, shared_with=recipient)
+
+        response, _ = self.post('bulk_share_files', file_ids=ids, username='recipient')
+        results = response.json()['results']
+        self.assertEqual([result['success'] for result in results], [False, True, True])
+        self.assertTrue(results[0]['already_shared'])
+        self.assertEqual(FileShare.objects.filter(shared_with=recipient).count(), 3)
+        response, _ = self.post('bulk_share_files', file_ids=ids, username='nobody')
+        self.assertEqual(response.status_code, 400)
+
+        response, _ = self.post('bulk_generate_links', file_ids=ids)
+        links = [result['link'] for result in response.json()['results']]
+        self.assertEqual(ShareableLink.objects.count(), 3)
+        self.client.logout()
+        self.assertEqual(self.client.get(links[2]).status_code, 200)
+        self.assertEqual(self.client.get(links[2]).status_code, 403)
+
+    def test_malformed_requests_are_rejected(self):
+        for payload in ({}, {'file_ids': []}, {'file_ids': ['x']}, {'file_ids': list(range(501))}):
+            response, _ = self.post('bulk_delete_files', **payload)
+            self.assertEqual(response.status_code, 400)
+
+
+class ExportTests(EncryptedFileTestCase):
+    def test_zip_streams_decrypted_entries(self):
+        payloads = {'a.bin': os.urandom(3 * SEGMENT_SIZE + 5), 'notes.txt': b'line\n' * 40000}
+        for name, data in payloads.items():
+            self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile(name, data)]})
+        self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('a.bin', b'second version')]})
+        ids = list(File.objects.order_by('id').values_list('id', flat=True))
+
+        response = self.client.get(reverse('export_files'), {'file_ids': ids})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        chunks = list(response.streaming_content)
+        # Entries are written a segment at a time, never buffered whole
+        self.assertLess(max(len(chunk) for chunk in chunks), 2 * SEGMENT_SIZE)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['a.bin', 'notes.txt', 'a (2).bin'])
+            self.assertEqual(archive.read('a.bin'), payloads['a.bin'])
+            self.assertEqual(archive.read('notes.txt'), payloads['notes.txt'])
+            self.assertEqual(archive.read('a (2).bin'), b'second version')
+
+    def test_inaccessible_files_refuse_the_whole_export(self):
+        mine = self.create_file(b'mine')
+        theirs = self.create_file(b'theirs', 'theirs.txt', user=User.objects.create_user('other'))
+        response = self.client.get(reverse('export_files'), {'file_ids': [mine.id, theirs.id]})
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+
+class ConcurrentRedemptionTests(TransactionTestCase):
+    def test_one_time_link_is_redeemed_exactly_once(self):
+        owner = User.objects.create_user('owner')
+        file_obj = File.objects.create(user=owner, file='x', filename='x.txt', file_hash='0' * 64)
+        ShareableLink.objects.create(
+            file=file_obj, token_hash=ShareableLink.hash_token('token'),
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+        threads = 16
+        barrier = threading.Barrier(threads)
+        results, errors = [], []
+
+        def redeem():
+            try:
+                barrier.wait()
+                results.append(redeem_link('token'))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=redeem) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), threads)
+        self.assertEqual([file.pk for file in results if file is not None], [file_obj.pk])
+
+    def test_only_sqlite_lock_errors_are_retried(self):
+        calls = []
+
+        def query(message):
+            calls.append(message)
+            if len(calls) == 1:
+                raise OperationalError(message)
+            return 'done'
+
+        self.assertEqual(_retry_locked(lambda: query('database table is locked: fileapp_file')), 'done')
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            _retry_locked(lambda: query('no such table: fileapp_file'))
+        self.assertEqual(len(calls), 1)
+
+
+class JanitorTests(EncryptedFileTestCase):
+    def age(self, path, seconds=2 * 60 * 60):
+        past = timezone.now().timestamp() - seconds
+        os.utime(path, (past, past))
+        return path
+
+    def test_sweeps_expired_rows_and_unreferenced_files(self):
+        kept = self.create_file(b'still referenced')
+        self.age(os.path.join(self.media.name, kept.file.name))
+        past = timezone.now() - timedelta(days=1)
+        ShareableLink.objects.create(file=kept, token_hash='a' * 64, expires_at=past)
+        live = ShareableLink.objects.create(file=kept, token_hash='b' * 64, expires_at=timezone.now() + timedelta(days=1))
+        reader = User.objects.create_user('reader')
+        FileShare.objects.create(file=kept, shared_by=self.owner, shared_with=reader, expiration_date=past)
+        FileShare.objects.create(file=kept, shared_by=self.owner, shared_with=reader)
+
+        orphan = os.path.join(self.media.name, 'encrypted_files', 'orphan.bin')
+        with open(orphan, 'wb') as f:
+            f.write(b'x' * 100)
+        self.age(orphan)
+        orphan_chunk = os.path.join(self.media.name, chunk_name('f' * 64))
+        os.makedirs(os.path.dirname(orphan_chunk))
+        with open(orphan_chunk, 'wb') as f:
+            f.write(b'y' * 50)
+        self.age(orphan_chunk)
+        fresh = os.path.join(self.media.name, 'encrypted_files', 'in_flight.bin')
+        open(fresh, 'wb').close()
+        fd, leaked = tempfile.mkstemp(prefix=DECRYPT_TEMP_PREFIX)
+        os.close(fd)
+        self.age(leaked)
+
+        stats = run_janitor(io_rate=0)
+        self.assertEqual((stats['links'], stats['shares']), (1, 1))
+        self.assertEqual((stats['orphan_files'], stats['orphan_bytes'], stats['temp_files']), (2, 150, 1))
+        self.assertEqual(list(ShareableLink.objects.all()), [live])
+        self.assertEqual(FileShare.objects.count(), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.media.name, kept.file.name)))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertFalse(os.path.exists(orphan) or os.path.exists(orphan_chunk) or os.path.exists(leaked))
+        self.assertFalse(Chunk.objects.exists())
+
+
+class AsyncTransferTests(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=self.media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.owner = User.objects.create_user('owner')
+
+    @async_to_sync
+    async def consume(self, response):
+        return b''.join([chunk async for chunk in response])
+
+    def test_download_streams_through_an_async_iterator(self):
+        data = os.urandom(3 * SEGMENT_SIZE + 7)
+        path = os.path.join(self.media.name, 'encrypted_files', 'big.bin')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        file_obj = File.objects.create(
+            user=self.owner, file='encrypted_files/big.bin', filename='big.bin',
+            file_hash=FileEncryptor.encrypt_file(path),
+        )
+
+        request = AsyncRequestFactory().get(f'/download/{file_obj.id}/')
+        request.user = self.owner
+        response = async_to_sync(async_views.download_file)(request, file_obj.id)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(data)))
+        self.assertEqual(self.consume(response), data)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_asgi_upload_bodies_are_spooled_encrypted(self):
+        data = b'plaintext that must not reach the disk\n' * 2000
+        body = encode_multipart(BOUNDARY, {'files': SimpleUploadedFile('notes.txt', data)})
+        messages = [
+            {'type': 'http.request', 'body': body[i:i + 65536], 'more_body': i + 65536 < len(body)}
+            for i in range(0, len(body), 65536)
+        ]
+
+        async def receive():
+            return messages.pop(0)
+
+        stream = async_to_sync(EncryptedBodyASGIHandler().read_body)(receive)
+        spool = stream.raw.file
+        self.assertTrue(spool._rolled)
+        spool.seek(0)
+        self.assertNotIn(b'plaintext that must not', spool.read())
+
+        request = ASGIRequest({
+            'type': 'http', 'method': 'POST', 'path': '/upload/', 'query_string': b'',
+            'headers': [
+                (b'content-type', MULTIPART_CONTENT.encode()), (b'content-length', str(len(body)).encode()),
+                (b'accept', b'application/json'),
+            ],
+        }, stream)
+        request.user = self.owner
+        request._dont_enforce_csrf_checks = True
+        response = async_to_sync(async_views.upload_file)(request)
+        self.assertTrue(json.loads(response.content)['results'][0]['success'])
+        file_obj = File.objects.get(filename='notes.txt')
+        self.assertEqual(b''.join(open_reader(file_obj).iter_verified()), data)
+
+
+class MetricsTests(EncryptedFileTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_disabled_by_default(self):
+        file_obj = self.create_file(b'quiet')
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(FILE_METRICS_ENABLED=True, FILE_METRICS_SERVER_TIMING=True)
+    def test_download_phases_are_exported(self):
+        data = os.urandom(2 * SEGMENT_SIZE)
+        file_obj = self.create_file(data)
+        metrics.reset()
+        # Cold cache, so the download has to load and unwrap the file's data key
+        keys.clear_cache()
+
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('fileapp_phase_seconds_count{phase="decrypt"} 1', body)
+        self.assertIn(f'fileapp_phase_bytes_total{{phase="decrypt"}} {len(data)}', body)
+        self.assertIn(f'fileapp_phase_bytes_total{{phase="stream"}} {len(data)}', body)
+        self.assertIn('fileapp_phase_seconds_bucket{phase="key_load",le="+Inf"}', body)
+
+    @override_settings(FILE_METRICS_ENABLED=True)
+    def test_reused_timer_records_each_operation_once(self):
+        timer = metrics.start_timer()
+        read = timer.wrap('read', lambda size: b'x' * size)
+        read(100)
+        timer.finish()
+        read(30)
+        timer.finish()
+        timer.finish()
+
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('fileapp_phase_seconds_count{phase="read"} 2', body)
+        self.assertIn('fileapp_phase_bytes_total{phase="read"} 130', body)
+
+
+class KeyRotationTests(EncryptedFileTestCase):
+    def test_data_keys_are_unwrapped_once(self):
+        data_key = keys.new_data_key()
+        with self.assertNumQueries(0):
+            self.assertEqual(keys.load_data_key(data_key.id), data_key)
+        keys.clear_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(keys.load_data_key(data_key.id), data_key)
+            self.assertEqual(keys.load_data_key(data_key.id), data_key)
+
+    def test_rotation_rewraps_keys_without_touching_ciphertext(self):
+        old, new = FileEncryptor.get_key().decode(), Fernet.generate_key().decode()
+        data = os.urandom(SEGMENT_SIZE + 10)
+        with override_settings(FILE_MASTER_KEYS={'old': old}):
+            file_obj = self.create_file(data)
+        path = os.path.join(self.media.name, file_obj.file.name)
+        with open(path, 'rb') as f:
+            ciphertext = f.read()
+
+        with override_settings(FILE_MASTER_KEYS={'old': old, 'new': new}, FILE_ACTIVE_MASTER_KEY='new'):
+            call_command('rotate_keys', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(list(DataKey.objects.values_list('key_id', flat=True)), ['new'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), ciphertext)
+
+        # The retired master key is gone, yet the file still decrypts
+        with override_settings(FILE_MASTER_KEYS={'new': new}):
+            response = self.client.get(reverse('download_file', args=[file_obj.id]))
+            self.assertEqual(b''.join(response.streaming_content), data)
+
+
+class UploadTests(EncryptedFileTestCase):
+    def test_upload_writes_only_ciphertext(self):
+        data = os.urandom(SEGMENT_SIZE * 2 + 17)
+        response = self.client.post(reverse('upload_file'), {
+            'files': [SimpleUploadedFile('notes.txt', data), SimpleUploadedFile('b.txt', b'')],
+        })
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+        file_obj = File.objects.get(filename='notes.txt')
+        self.assertEqual(file_obj.file_hash, hashlib.sha256(data).hexdigest())
+        self.assertTrue(File.objects.filter(filename='b.txt').exists())
+        # Ciphertext the request wrote itself is ready without a read-back job
+        self.assertEqual(file_obj.processing_status, File.READY)
+        self.assertIsNone(file_obj.blob.verified_at)
+        self.assertFalse(Job.objects.exists())
+
+        stored = [name for name, _, _ in get_storage().list('blobs')]
+        self.assertEqual(len(stored), 2)
+        self.assertRegex(file_obj.file.name, r'^blobs/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{28}$')
+        path = os.path.join(self.media.name, str(file_obj.file))
+        self.assertTrue(FileEncryptor.is_segmented(path))
+        self.assertEqual(b''.join(FileEncryptor.iter_decrypt(path)), data)
+
+        # So is a copy of it: with jobs run inline the read-back is left to the scrubber
+        self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('copy.txt', data)]})
+        self.assertEqual(File.objects.get(filename='copy.txt').processing_status, File.READY)
+        self.assertFalse(Job.objects.exists())
+
+    def test_compressed_upload_serves_ranges(self):
+        data = b'0123456789abcdef' * 20000
+        self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('log.txt', data)]})
+        file_obj = File.objects.get(filename='log.txt')
+        self.assertEqual(file_obj.size, len(data))
+        self.assertLess(os.path.getsize(os.path.join(self.media.name, str(file_obj.file))), len(data) // 10)
+
+        response = self.client.get(reverse('download_file', args=[file_obj.id]), HTTP_RANGE='bytes=100000-100009')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), data[100000:100010])
+
+    @override_settings(FILE_ENCRYPTION_WORKERS=0)
+    def test_inline_encryption_and_json_report(self):
+        reset_encryption_executor()
+        self.addCleanup(reset_encryption_executor)
+        files = [SimpleUploadedFile(f'file{i}.txt', os.urandom(1000 * i)) for i in range(5)]
+        response = self.client.post(reverse('upload_file'), {'files': files}, HTTP_ACCEPT='application/json')
+        results = response.json()['results']
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual(File.objects.filter(user=self.owner).count(), 5)
+
+    @override_settings(FILE_ENCRYPTION_WORKERS=1)
+    def test_slow_upload_does_not_hold_an_encryption_worker(self):
+        reset_encryption_executor()
+        self.addCleanup(reset_encryption_executor)
+        slow, fast = EncryptingUploadHandler(), EncryptingUploadHandler()
+        slow.new_file('files', 'slow.bin', 'application/octet-stream', None)
+        slow.receive_data_chunk(b'first part', 0)
+
+        # The slow client has not sent the rest, yet the only worker is free for another upload
+        data = os.urandom(3 * SEGMENT_SIZE)
+        fast.new_file('files', 'fast.bin', 'application/octet-stream', None)
+        for start in range(0, len(data), 65536):
+            fast.receive_data_chunk(data[start:start + 65536], start)
+        uploaded = fast.file_complete(len(data))
+        self.assertEqual(uploaded.file_hash, hashlib.sha256(data).hexdigest())
+        path = os.path.join(self.media.name, uploaded.storage_name)
+        self.assertEqual(b''.join(FileEncryptor.iter_decrypt(path)), data)
+
+        slow.upload_interrupted()
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, slow.storage_name)))
+
+
+class BlobStoreTests(EncryptedFileTestCase):
+    def test_identical_uploads_share_one_blob(self):
+        data = os.urandom(5000)
+        for name in ('a.pdf', 'b.pdf'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile(name, data)]})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_file'), {
+                'files': [SimpleUploadedFile('c.pdf', data), SimpleUploadedFile('d.pdf', data)],
+            })
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 4)
+        self.assertEqual(len(list(get_storage().list('blobs'))), 1)
+        self.assertEqual(set(File.objects.values_list('file', flat=True)), {blob.file.name})
+
+        blob_path = os.path.join(self.media.name, blob.file.name)
+        files = list(File.objects.order_by('id'))
+        for file_obj in files[:-1]:
+            self.client.post(reverse('delete_file', args=[file_obj.id]))
+        self.assertTrue(os.path.exists(blob_path))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('delete_file', args=[files[-1].id]))
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_migrate_blobs_deduplicates_existing_rows(self):
+        data = b'same content'
+        first = self.create_file(data, 'one.txt')
+        second = self.create_file(data, 'two.txt')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('migrate_blobs', stdout=io.StringIO())
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.blob.refcount, 2)
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, 'encrypted_files', 'two.txt')))
+
+    def test_migrate_blobs_leaves_chunked_files_alone(self):
+        data = os.urandom(100 * 1024)
+        with override_settings(FILE_STORAGE_MODE='chunked'), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('chunked.bin', data)]})
+        chunked = File.objects.get(chunked=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('migrate_blobs', stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+
+        # A later blob upload of the same content must store its own ciphertext
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('plain.bin', data)]})
+        plain = File.objects.get(filename='plain.bin')
+        self.assertTrue(get_storage().exists(plain.blob.file.name))
+        for file_obj in (chunked, plain):
+            response = self.client.get(reverse('download_file', args=[file_obj.id]))
+            self.assertEqual(b''.join(response.streaming_content), data)
+
+
+class ObjectStorageTests(EncryptedFileTestCase):
+    def setUp(self):
+        super().setUp()
+        store_root = tempfile.TemporaryDirectory()
+        self.addCleanup(store_root.cleanup)
+        self.store_root = store_root.name
+        server = start_object_store(self.store_root)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        backend = override_settings(FILE_STORAGE_BACKEND={
+            'driver': 's3', 'endpoint': server.endpoint, 'bucket': 'files', 'access_key': 'test', 'secret_key': 'test',
+        })
+        backend.enable()
+        self.addCleanup(backend.disable)
+        # Small parts so multi-segment files go through multipart upload
+        get_storage().PART_SIZE = SEGMENT_SIZE
+
+    def test_uploads_stream_through_the_object_store(self):
+        data = os.urandom(3 * SEGMENT_SIZE + 99)
+        self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile('big.bin', data)]})
+        file_obj = File.objects.get()
+        self.assertTrue(os.path.exists(os.path.join(self.store_root, 'files', file_obj.file.name)))
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, 'blobs')))
+
+        url = reverse('download_file', args=[file_obj.id])
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), data)
+        response = self.client.get(url, HTTP_RANGE=f'bytes={SEGMENT_SIZE - 5}-{2 * SEGMENT_SIZE + 5}')
+        self.assertEqual(b''.join(response.streaming_content), data[SEGMENT_SIZE - 5:2 * SEGMENT_SIZE + 6])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('delete_file', args=[file_obj.id]))
+        self.assertEqual(list(get_storage().list('blobs')), [])
+
+    def test_relocate_moves_legacy_files_into_the_sharded_store(self):
+        data = os.urandom(SEGMENT_SIZE + 1)
+        file_obj = self.create_file(data, 'legacy.bin')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('relocate_files', stdout=io.StringIO())
+
+        file_obj.refresh_from_db()
+        self.assertTrue(file_obj.file.name.startswith('blobs/'))
+        self.assertTrue(get_storage().exists(file_obj.file.name))
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, 'encrypted_files', 'legacy.bin')))
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_relocate_all_only_moves_referenced_objects(self):
+        local = {}
+        for name in ('blobs/ab/cd/kept', 'blobs/ab/cd/.partial-upload', 'blobs/ab/cd/orphan'):
+            local[name] = os.path.join(self.media.name, name)
+            os.makedirs(os.path.dirname(local[name]), exist_ok=True)
+            with open(local[name], 'wb') as f:
+                f.write(b'ciphertext')
+        Blob.objects.create(content_hash='a' * 64, file='blobs/ab/cd/kept', refcount=1)
+        call_command('relocate_files', all=True, stdout=io.StringIO())
+
+        self.assertTrue(get_storage().exists('blobs/ab/cd/kept'))
+        self.assertFalse(os.path.exists(local['blobs/ab/cd/kept']))
+        for name in ('blobs/ab/cd/.partial-upload', 'blobs/ab/cd/orphan'):
+            self.assertTrue(os.path.exists(local[name]))
+            self.assertFalse(get_storage().exists(name))
+
+
+class ScrubberTests(EncryptedFileTestCase):
+    def upload(self, data, name='scrub.bin'):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_file'), {'files': [SimpleUploadedFile(name, data)]})
+        return File.objects.filter(filename=name).latest('id')
+
+    def test_corruption_is_flagged_and_repaired_by_reupload(self):
+        data = os.urandom(3 * SEGMENT_SIZE)
+        file_obj = self.upload(data)
+        blob = file_obj.blob
+        self.assertEqual(len(blob.integrity_manifest), 32 * 4)
+        self.assertEqual(run_scrubber(io_rate=0)['corrupt_blobs'], 0)
+
+        # Flip one byte in the second segment
+        path = os.path.join(self.media.name, blob.file.name)
+        with open(path, 'r+b') as f:
+            f.seek(HEADER_SIZE + SEGMENT_SIZE + TAG_SIZE + 10)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+        url = reverse('download_file', args=[file_obj.id])
+        # Partial reads are checked against the manifest before the range is served
+        response = self.client.get(url, HTTP_RANGE=f'bytes={SEGMENT_SIZE}-{SEGMENT_SIZE + 9}', follow=True)
+        self.assertContains(response, 'integrity check failed')
+
+        stats = run_scrubber(io_rate=0)
+        self.assertEqual((stats['corrupt_blobs'], stats['flagged_files']), (1, 1))
+        file_obj.refresh_from_db()
+        self.assertIsNotNone(file_obj.corrupted_at)
+        self.assertRedirects(self.client.get(url), reverse('file_list'), fetch_redirect_response=False)
+
+        self.upload(data, 'again.bin')
+        file_obj.refresh_from_db()
+        self.assertIsNone(file_obj.corrupted_at)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), data)
+
+    def test_blobs_without_a_manifest_are_backfilled(self):
+        self.create_file(b'legacy content' * 1000, 'legacy.txt')
+        call_command('migrate_blobs', stdout=io.StringIO())
+        blob = Blob.objects.get()
+        self.assertEqual(blob.integrity_manifest, b'')
+
+        stats = run_scrubber(io_rate=0)
+        blob.refresh_from_db()
+        self.assertEqual((stats['blobs'], stats['corrupt_blobs']), (1, 0))
+        self.assertEqual(merkle_root(unpack_leaves(blob.integrity_manifest)), blob.merkle_root)
+        self.assertIsNotNone(blob.verified_at)
+
+
+class ChunkingTests(SimpleTestCase):
+    def split(self, data, step=10000):
+        chunker = Chunker()
+        chunks = []
+        for offset in range(0, len(data), step):
+            chunks.extend(chunker.update(data[offset:offset + step]))
+        return chunks + chunker.finalize()
+
+    def test_chunks_reassemble_within_bounds(self):
+        data = os.urandom(2 * 1024 * 1024)
+        chunks = self.split(data)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks))
+        self.assertTrue(all(len(chunk) > MIN_CHUNK_SIZE for chunk in chunks[:-1]))
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        data = os.urandom(2 * 1024 * 1024)
+        original = set(self.split(data))
+        revised = self.split(data[:1000] + b'inserted' + data[1000:], step=4096)
+        self.assertLessEqual(len([chunk for chunk in revised if chunk not in original]), 2)
+
+
+@override_settings(FILE_STORAGE_MODE='chunked')
+class ChunkedStorageTests(EncryptedFileTestCase):
+    def upload(self, name, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('upload_file'), {'files': [SimpleUploadedFile(name, data)]},
+                HTTP_ACCEPT='application/json',
+            )
+        return File.objects.get(id=response.json()['results'][0]['id'])
+
+    def test_revisions_store_only_changed_chunks(self):
+        data = os.urandom(1024 * 1024)
+        first = self.upload('doc.docx', data)
+        chunks_before = Chunk.objects.count()
+        second = self.upload('doc.docx', data[:5000] + b'edit' + data[5000:])
+
+        self.assertTrue(second.chunked)
+        self.assertEqual((first.version, second.version), (1, 2))
+        self.assertLessEqual(Chunk.objects.count() - chunks_before, 2)
+
+        response = self.client.get(reverse('download_file', args=[second.id]))
+        self.assertEqual(b''.join(response.streaming_content), data[:5000] + b'edit' + data[5000:])
+        response = self.client.get(reverse('download_file', args=[first.id]), HTTP_RANGE='bytes=100000-300000')
+        self.assertEqual(b''.join(response.streaming_content), data[100000:300001])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('delete_file', args=[first.id]))
+            self.client.post(reverse('delete_file', args=[second.id]))
+        self.assertFalse(Chunk.objects.exists())
+        stored = [name for _, _, names in os.walk(os.path.join(self.media.name, 'chunks')) for name in names]
+        self.assertEqual(stored, [])
+
+    def test_released_chunks_picked_up_again_are_not_reclaimed(self):
+        data = os.urandom(512 * 1024)
+        first = self.upload('first.bin', data)
+        # Hold back the reclaim the delete schedules, as if it ran late
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('delete_file', args=[first.id]))
+        second = self.upload('second.bin', data)
+        for callback in callbacks:
+            callback()
+
+        self.assertTrue(all(chunk.refcount == 1 for chunk in Chunk.objects.all()))
+        response = self.client.get(reverse('download_file', args=[second.id]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+
+class ResumableUploadTests(EncryptedFileTestCase):
+    def start(self, length, filename='big.bin'):
+        response = self.client.post(
+            reverse('create_upload_session'),
+            HTTP_UPLOAD_LENGTH=str(length),
+            HTTP_UPLOAD_METADATA='filename ' + base64.b64encode(filename.encode()).decode(),
+        )
+        self.assertEqual(response.status_code, 201)
+        return response['Location']
+
+    def patch(self, url, offset, data):
+        return self.client.patch(
+            url, data, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def test_chunks_resume_and_complete(self):
+        data = os.urandom(3 * SEGMENT_SIZE + 999)
+        url = self.start(len(data))
+
+        response = self.patch(url, 0, data[:100000])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], '100000')
+
+        # A client that lost track asks for the offset, and a stale offset is rejected
+        self.assertEqual(self.client.head(url)['Upload-Offset'], '100000')
+        self.assertEqual(self.patch(url, 0, data[:10]).status_code, 409)
+
+        response = self.patch(url, 100000, data[100000:])
+        self.assertEqual(response.status_code, 204)
+        file_obj = File.objects.get(id=response['Upload-File-Id'])
+        self.assertEqual(file_obj.file_hash, hashlib.sha256(data).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media.name, 'uploads')), [])
+
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_oversized_chunk_is_rejected(self):
+        url = self.start(10)
+        self.assertEqual(self.patch(url, 0, b'x' * 11).status_code, 413)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], '0')
+
+    def test_expired_sessions_are_collected(self):
+        self.start(10)
+        UploadSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('expire_upload_sessions', stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media.name, 'uploads')), [])
+
+
+job_calls = []
+
+
+@jobs.handler('test_job', on_failure=lambda error, **payload: job_calls.append(('gave up', error)))
+def _test_job(name, fail=False):
+    job_calls.append(name)
+    if fail:
+        raise Exception(f"{name} failed")
+
+
+@override_settings(JOB_MAX_ATTEMPTS=2, JOB_RETRY_BACKOFF=60)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        job_calls.clear()
+
+    def test_priority_retries_and_failure(self):
+        low, = jobs.enqueue('test_job', [{'name': 'low'}])
+        high, = jobs.enqueue('test_job', [{'name': 'high', 'fail': True}], priority=5)
+
+        job, = jobs.lease('worker')
+        self.assertEqual(job.pk, high.pk)
+        self.assertFalse(jobs.run(job))
+        high.refresh_from_db()
+        self.assertEqual((high.status, high.last_error), (Job.QUEUED, "high failed"))
+        self.assertGreater(high.run_after, timezone.now() + timedelta(seconds=50))
+
+        # The failed job backs off, so the other one runs in the meantime
+        job, = jobs.lease('worker')
+        self.assertEqual(job.pk, low.pk)
+        self.assertTrue(jobs.run(job))
+        self.assertEqual(jobs.lease('worker'), [])
+
+        Job.objects.filter(pk=high.pk).update(run_after=timezone.now())
+        self.assertFalse(jobs.run(jobs.lease('worker')[0]))
+        high.refresh_from_db()
+        self.assertEqual((high.status, high.attempts), (Job.FAILED, 2))
+        self.assertEqual(job_calls, ['high', 'low', 'high', ('gave up', "high failed")])
+
+    def test_expired_leases_are_taken_over(self):
+        queued, = jobs.enqueue('test_job', [{'name': 'slow'}])
+        job, = jobs.lease('crashed', visibility_timeout=60)
+        self.assertEqual(jobs.lease('other'), [])
+
+        Job.objects.filter(pk=queued.pk).update(leased_until=timezone.now() - timedelta(seconds=1))
+        job, = jobs.lease('other')
+        self.assertEqual((job.lease_owner, job.attempts), ('other', 2))
+        self.assertTrue(jobs.run(job))
+
+        # A second lapse uses up the last attempt, so the job fails instead of running again
+        stuck, = jobs.enqueue('test_job', [{'name': 'stuck'}])
+        jobs.lease('crashed')
+        Job.objects.filter(pk=stuck.pk).update(attempts=2, leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.lease('other'), [])
+        self.assertEqual(Job.objects.get(pk=stuck.pk).status, Job.FAILED)
+        self.assertEqual(job_calls, ['slow', ('gave up', "Lease expired")])
+
+
+@override_settings(JOB_RUN_INLINE=False)
+class BackgroundProcessingTests(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=self.media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.owner = User.objects.create_user('owner')
+        self.client.force_login(self.owner)
+
+    def status(self, file_obj):
+        data = self.client.get(reverse('file_status'), {'ids': [file_obj.id]}).json()
+        return data['results'][0]['status']
+
+    def run_workers(self):
+        out = io.StringIO()
+        call_command('run_workers', once=True, stdout=out)
+        return out.getvalue()
+
+    def test_deduplicated_uploads_are_served_once_processed(self):
+        data = os.urandom(2 * SEGMENT_SIZE)
+        upload = lambda name: self.client.post(  # noqa: E731
+            reverse('upload_file'), {'files': [SimpleUploadedFile(name, data)]}, HTTP_ACCEPT='application/json'
+        ).json()['results'][0]
+        self.assertEqual(upload('a.bin')['status'], File.READY)
+        self.assertFalse(Job.objects.exists())
+
+        # The second copy reuses ciphertext nobody has read back yet
+        self.assertEqual(upload('b.bin')['status'], File.PENDING)
+        file_obj = File.objects.get(filename='b.bin')
+        self.assertEqual(self.status(file_obj), File.PENDING)
+        url = reverse('download_file', args=[file_obj.id])
+        self.assertRedirects(self.client.get(url), reverse('file_list'), fetch_redirect_response=False)
+
+        self.assertIn("Processed 1 job(s)", self.run_workers())
+        self.assertEqual(self.status(file_obj), File.READY)
+        self.assertIsNotNone(Blob.objects.get().verified_at)
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), data)
+
+    def test_resumable_upload_is_finalized_by_a_worker(self):
+        data = os.urandom(SEGMENT_SIZE + 5)
+        response = self.client.post(
+            reverse('create_upload_session'), HTTP_UPLOAD_LENGTH=str(len(data)),
+            HTTP_UPLOAD_METADATA='filename ' + base64.b64encode(b'big.bin').decode(),
+        )
+        url = response['Location']
+        patch = lambda: self.client.patch(  # noqa: E731
+            url, data, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0'
+        )
+        file_id = patch()['Upload-File-Id']
+        # A client retrying the final chunk is pointed at the same pending file
+        self.assertEqual(patch()['Upload-File-Id'], file_id)
+        file_obj = File.objects.get()
+        self.assertEqual(self.status(file_obj), File.PENDING)
+
+        self.run_workers()
+        file_obj.refresh_from_db()
+        self.assertEqual((file_obj.processing_status, file_obj.file_hash), (File.READY, hashlib.sha256(data).hexdigest()))
+        self.assertFalse(UploadSession.objects.exists())
+        response = self.client.get(reverse('download_file', args=[file_obj.id]))
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+
+class FileListTests(EncryptedFileTestCase):
+    def add_rows(self, count):
+        for i in range(count):
+            sharer = User.objects.create_user(f'sharer{File.objects.count()}')
+            own = File.objects.create(user=self.owner, filename=f'mine{i}.txt', file='x', file_hash='0' * 64)
+            theirs = File.objects.create(user=sharer, filename=f'theirs{i}.txt', file='x', file_hash='0' * 64)
+            FileShare.objects.create(file=theirs, shared_by=sharer, shared_with=self.owner)
+        return own
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('file_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_rows(2)
+        few = self.count_queries()
+        self.add_rows(20)
+        self.assertEqual(self.count_queries(), few)
+
+    @override_settings(FILE_LIST_PAGE_SIZE=5)
+    def test_keyset_pages_cover_every_row_once(self):
+        self.add_rows(12)
+        response = self.client.get(reverse('file_list'))
+        self.assertEqual(len(response.context['user_files']), 5)
+
+        seen = [file.filename for file in response.context['user_files']]
+        cursor = response.context['files_cursor']
+        while cursor:
+            data = self.client.get(reverse('file_list'), {'tab': 'mine', 'cursor': cursor}).json()
+            seen.extend(re.findall(r'title="(mine\d+\.txt)"', data['html']))
+            cursor = data['next_cursor']
+        self.assertEqual(sorted(seen), sorted(f'mine{i}.txt' for i in range(12)))
@@ -0,0 +1,321 @@
+import io
+import os
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from . import keys, metrics
+from .chunking import Chunker, store_chunk
+from .storage import get_storage, new_blob_name
+from .utils import SEGMENT_SIZE, SegmentEncryptor, choose_codec
+
+# Flat directory used before the storage backend; only relocate_files and the janitor still look here
+UPLOAD_DIR = 'encrypted_files'
+
+# Chunks buffered per file between the request thread and the encryption pool
+PIPELINE_DEPTH = 8
+
+# Memory an upload holds at once: the buffered chunks plus the segment being sealed
+UPLOAD_WORKING_SET = (PIPELINE_DEPTH + 2) * SEGMENT_SIZE
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_encryption_executor():
+    """Return the shared encryption pool, or None when FILE_ENCRYPTION_WORKERS disables it"""
+    global _executor
+    workers = getattr(settings, 'FILE_ENCRYPTION_WORKERS', os.cpu_count())
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encrypt')
+        return _executor
+
+
+def create_ciphertext_file():
+    """
+    Open a writer for a new, uniquely named ciphertext in the storage backend; returns (writer, name).
+    The object only becomes visible once the writer is closed, and abort() discards it.
+    """
+    name = new_blob_name()
+    return get_storage().open_write(name), name
+
+
+def reset_encryption_executor():
+    """Shut down the shared pool so the next upload picks up the current setting"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def _timed_pipeline(destination, encryptor):
+    """Return (encrypt, write, timer) for an upload, timed only when metrics are enabled"""
+    timer = metrics.start_timer()
+    if timer is None:
+        return encryptor.update, destination.write, None
+    return (
+        timer.wrap('encrypt', encryptor.update, count_result=False),
+        timer.wrap('write', destination.write, count_result=False),
+        timer,
+    )
+
+
+class _EncryptionPipeline:
+    """
+    Encrypts one file's chunks on the shared pool in arrival order. A pool task only runs while
+    chunks are waiting and returns its worker once they are written, so a slow client never holds
+    a worker through the network receive. At most PIPELINE_DEPTH chunks wait; put() blocks beyond that.
+    future resolves to the plaintext hash and manifest once close() has been called and all is written.
+    """
+
+    def __init__(self, executor, destination, encryptor):
+        self.executor = executor
+        self.destination = destination
+        self.encryptor = encryptor
+        self.encrypt, self.write, self.timer = _timed_pipeline(destination, encryptor)
+        self.future = Future()
+        self._pending = deque()
+        self._ready = threading.Condition()
+        self._running = False
+        self._closed = False
+        self._error = None
+
+    def _schedule(self):
+        # Called with the condition held; one task at a time keeps the chunks in order
+        if not self._running:
+            self._running = True
+            self.executor.submit(self._drain)
+
+    def put(self, chunk):
+        with self._ready:
+            while len(self._pending) >= PIPELINE_DEPTH and self._error is None:
+                self._ready.wait()
+            # After a failure the rest of the body is dropped; close() reports the error
+            if self._error is None:
+                self._pending.append(chunk)
+                self._schedule()
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._schedule()
+        return self.future
+
+    def abort(self, error):
+        """Drop the chunks still waiting and discard what was written; returns future"""
+        with self._ready:
+            self._pending.clear()
+            if self._error is None:
+                self._error = error
+            self._ready.notify_all()
+        return self.close()
+
+    def _drain(self):
+        while True:
+            with self._ready:
+                if not self._pending:
+                    if not self._closed:
+                        self._running = False
+                        return
+                    break
+                chunk = self._pending.popleft()
+                error = self._error
+                self._ready.notify_all()
+            if error is None:
+                try:
+                    self.write(self.encrypt(chunk))
+                except Exception as e:
+                    with self._ready:
+                        self._error = e
+                        self._pending.clear()
+                        self._ready.notify_all()
+        self._complete()
+
+    def _complete(self):
+        try:
+            if self._error is None:
+                with self.destination:
+                    self.write(self.encryptor.finalize())
+            else:
+                self.destination.abort()
+        except Exception as e:
+            self._error = e
+        if self.timer:
+            self.timer.finish()
+        if self._error is not None:
+            self.future.set_exception(self._error)
+        else:
+            self.future.set_result((self.encryptor.hexdigest(), self.encryptor.manifest()))
+
+
+class EncryptedUploadedFile(UploadedFile):
+    """
+    A file that was encrypted while it was being received.
+    Only ciphertext was stored; storage_name is its name in the storage backend.
+    hash_future resolves to the plaintext hash and the packed integrity manifest.
+    """
+
+    def __init__(self, storage_name, name, content_type, size, charset, hash_future, content_type_extra=None):
+        super().__init__(io.BytesIO(), name, content_type, size, charset, content_type_extra)
+        self.storage_name = storage_name
+        self._hash_future = hash_future
+
+    @property
+    def stored_size(self):
+        """Size of the ciphertext; waits for encryption to finish like file_hash"""
+        self._hash_future.result()
+        return get_storage().size(self.storage_name)
+
+    @property
+    def file_hash(self):
+        """Plaintext hash; blocks until the encryption worker has finished this file"""
+        return self._hash_future.result()[0]
+
+    @property
+    def integrity_manifest(self):
+        """Packed manifest leaves of the stored ciphertext"""
+        return self._hash_future.result()[1]
+
+    def discard(self):
+        """Close and remove the ciphertext, e.g. when the database write fails"""
+        self.close()
+        get_storage().delete(self.storage_name)
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    """
+    Upload handler that hashes and encrypts each chunk as it arrives,
+    so the request body is written to the storage backend as ciphertext in a single pass.
+    Encryption runs on the shared pool, so a file is still being encrypted while
+    the request thread parses the next one in a multi-file batch.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.destination, self.storage_name = create_ciphertext_file()
+        self.encryptor = None
+        self.pipeline = None
+
+    def _start(self, sample):
+        """Set up encryption once the first chunk shows whether compression pays off"""
+        self.encryptor = SegmentEncryptor(
+            keys.new_data_key(), codec=choose_codec(self.file_name, sample)
+        )
+        executor = get_encryption_executor()
+        if executor is None:
+            self.pipeline = None
+            self._encrypt, self._write, self._timer = _timed_pipeline(self.destination, self.encryptor)
+        else:
+            self.pipeline = _EncryptionPipeline(executor, self.destination, self.encryptor)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.encryptor is None:
+            self._start(raw_data)
+        if self.pipeline is None:
+            self._write(self._encrypt(raw_data))
+        else:
+            self.pipeline.put(raw_data)
+
+    def _finish(self):
+        """Signal the end of the current file and return the future for its hash and manifest"""
+        if self.encryptor is None:
+            self._start(b'')
+        if self.pipeline is not None:
+            return self.pipeline.close()
+
+        # Without a pool the file was encrypted inline; only the last segment is left
+        future = Future()
+        try:
+            with self.destination:
+                self._write(self.encryptor.finalize())
+            future.set_result((self.encryptor.hexdigest(), self.encryptor.manifest()))
+        except Exception as e:
+            future.set_exception(e)
+        if self._timer:
+            self._timer.finish()
+        return future
+
+    def file_complete(self, file_size):
+        return EncryptedUploadedFile(
+            self.storage_name,
+            self.file_name,
+            self.content_type,
+            file_size,
+            self.charset,
+            self._finish(),
+            self.content_type_extra,
+        )
+
+    def upload_interrupted(self):
+        if hasattr(self, 'destination'):
+            if self.pipeline is not None:
+                # Skip the chunks still waiting; only one in flight is awaited before the writer is discarded
+                self.pipeline.abort(Exception("Upload interrupted")).exception()
+            else:
+                self.destination.abort()
+            get_storage().delete(self.storage_name)
+
+
+class ChunkedUploadedFile(UploadedFile):
+    """
+    A file split into content-defined chunks while it was being received.
+    manifest lists (chunk_hash, size) pairs in order; the chunks are already stored.
+    """
+
+    def __init__(self, name, content_type, size, charset, file_hash, manifest, content_type_extra=None):
+        super().__init__(io.BytesIO(), name, content_type, size, charset, content_type_extra)
+        self.file_hash = file_hash
+        self.manifest = manifest
+
+    def discard(self):
+        """Chunks may already be shared with other files; unreferenced ones are swept separately"""
+        self.close()
+
+
+class ChunkingUploadHandler(FileUploadHandler):
+    """
+    Upload handler for the chunked storage mode. The stream is cut into
+    content-defined chunks and only chunks not already stored are encrypted,
+    so re-uploading a revised file costs encryption only for the changed bytes.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.chunker = Chunker()
+        self.hasher = hashlib.sha256()
+        self.manifest = []
+        self.data_key = None
+
+    def _data_key(self):
+        """The data key shared by this file's new chunks, created when the first one is stored"""
+        if self.data_key is None:
+            self.data_key = keys.new_data_key()
+        return self.data_key
+
+    def _store(self, chunks):
+        for chunk in chunks:
+            self.manifest.append((store_chunk(chunk, self.file_name, self._data_key), len(chunk)))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        self._store(self.chunker.update(raw_data))
+
+    def file_complete(self, file_size):
+        self._store(self.chunker.finalize())
+        return ChunkedUploadedFile(
+            self.file_name,
+            self.content_type,
+            file_size,
+            self.charset,
+            self.hasher.hexdigest(),
+            self.manifest,
+            self.content_type_extra,
+        )
@@ -1,13 +1,322 @@
 import os
+import zlib
+import base64
+import struct
 import hashlib
 import tempfile
 from cryptography.fernet import Fernet
-from django.conf import settings
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from dotenv import load_dotenv, set_key
 
+from . import keys, metrics
+
+# Segmented on-disk format:
+#   header  = magic | version (1 byte) | segment size (4 bytes) | salt (16 bytes) [| codec (1 byte), v2+]
+#             [| data key id (8 bytes), v3+]
+#   body    = segments of AES-256-GCM(stream[:segment size]) + 16-byte tag
+# The segmented stream is the plaintext, or its compressed form when a codec is set.
+# Each segment nonce is an 11-byte counter followed by a final-segment flag, so
+# truncated, reordered or spliced segments fail authentication.
+# v3 segment keys come from the DataKey row named in the header (see keys.py);
+# v1 and v2 segment keys come straight from the master FERNET_KEY.
+STREAM_MAGIC = b"SFSE"
+STREAM_VERSION = 3
+SEGMENT_SIZE = 64 * 1024
+SALT_SIZE = 16
+TAG_SIZE = 16
+HEADER_STRUCTS = {
+    1: struct.Struct(">4sBI16s"),
+    2: struct.Struct(">4sBI16sB"),
+    3: struct.Struct(">4sBI16sBQ"),
+}
+HEADER_SIZE = HEADER_STRUCTS[STREAM_VERSION].size
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+# Extensions whose content is already compressed; compressing them again only costs CPU
+COMPRESSED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'zip', 'pdf', 'gz', 'mp3', 'mp4'}
+# Compress only when a sample shrinks below this fraction of its size
+COMPRESSION_THRESHOLD = 0.9
+PROBE_SIZE = 8 * 1024
+# Level 1 keeps uploads near disk speed; level 6 saved ~7 more points on text at a quarter of the throughput
+COMPRESSION_LEVEL = 1
+
+# Integrity manifest: one SHA-256 leaf for the header and one for each segment's GCM tag.
+# A tag authenticates its segment under the file key, so decrypting a segment and matching
+# its tag to the manifest proves it is the one uploaded; uploads pay no extra hashing
+LEAF_SIZE = 32
+
+# Prefix of the plaintext temp files older releases decrypted into; the janitor removes any they leaked
+DECRYPT_TEMP_PREFIX = 'sfs-decrypted-'
+
+
+def choose_codec(filename, sample):
+    """Pick a codec from the file type and a quick compression probe of the first bytes"""
+    _, ext = os.path.splitext(filename or '')
+    if ext[1:].lower() in COMPRESSED_EXTENSIONS or not sample:
+        return CODEC_NONE
+    sample = sample[:PROBE_SIZE]
+    if len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_THRESHOLD:
+        return CODEC_ZLIB
+    return CODEC_NONE
+
+
+def read_header(file):
+    """
+    Read the segmented-format header from the start of an open file.
+    Returns the raw header bytes, or None (with the file rewound) for legacy Fernet tokens.
+    """
+    prefix = file.read(len(STREAM_MAGIC) + 1)
+    if not prefix.startswith(STREAM_MAGIC) or len(prefix) <= len(STREAM_MAGIC):
+        file.seek(0)
+        return None
+    header_struct = HEADER_STRUCTS.get(prefix[-1])
+    if header_struct is None:
+        raise ValueError("Unsupported encrypted file format")
+    return prefix + file.read(header_struct.size - len(prefix))
+
+
+def _unpack_header(header):
+    header_struct = HEADER_STRUCTS.get(header[len(STREAM_MAGIC)])
+    if not header.startswith(STREAM_MAGIC) or header_struct is None or len(header) != header_struct.size:
+        raise ValueError("Unsupported encrypted file format")
+    return header_struct.unpack(header)
+
+
+def parse_header(header):
+    """Return (segment_size, salt, codec) from raw header bytes"""
+    fields = _unpack_header(header)
+    codec = fields[4] if len(fields) > 4 else CODEC_NONE
+    return fields[2], fields[3], codec
+
+
+def header_data_key(header):
+    """Return the id of the DataKey sealing a ciphertext, or None if it is sealed under the master key"""
+    fields = _unpack_header(header)
+    return fields[5] if len(fields) > 5 else None
+
+
+def leaf_digest(data):
+    """Manifest leaf for the header or a segment's tag"""
+    return hashlib.sha256(b"\x00" + data).digest()
+
+
+def merkle_root(leaves):
+    """Hex Merkle root over manifest leaves; an odd node is carried up unchanged"""
+    level = list(leaves)
+    if not level:
+        return ''
+    while len(level) > 1:
+        paired = [hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        level = paired + level[len(paired) * 2:]
+    return level[0].hex()
+
+
+def unpack_leaves(manifest):
+    """Split a packed manifest into its leaves"""
+    return [bytes(manifest[i:i + LEAF_SIZE]) for i in range(0, len(manifest), LEAF_SIZE)]
+
+
+def check_leaf(manifest, index, data):
+    """Compare the header or a segment's tag with its leaf in a packed manifest"""
+    if manifest[index * LEAF_SIZE:(index + 1) * LEAF_SIZE] != leaf_digest(data):
+        raise Exception("File integrity check failed.")
+
+
+def derive_segment_key(key, salt):
+    """Derive the per-file AES-256 key of a v1/v2 ciphertext from the master Fernet key and the header salt"""
+    return keys.derive_key(base64.urlsafe_b64decode(key), salt, keys.SEGMENT_KEY_INFO)
+
+
+def segment_cipher(header):
+    """The cached AES-GCM cipher for the segments of a ciphertext with this header"""
+    _, salt, _ = parse_header(header)
+    data_key_id = header_data_key(header)
+    if data_key_id is not None:
+        return keys.segment_cipher(data_key_id, salt)
+    return keys.cached_cipher('master', salt, lambda: base64.urlsafe_b64decode(FileEncryptor.get_key()))
+
+
+def segment_nonce(index, last):
+    """Build the 12-byte nonce for a segment"""
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+class SegmentEncryptor:
+    """
+    Incrementally (optionally compresses and) encrypts plaintext into the segmented format.
+    data_key is the keys.PlainDataKey the segment key is derived from.
+    """
+
+    def __init__(self, data_key, segment_size=SEGMENT_SIZE, codec=CODEC_NONE):
+        self.segment_size = segment_size
+        self.codec = codec
+        salt = os.urandom(SALT_SIZE)
+        self.header = HEADER_STRUCTS[STREAM_VERSION].pack(
+            STREAM_MAGIC, STREAM_VERSION, segment_size, salt, codec, data_key.id
+        )
+        self._aead = AESGCM(keys.derive_key(data_key.key, salt, keys.SEGMENT_KEY_INFO))
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL) if codec == CODEC_ZLIB else None
+        self._buffer = bytearray()
+        self._index = 0
+        self._hash = hashlib.sha256()
+        self._header_written = False
+        self.leaves = [leaf_digest(self.header)]
+        self.plaintext_bytes = 0
+        self.stored_bytes = 0
+
+    def _take_header(self):
+        if self._header_written:
+            return b""
+        self._header_written = True
+        return self.header
+
+    def _seal(self, data, last):
+        sealed = self._aead.encrypt(segment_nonce(self._index, last), data, self.header)
+        self._index += 1
+        self.stored_bytes += len(sealed)
+        self.leaves.append(leaf_digest(sealed[-TAG_SIZE:]))
+        return sealed
+
+    def update(self, data):
+        """Feed plaintext and return the ciphertext of every completed segment"""
+        self._hash.update(data)
+        self.plaintext_bytes += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        out = bytearray(self._take_header())
+        # Always keep the tail buffered: only finalize() knows which segment is last
+        while len(self._buffer) > self.segment_size:
+            out += self._seal(bytes(self._buffer[:self.segment_size]), last=False)
+            del self._buffer[:self.segment_size]
+        return bytes(out)
+
+    def finalize(self):
+        """Seal the final segment(s) and return the remaining ciphertext"""
+        out = bytearray()
+        if self._compressor is not None:
+            out += self.update(b"")
+            self._buffer += self._compressor.flush()
+            while len(self._buffer) > self.segment_size:
+                out += self._seal(bytes(self._buffer[:self.segment_size]), last=False)
+                del self._buffer[:self.segment_size]
+        out += self._take_header() + self._seal(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        return bytes(out)
+
+    def hexdigest(self):
+        """SHA-256 of all plaintext fed so far"""
+        return self._hash.hexdigest()
+
+    def manifest(self):
+        """Packed manifest leaves of everything sealed so far"""
+        return b"".join(self.leaves)
+
+
+class SegmentDecryptor:
+    """
+    Incrementally decrypts ciphertext written by SegmentEncryptor.
+    Output is the segmented stream; decompressing it is left to the caller (see codec).
+    """
+
+    def __init__(self, header):
+        self.segment_size, _, self.codec = parse_header(header)
+        self.header = header
+        self._aead = segment_cipher(header)
+        self._buffer = bytearray()
+        self._index = 0
+
+    @property
+    def sealed_segment_size(self):
+        return self.segment_size + TAG_SIZE
+
+    def open_segment(self, index, data, last):
+        """Authenticate and decrypt a single sealed segment at a known position"""
+        return self._aead.decrypt(segment_nonce(index, last), data, self.header)
+
+    def _open(self, data, last):
+        plaintext = self.open_segment(self._index, data, last)
+        self._index += 1
+        return plaintext
+
+    def update(self, data):
+        """Feed ciphertext and return the stream bytes of every segment known not to be last"""
+        self._buffer += data
+        out = bytearray()
+        sealed = self.sealed_segment_size
+        while len(self._buffer) > sealed:
+            out += self._open(bytes(self._buffer[:sealed]), last=False)
+            del self._buffer[:sealed]
+        return bytes(out)
+
+    def finalize(self):
+        """Open the final segment; fails if the stream was truncated"""
+        if len(self._buffer) < TAG_SIZE:
+            raise InvalidTag()
+        out = self._open(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        return out
+
+
+def iter_decompressed(chunks, codec):
+    """Undo the stream codec, never producing more than a segment of output per step"""
+    if codec == CODEC_NONE:
+        yield from chunks
+        return
+
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        data = chunk
+        while data:
+            # max_length bounds the output so a highly compressed segment cannot balloon memory
+            out = decompressor.decompress(data, SEGMENT_SIZE)
+            if out:
+                yield out
+            data = decompressor.unconsumed_tail
+    out = decompressor.flush()
+    if out:
+        yield out
+    if not decompressor.eof:
+        raise ValueError("Compressed stream is incomplete")
+
+
+def verify_chunks(chunks, hasher, expected_hash):
+    """
+    Pass plaintext chunks through while hasher (fed by the producer) is checked.
+    The last chunk is held back until the hash matches, so content that fails
+    the integrity check is never delivered in full.
+    """
+    pending = None
+    for chunk in chunks:
+        if pending:
+            yield pending
+        pending = chunk
+    if hasher.hexdigest() != expected_hash:
+        raise Exception("File integrity check failed.")
+    if pending:
+        yield pending
+
+
+def _open_ciphertext(source):
+    """Open a ciphertext given as a local path or as a storage handle with open_read()"""
+    if hasattr(source, 'open_read'):
+        return source.open_read()
+    return open(source, 'rb')
+
+
+def _ciphertext_size(source):
+    if hasattr(source, 'size'):
+        return source.size()
+    return os.path.getsize(source)
+
+
 class FileEncryptor:
     ENV_KEY_NAME = "FERNET_KEY"
-    
+    _key = None
+
     @classmethod
     def initialize(cls):
         """Initialize the encryption key if it doesn't exist"""
@@ -27,68 +336,267 @@ class FileEncryptor:
 
     @classmethod
     def get_key(cls):
-        """Get the encryption key, generating if necessary"""
-        cls.initialize()
-        key = os.getenv(cls.ENV_KEY_NAME)
-        if isinstance(key, str):
-            key = key.encode()
-        return key
+        """Get the master encryption key, generating if necessary; it is read once per process"""
+        if cls._key is None:
+            with metrics.span('key_load'):
+                cls.initialize()
+                key = os.getenv(cls.ENV_KEY_NAME)
+            cls._key = key.encode() if isinstance(key, str) else key
+        return cls._key
+
+    @classmethod
+    def is_segmented(cls, file_path):
+        """Return True if the file uses the segmented format rather than a legacy Fernet token"""
+        with _open_ciphertext(file_path) as file:
+            return file.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+
+    @classmethod
+    def plaintext_size(cls, file_path):
+        """
+        Return the decrypted size of an uncompressed segmented file without decrypting it.
+        Returns None for legacy and compressed files, whose size cannot be derived.
+        """
+        with _open_ciphertext(file_path) as file:
+            header = read_header(file)
+        if header is None:
+            return None
+        segment_size, _, codec = parse_header(header)
+        if codec != CODEC_NONE:
+            return None
+        body_size = _ciphertext_size(file_path) - len(header)
+        segments = max(1, -(-body_size // (segment_size + TAG_SIZE)))
+        return body_size - segments * TAG_SIZE
+
+    @classmethod
+    def encrypt_stream(cls, source, destination, segment_size=SEGMENT_SIZE, filename=None, leaves=None,
+                       data_key=None):
+        """
+        Encrypt a readable binary stream into a writable one and return the plaintext hash.
+        The stream is compressed first when the filename and a probe of the first read suggest it pays off.
+        If given, leaves is extended with the integrity manifest of the written ciphertext.
+        The ciphertext is sealed under data_key, or under a new data key when none is given.
+        """
+        timer = metrics.start_timer()
+        read, write = source.read, destination.write
+        if timer:
+            read, write = timer.wrap('read', read), timer.wrap('write', write, count_result=False)
+        try:
+            chunk = read(segment_size)
+            encryptor = SegmentEncryptor(data_key or keys.new_data_key(), segment_size, choose_codec(filename, chunk))
+            # Hashing and compression happen inside update(), so they count towards encrypt
+            encrypt = timer.wrap('encrypt', encryptor.update, count_result=False) if timer else encryptor.update
+            while chunk:
+                write(encrypt(chunk))
+                chunk = read(segment_size)
+            write(encryptor.finalize())
+            if leaves is not None:
+                leaves.extend(encryptor.leaves)
+            return encryptor.hexdigest()
+        finally:
+            if timer:
+                timer.finish()
+
+    @classmethod
+    def iter_decrypt(cls, file_path, hasher=None):
+        """
+        Yield the plaintext of an encrypted file one segment at a time.
+        Legacy Fernet files are decrypted in one piece, as the format cannot be streamed.
+        If given, hasher is updated with every plaintext chunk before it is yielded.
+        """
+        timer = metrics.start_timer()
+        try:
+            with _open_ciphertext(file_path) as file:
+                read = timer.wrap('read', file.read) if timer else file.read
+                update_hash = hasher.update if hasher is not None else None
+                if timer and hasher is not None:
+                    update_hash = timer.wrap('hash', update_hash, count_result=False)
+
+                header = read_header(file)
+                if header is None:
+                    fernet = Fernet(cls.get_key())
+                    decrypt = timer.wrap('decrypt', fernet.decrypt) if timer else fernet.decrypt
+                    plaintext = decrypt(read())
+                    if update_hash is not None:
+                        update_hash(plaintext)
+                    yield plaintext
+                    return
+
+                decryptor = SegmentDecryptor(header)
+                decrypt, finalize = decryptor.update, decryptor.finalize
+                if timer:
+                    decrypt, finalize = timer.wrap('decrypt', decrypt), timer.wrap('decrypt', finalize)
+
+                def segments():
+                    while True:
+                        chunk = read(decryptor.sealed_segment_size)
+                        if not chunk:
+                            break
+                        data = decrypt(chunk)
+                        if data:
+                            yield data
+                    yield finalize()
+
+                for plaintext in iter_decompressed(segments(), decryptor.codec):
+                    if update_hash is not None:
+                        update_hash(plaintext)
+                    yield plaintext
+        finally:
+            if timer:
+                timer.finish()
+
+    @classmethod
+    def iter_decrypt_range(cls, file_path, start, stop, manifest=None):
+        """
+        Yield plaintext bytes [start, stop) of an encrypted file.
+        For uncompressed segmented files only the segments covering the range are
+        read and decrypted; other files are decrypted from the start and sliced.
+        With a packed manifest, each segment's tag is also checked against its leaf,
+        which ties a partial read to the upload without hashing the whole file.
+        """
+        with _open_ciphertext(file_path) as file:
+            header = read_header(file)
+            decryptor = SegmentDecryptor(header) if header is not None else None
+        if manifest and header is not None:
+            check_leaf(manifest, 0, header)
+
+        if decryptor is None or decryptor.codec != CODEC_NONE:
+            offset = 0
+            for plaintext in cls.iter_decrypt(file_path):
+                if offset >= stop:
+                    break
+                if offset + len(plaintext) > start:
+                    yield plaintext[max(start - offset, 0):stop - offset]
+                offset += len(plaintext)
+            return
+
+        timer = metrics.start_timer()
+        try:
+            body_size = _ciphertext_size(file_path) - len(header)
+            with _open_ciphertext(file_path) as file:
+                read, decrypt = file.read, decryptor.open_segment
+                if timer:
+                    read, decrypt = timer.wrap('read', read), timer.wrap('decrypt', decrypt)
+                segment_size = decryptor.segment_size
+                sealed = decryptor.sealed_segment_size
+                last_index = max(1, -(-body_size // sealed)) - 1
+
+                first_index = start // segment_size
+                file.seek(len(header) + first_index * sealed)
+                for index in range(first_index, (stop - 1) // segment_size + 1):
+                    data = read(sealed)
+                    if manifest:
+                        check_leaf(manifest, index + 1, data[-TAG_SIZE:])
+                    try:
+                        plaintext = decrypt(index, data, index == last_index)
+                    except InvalidTag:
+                        raise Exception("File integrity check failed.")
+                    offset = index * segment_size
+                    yield plaintext[max(start - offset, 0):stop - offset]
+        finally:
+            if timer:
+                timer.finish()
+
+    @classmethod
+    def verify_segments(cls, file_path, manifest=None, progress=None):
+        """
+        Authenticate every segment of a stored file without keeping any plaintext.
+        Returns (leaves, bad): the file's manifest leaves and the indexes of leaves whose
+        segment failed authentication or differs from manifest. Returns None for legacy
+        Fernet files. progress, if given, is called with the size of each read.
+        """
+        with _open_ciphertext(file_path) as file:
+            header = read_header(file)
+            if header is None:
+                return None
+            decryptor = SegmentDecryptor(header)
+            sealed = decryptor.sealed_segment_size
+            leaves = [leaf_digest(header)]
+            bad = set()
+            data = file.read(sealed)
+            if not data:
+                bad.add(1)
+            index = 0
+            while data:
+                # Reading one segment ahead tells whether this one must carry the final flag
+                following = file.read(sealed)
+                if progress is not None:
+                    progress(len(data))
+                leaves.append(leaf_digest(data[-TAG_SIZE:]))
+                try:
+                    decryptor.open_segment(index, data, not following)
+                except InvalidTag:
+                    bad.add(index + 1)
+                data = following
+                index += 1
+
+        if manifest:
+            expected = unpack_leaves(manifest)
+            bad.update(i for i, (leaf, wanted) in enumerate(zip(leaves, expected)) if leaf != wanted)
+            # A truncated or extended file also fails from its first missing or extra leaf
+            if len(leaves) != len(expected):
+                bad.add(min(len(leaves), len(expected)))
+        return leaves, sorted(bad)
+
+    @classmethod
+    def iter_verified(cls, file_path, expected_hash):
+        """Yield decrypted chunks of a file, checking the plaintext hash as they stream"""
+        hasher = hashlib.sha256()
+        return verify_chunks(cls.iter_decrypt(file_path, hasher), hasher, expected_hash)
 
     @classmethod
     def encrypt_file(cls, file_path):
-        """Encrypt a file and return its hash"""
+        """Encrypt a file in place and return its hash"""
+        temp_path = None
         try:
-            key = cls.get_key()
-            fernet = Fernet(key)
-            
-            # Read the original file
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-            
-            # Calculate hash of original data
-            file_hash = hashlib.sha256(file_data).hexdigest()
-            
-            # Encrypt the data
-            encrypted_data = fernet.encrypt(file_data)
-            
-            # Write encrypted data back to file
-            with open(file_path, 'wb') as file:
-                file.write(encrypted_data)
-            
+            # Write ciphertext next to the original so the final rename is atomic
+            temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or None)
+            with open(file_path, 'rb') as source, os.fdopen(temp_fd, 'wb') as destination:
+                file_hash = cls.encrypt_stream(source, destination, filename=file_path)
+            os.replace(temp_path, file_path)
             return file_hash
-            
+
         except Exception as e:
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
             raise Exception(f"Encryption failed: {str(e)}")
 
-    @classmethod
-    def decrypt_file(cls, file_path):
-        """Decrypt a file and return the path to decrypted file and its hash"""
+
+MAX_RANGES = 16
+
+
+def parse_range_header(header, size):
+    """
+    Parse an HTTP Range header against a representation of the given size.
+    Returns a list of (start, stop) pairs with stop exclusive, an empty list if
+    no range is satisfiable, or None if the header should be ignored.
+    """
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
         try:
-            key = cls.get_key()
-            fernet = Fernet(key)
-            
-            # Read the encrypted file
-            with open(file_path, 'rb') as file:
-                encrypted_data = file.read()
-            
-            # Decrypt the data
-            decrypted_data = fernet.decrypt(encrypted_data)
-            
-            # Get the original file extension
-            _, ext = os.path.splitext(file_path)
-            
-            # Create a temporary file with the same extension
-            temp_fd, temp_path = tempfile.mkstemp(suffix=ext)
-            os.close(temp_fd)
-            
-            # Write decrypted data to temporary file
-            with open(temp_path, 'wb') as temp_file:
-                temp_file.write(decrypted_data)
-            
-            # Calculate hash of decrypted data
-            decrypted_hash = hashlib.sha256(decrypted_data).hexdigest()
-            
-            return temp_path, decrypted_hash
-            
-        except Exception as e:
-            raise Exception(f"Decryption failed: {str(e)}")
\ No newline at end of file
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else max(size, start + 1)
+                if stop <= start:
+                    return None
+            else:
+                # Suffix range: the final N bytes
+                length = int(last)
+                start, stop = max(size - length, 0), size
+                if length == 0:
+                    continue
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(stop, size)))
+
+    # Serving too many small ranges costs more than the full body
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
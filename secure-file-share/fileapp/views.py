@@ -1,22 +1,35 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.http import FileResponse
+from django.db import IntegrityError
 from django.http import JsonResponse
-from django.core.exceptions import PermissionDenied
 
-from .models import File, FileShare, ShareableLink
+from .models import File, FileShare, UploadSession
 from .forms import FileUploadForm, UserRegistrationForm, FileShareForm
-from .utils import FileEncryptor
+from . import admission, bulk, jobs, metrics
+from .access import DELETE, DOWNLOAD, SHARE, VIEW, annotate_access, can, invalidate_access, redeem_link, release_link
+from .export import archive_names, iter_zip
+from .pagination import keyset_page
+from .processing import complete_session, new_file, save_uploads
+from .readers import open_reader
+from .resumable import UploadConflict, append_chunk, create_session, discard_session
+from .uploadhandlers import UPLOAD_WORKING_SET, ChunkingUploadHandler, EncryptingUploadHandler
+from .utils import parse_range_header
 import os
+import json
+import base64
 import secrets
-from datetime import timedelta
-from django.utils.timezone import now
-from django.http import HttpResponseForbidden, FileResponse
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
+from django.utils.timezone import localtime
 
 # View for user registration
 def register(request):
@@ -37,6 +50,37 @@ def logout_view(request):
     messages.success(request, "You have been logged out successfully.")
     return redirect('login')
 
+# Prometheus scrape endpoint; exposed only when metrics are enabled
+@require_http_methods(["GET"])
+def metrics_view(request):
+    if not metrics.enabled():
+        return HttpResponse(status=404)
+    return HttpResponse(
+        metrics.render() + admission.render() + jobs.render(), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+# Why a file whose background processing has not finished cannot be served yet
+NOT_READY = {
+    File.PENDING: "is still being processed",
+    File.PROCESSING: "is still being processed",
+    File.FAILED: "could not be processed",
+}
+
+def _stream_body(first_chunk, chunks):
+    """Response body that sends first_chunk and then chunks, closing chunks however the response ends"""
+    try:
+        yield first_chunk
+        yield from chunks
+    finally:
+        # A client that goes away mid-stream must not leave the ticket and file to the garbage collector
+        chunks.close()
+
+def _busy_response(error):
+    """503 for a crypto job the admission controller could not fit in"""
+    response = HttpResponse(str(error), status=503, content_type='text/plain')
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
 # View for generating share link
 
 @login_required
@@ -45,20 +89,15 @@ def generate_shareable_link(request, file_id):
     Generates a one-time shareable link for a file.
     """
     file = get_object_or_404(File, id=file_id)
+    if not can(request, file, SHARE):
+        return JsonResponse({'error': "You don't have permission to share this file."}, status=403)
     
-    # Generate a secure token and expiration time
-    token = secrets.token_urlsafe(32)
-    expiration_time = now() + timedelta(hours=24)  # 24-hour validity
-    
-    # Create a new ShareableLink object
-    shareable_link = ShareableLink.objects.create(
-        file=file,
-        token=token,
-        expires_at=expiration_time
-    )
+    # Generate a secure token valid for 24 hours
+    link, token = bulk.new_link(file)
+    link.save()
     
     # Return the generated link
-    link = f"{request.scheme}://{request.get_host()}/file/share/{shareable_link.token}/"
+    link = request.build_absolute_uri(reverse('access_shared_file', args=[token]))
     return JsonResponse({'link': link})
 
 
@@ -66,54 +105,117 @@ def access_shared_file(request, token):
     """
     Validates and serves a file through a one-time shareable link.
     """
-    shareable_link = get_object_or_404(ShareableLink, token=token)
-    
-    # Check if the link is expired or already used
-    if shareable_link.has_expired() or shareable_link.is_used:
+    # Claim the link; missing, expired and already used links are all refused the same way
+    file = redeem_link(token)
+    if file is None:
         return HttpResponseForbidden("This link is no longer valid.")
+    if file.processing_status != File.READY:
+        # Nothing was served, so the one-time link stays usable once processing is done
+        release_link(token)
+        return HttpResponse(f"This file {NOT_READY[file.processing_status]}.", status=409)
     
-    # Mark the link as used
-    shareable_link.is_used = True
-    shareable_link.save()
-    
-    # Serve the file
-    file = shareable_link.file
-    response = FileResponse(file.file_object.open(), as_attachment=True, filename=file.file)
+    # Refusals from here on serve nothing either, so each one hands the link back
+    if file.corrupted_at is not None:
+        release_link(token)
+        return HttpResponse("This file failed an integrity check and cannot be downloaded.", status=409)
+
+    # Serve the file through the same verified decrypt path as downloads
+    reader = open_reader(file)
+    if not reader.exists():
+        release_link(token)
+        return HttpResponse("File not found on the server.", status=404)
+    try:
+        ticket = admission.admit(reader.size, reader.memory_cost)
+    except admission.Saturated as e:
+        # Nothing was served, so the one-time link stays usable for the retry
+        release_link(token)
+        return _busy_response(e)
+    try:
+        chunks = admission.guarded(reader.iter_verified(), ticket)
+        first_chunk = next(chunks, b'')
+    except Exception as e:
+        ticket.release()
+        release_link(token)
+        return HttpResponse(f"Download failed: {str(e)}", status=500)
+
+    response = StreamingHttpResponse(_stream_body(first_chunk, chunks))
+    response['Content-Type'] = 'application/octet-stream'
+    response['Content-Disposition'] = content_disposition_header(True, file.filename)
+    if reader.size is not None:
+        response['Content-Length'] = str(reader.size)
     return response
 
 # View for uploading files
 @login_required
+@csrf_exempt
 def upload_file(request):
+    # Upload handlers must be swapped before CSRF validation reads request.POST
+    if getattr(settings, 'FILE_STORAGE_MODE', 'blob') == 'chunked':
+        request.upload_handlers = [ChunkingUploadHandler(request)]
+    else:
+        request.upload_handlers = [EncryptingUploadHandler(request)]
+    if request.method != 'POST':
+        return _upload_file(request)
+
+    # Admitted before the body is read, so a saturated server turns uploads away cheaply
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    try:
+        ticket = admission.admit(length, min(length, UPLOAD_WORKING_SET))
+    except admission.Saturated as e:
+        return _busy_response(e)
+    with ticket:
+        return _upload_file(request)
+
+@csrf_protect
+def _upload_file(request):
     if request.method == 'POST':
+        # Files arrive already encrypted (or still encrypting on the pool) or already chunked
         uploaded_files = request.FILES.getlist('files')
-        successful_uploads = 0
-        failed_uploads = 0
+        results = []
+        pending = []
 
         for uploaded_file in uploaded_files:
             try:
-                # Create File model instance
-                file = File.objects.create(
-                    user=request.user,
-                    filename=uploaded_file.name,
-                    file=uploaded_file
-                )
+                pending.append((uploaded_file, new_file(request.user, uploaded_file)))
+            except Exception as e:
+                uploaded_file.discard()
+                results.append({'filename': uploaded_file.name, 'success': False, 'error': str(e)})
 
-                # Get the full path of the saved file
-                file_path = os.path.join(settings.MEDIA_ROOT, str(file.file))
-                
-                # Encrypt the file and get its hash
-                file_hash = FileEncryptor.encrypt_file(file_path)
-                file.file_hash = file_hash
-                file.save()
-                
-                successful_uploads += 1
+        created, queued = [], []
+        try:
+            for attempt in range(2):
+                try:
+                    created, queued = save_uploads(request.user, pending)
+                    break
+                except IntegrityError:
+                    # A concurrent upload stored the same new content first; retry against its blob
+                    if attempt:
+                        raise
+        except Exception as e:
+            for uploaded_file, _ in pending:
+                uploaded_file.discard()
+                results.append({'filename': uploaded_file.name, 'success': False, 'error': str(e)})
 
-            except Exception as e:
-                # If encryption or saving fails, delete the file
-                if hasattr(locals(), 'file'):
-                    file.delete()
-                failed_uploads += 1
-                messages.error(request, f"Failed to upload {uploaded_file.name}: {str(e)}")
+        # Post-upload processing runs here only with JOB_RUN_INLINE; otherwise the workers pick it up
+        jobs.dispatch(queued)
+        statuses = dict(File.objects.filter(pk__in=[file.id for file in created]).values_list('id', 'processing_status'))
+        results.extend(
+            {'filename': file.filename, 'success': True, 'id': file.id, 'version': file.version,
+             'status': statuses.get(file.id)}
+            for file in created
+        )
+
+        if not request.accepts('text/html'):
+            return JsonResponse({'results': results})
+
+        successful_uploads = sum(1 for result in results if result['success'])
+        failed_uploads = len(results) - successful_uploads
+        for result in results:
+            if not result['success']:
+                messages.error(request, f"Failed to upload {result['filename']}: {result['error']}")
 
         if successful_uploads > 0:
             messages.success(request, f"Successfully uploaded {successful_uploads} file(s).")
@@ -124,20 +226,155 @@ def upload_file(request):
     
     return render(request, 'upload_file.html', {'form': FileUploadForm()})
 
+# Views for resumable uploads (tus-style): create a session, PATCH chunks at offsets,
+# HEAD for the committed offset; the final chunk completes the upload
+def _tus_response(session, status=204):
+    response = HttpResponse(status=status)
+    response['Tus-Resumable'] = '1.0.0'
+    response['Upload-Offset'] = str(session.offset)
+    response['Upload-Length'] = str(session.length)
+    response['Upload-Expires'] = http_date(session.expires_at.timestamp())
+    response['Cache-Control'] = 'no-store'
+    return response
+
+def _tus_metadata(header):
+    """Decode a tus Upload-Metadata header ('key base64value, ...')"""
+    metadata = {}
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if key:
+            try:
+                metadata[key] = base64.b64decode(value).decode()
+            except (ValueError, UnicodeDecodeError):
+                pass
+    return metadata
+
+@login_required
+@require_http_methods(["POST"])
+def create_upload_session(request):
+    metadata = _tus_metadata(request.headers.get('Upload-Metadata', ''))
+    filename = metadata.get('filename') or request.POST.get('filename', '')
+    try:
+        length = int(request.headers.get('Upload-Length') or request.POST.get('length', ''))
+    except ValueError:
+        length = -1
+    if not filename or length < 0:
+        return JsonResponse({'error': "A filename and a non-negative Upload-Length are required."}, status=400)
+
+    session = create_session(request.user, os.path.basename(filename)[:255], length)
+    response = _tus_response(session, status=201)
+    response['Location'] = reverse('upload_session', args=[session.id])
+    return response
+
+@login_required
+@require_http_methods(["HEAD", "GET", "PATCH", "DELETE"])
+def upload_session(request, session_id):
+    session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+
+    if session.has_expired():
+        discard_session(session)
+        return HttpResponse(status=410)
+
+    if request.method == 'DELETE':
+        discard_session(session)
+        return HttpResponse(status=204)
+
+    if request.method in ('HEAD', 'GET'):
+        return _tus_response(session, status=200)
+
+    # A retried final PATCH gets the same answer instead of a second File
+    if session.file_id is not None:
+        response = _tus_response(session)
+        response['Upload-File-Id'] = str(session.file_id)
+        return response
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "Upload-Offset header is required."}, status=400)
+
+    try:
+        # The body is read from the socket a segment at a time and sealed straight to the staging file
+        session = append_chunk(session, offset, request)
+    except UploadConflict as e:
+        response = _tus_response(session, status=409)
+        response.content = str(e)
+        return response
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=413)
+
+    response = _tus_response(session)
+    if session.offset == session.length:
+        # Re-encrypting the staged chunks is a finalize_upload job; the File is pending until it has run
+        file, job = complete_session(session)
+        jobs.dispatch([job])
+        response['Upload-File-Id'] = str(file.id)
+    return response
+
 # View for listing user's files and files shared with them
 @login_required
 def file_list(request):
-    user_files = File.objects.filter(user=request.user)
-    shared_files = FileShare.objects.filter(shared_with=request.user)
+    page_size = getattr(settings, 'FILE_LIST_PAGE_SIZE', 50)
+    tab = request.GET.get('tab')
+    cursor = request.GET.get('cursor') if tab else None
+
+    user_files, files_cursor = [], None
+    if tab != 'shared':
+        user_files, files_cursor = keyset_page(
+            File.objects.filter(user=request.user), 'upload_date', cursor, page_size
+        )
+
+    shared_files, shared_cursor = [], None
+    if tab != 'mine':
+        # The template shows the file name and sharer of every share, so join them in
+        shared_files, shared_cursor = keyset_page(
+            FileShare.objects.filter(shared_with=request.user).select_related('file', 'shared_by'),
+            'shared_date', cursor, page_size,
+        )
+        # Every shared file's permissions in one query, for showing only the allowed actions
+        annotate_access(request, [share.file for share in shared_files])
+
+    # Infinite scroll asks for one tab's next page as a rendered fragment
+    if tab in ('mine', 'shared'):
+        template = 'file_cards.html' if tab == 'mine' else 'shared_file_cards.html'
+        html = render_to_string(template, {
+            'user_files': user_files, 'shared_files': shared_files
+        }, request=request)
+        return JsonResponse({
+            'html': html, 'next_cursor': files_cursor if tab == 'mine' else shared_cursor
+        })
+
     return render(request, 'file_list.html', {
         'user_files': user_files,
-        'shared_files': shared_files
+        'shared_files': shared_files,
+        'files_cursor': files_cursor,
+        'shared_cursor': shared_cursor,
     })
 
+# Processing status of listed files; the file list polls it while uploads are being processed
+@login_required
+@require_http_methods(["GET"])
+def file_status(request):
+    try:
+        file_ids = bulk.parse_file_ids(request.GET.getlist('ids'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    files, results = bulk.load_files(request, file_ids, VIEW)
+    results.extend(
+        {'id': file.id, 'success': True, 'status': file.processing_status,
+         'label': file.get_processing_status_display(), 'error': file.processing_error}
+        for file in files
+    )
+    return JsonResponse({'results': results})
+
 # View for sharing a file
 @login_required
 def share_file(request, file_id):
-    file = get_object_or_404(File, id=file_id, user=request.user)
+    file = get_object_or_404(File, id=file_id)
+    if not can(request, file, SHARE):
+        messages.error(request, "You don't have permission to share this file.")
+        return redirect('file_list')
     
     if request.method == 'POST':
         form = FileShareForm(request.POST)
@@ -173,7 +410,9 @@ def share_file(request, file_id):
                     file=file,
                     shared_with=shared_with_user,
                     shared_by=request.user,
+                    permission='download',
                 )
+                invalidate_access(file.id, [shared_with_user.id])
                 
                 messages.success(request, f"File shared with {shared_with_user.username}")
                 return redirect('file_list')
@@ -193,92 +432,250 @@ def download_file(request, file_id):
     file_obj = get_object_or_404(File, id=file_id)
     
     # Check if user has permission to download
-    is_owner = file_obj.user == request.user
-    is_shared = FileShare.objects.filter(file=file_obj, shared_with=request.user).exists()
-    
-    if not (is_owner or is_shared):
+    if not can(request, file_obj, DOWNLOAD):
         messages.error(request, "You don't have permission to download this file.")
         return redirect('file_list')
+
+    if file_obj.processing_status != File.READY:
+        messages.error(request, f"This file {NOT_READY[file_obj.processing_status]} and cannot be downloaded yet.")
+        return redirect('file_list')
+
+    # Content the scrubber found corrupt is refused before any decryption work
+    if file_obj.corrupted_at is not None:
+        messages.error(request, "This file failed an integrity check and cannot be downloaded.")
+        return redirect('file_list')
     
-    try:
-        file_path = os.path.join(settings.MEDIA_ROOT, str(file_obj.file))
-        
-        if not os.path.exists(file_path):
-            messages.error(request, "File not found on the server.")
-            return redirect('file_list')
-        
-        decrypted_path, decrypted_hash = FileEncryptor.decrypt_file(file_path)
-        
-        if decrypted_hash != file_obj.file_hash:
-            os.unlink(decrypted_path)
-            messages.error(request, "File integrity check failed.")
-            return redirect('file_list')
-        
-        response = FileResponse(
-            open(decrypted_path, 'rb'),
-            as_attachment=True,
-            filename=file_obj.filename
-        )
-        
-        # Clean up the temporary file after sending
-        response.close_callback = lambda: os.unlink(decrypted_path) if os.path.exists(decrypted_path) else None
-        
+    # The content hash is a strong validator and File rows never change content, so
+    # revalidation is answered before any ciphertext is opened
+    etag = f'"{file_obj.file_hash}"'
+    validators = _set_validators(HttpResponse(), file_obj)
+    conditional = get_conditional_response(
+        request, etag=etag, last_modified=int(file_obj.upload_date.timestamp()), response=validators
+    )
+    # A 304 or 412 carrying the validators; the template response itself means "send the file"
+    if conditional is not validators:
+        return conditional
+
+    reader = open_reader(file_obj)
+
+    if not reader.exists():
+        messages.error(request, "File not found on the server.")
+        return redirect('file_list')
+
+    plaintext_size = reader.size
+    ranges = None
+    # Byte ranges need a known size; compressed and legacy content is decrypted from the start and sliced
+    if plaintext_size is not None and 'HTTP_RANGE' in request.META:
+        if_range = request.META.get('HTTP_IF_RANGE')
+        # If-Range holds either validator; a date matches only the exact Last-Modified
+        if if_range is None or if_range in (etag, http_date(file_obj.upload_date.timestamp())):
+            ranges = parse_range_header(request.META['HTTP_RANGE'], plaintext_size)
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{plaintext_size}'
         return response
-        
+
+    try:
+        # Range requests only decrypt what they send, so small ranges of large files skip the queue
+        job_size = sum(stop - start for start, stop in ranges) if ranges else plaintext_size
+        ticket = admission.admit(job_size, reader.memory_cost)
+    except admission.Saturated as e:
+        return _busy_response(e)
+
+    boundary = secrets.token_hex(16)
+    try:
+        # Decrypt the first segment up front so key or format errors still redirect
+        if ranges:
+            chunks = _iter_ranges(reader, ranges, plaintext_size, boundary)
+        else:
+            chunks = reader.iter_verified()
+        # The reservation is held until the last byte is sent or the client goes away
+        chunks = admission.guarded(chunks, ticket)
+        first_chunk = next(chunks, b'')
     except Exception as e:
-        if 'decrypted_path' in locals() and os.path.exists(decrypted_path):
-            os.unlink(decrypted_path)
+        ticket.release()
         messages.error(request, f"Download failed: {str(e)}")
         return redirect('file_list')
-    if request.method == 'POST':  # Only allow POST requests for deletion
-        file = get_object_or_404(File, id=file_id, user=request.user)
-        file_path = os.path.join(settings.MEDIA_ROOT, str(file.file))
-        try:
-            # Delete file shares first
-            FileShare.objects.filter(file=file).delete()
-            
-            # Delete the physical file
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            
-            # Delete the database record
-            file.delete()
-            messages.success(request, "File deleted successfully.")
-        except Exception as e:
-            messages.error(request, f"Failed to delete file: {str(e)}")
+
+    # Plaintext is decrypted segment by segment straight into the response
+    response = StreamingHttpResponse(_stream_body(first_chunk, chunks))
+    response['Content-Disposition'] = content_disposition_header(True, file_obj.filename)
+    _set_validators(response, file_obj)
+    if plaintext_size is not None:
+        response['Accept-Ranges'] = 'bytes'
+
+    if not ranges:
+        response['Content-Type'] = 'application/octet-stream'
+        if plaintext_size is not None:
+            response['Content-Length'] = str(plaintext_size)
+        return response
+
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response['Content-Type'] = 'application/octet-stream'
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{plaintext_size}'
+        response['Content-Length'] = str(stop - start)
     else:
-        messages.error(request, "Invalid request method for file deletion.")
-    
-    return redirect('file_list')
-    file = get_object_or_404(File, id=file_id, user=request.user)
-    file_path = os.path.join(settings.MEDIA_ROOT, str(file.file))
+        response['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    return response
+
+
+
+def _set_validators(response, file_obj):
+    """Attach the caching headers every download response, including a 304, carries"""
+    response['ETag'] = f'"{file_obj.file_hash}"'
+    response['Last-Modified'] = http_date(file_obj.upload_date.timestamp())
+    response['Cache-Control'] = getattr(settings, 'FILE_DOWNLOAD_CACHE_CONTROL', 'private, no-cache')
+    return response
+
+
+def _iter_ranges(reader, ranges, size, boundary):
+    """Yield a single range body, or a multipart/byteranges body for several ranges"""
+    if len(ranges) == 1:
+        yield from reader.iter_range(*ranges[0])
+        return
+
+    for start, stop in ranges:
+        yield (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: application/octet-stream\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+        ).encode()
+        yield from reader.iter_range(start, stop)
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def export_files(request):
+    """
+    Stream the requested files as one ZIP archive, decrypting each entry into the response
+    as it is written. Every file is checked up front, so a refused export never starts streaming.
+    """
+    data = request.POST if request.method == 'POST' else request.GET
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        file.delete()
-        messages.success(request, "File deleted successfully.")
-    except Exception as e:
-        messages.error(request, f"Failed to delete file: {str(e)}")
-    return redirect('file_list')
+        file_ids = bulk.parse_file_ids(data.getlist('file_ids'))
+    except ValueError as e:
+        messages.error(request, str(e))
+        return redirect('file_list')
+
+    files, refused = bulk.load_files(request, file_ids, DOWNLOAD)
+    problems = [f"{result['id']}: {result['error']}" for result in refused]
+    problems += [
+        f"{file.filename}: {NOT_READY[file.processing_status]}"
+        for file in files if file.processing_status != File.READY
+    ]
+    files = [file for file in files if file.processing_status == File.READY]
+    readers = [open_reader(file) for file in files]
+    problems += [
+        f"{file.filename}: {'failed an integrity check' if file.corrupted_at else 'not found on the server'}"
+        for file, reader in zip(files, readers) if file.corrupted_at is not None or not reader.exists()
+    ]
+    if problems:
+        messages.error(request, f"Export failed: {'; '.join(problems[:5])}")
+        return redirect('file_list')
+
+    # Entries are decrypted one after another, so the archive costs as much as its largest entry
+    sizes = [reader.size for reader in readers]
+    try:
+        ticket = admission.admit(
+            None if None in sizes else sum(sizes), lambda: max(reader.memory_cost() for reader in readers)
+        )
+    except admission.Saturated as e:
+        return _busy_response(e)
+
+    members = (
+        (name, localtime(file.upload_date), reader.size, reader.iter_verified())
+        for name, file, reader in zip(archive_names(files), files, readers)
+    )
+    response = StreamingHttpResponse(
+        admission.guarded(iter_zip(members, deflate=getattr(settings, 'FILE_EXPORT_DEFLATE', False)), ticket),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = content_disposition_header(True, f"files-{localtime():%Y%m%d-%H%M%S}.zip")
+    response['Cache-Control'] = 'no-store'
+    return response
 
 @login_required
 @require_http_methods(["POST"])
 def delete_file(request, file_id):
-    file = get_object_or_404(File, id=file_id, user=request.user)
-    file_path = os.path.join(settings.MEDIA_ROOT, str(file.file))
+    file = get_object_or_404(File, id=file_id)
+    if not can(request, file, DELETE):
+        messages.error(request, "You don't have permission to delete this file.")
+        return redirect('file_list')
     
     try:
-        # Delete file shares first
-        FileShare.objects.filter(file=file).delete()
-        
-        # Delete the physical file
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # Delete the database record
-        file.delete()
+        # Shares, chunk and blob references go in one transaction; unused ciphertext after it commits
+        bulk.delete_files([file])
         messages.success(request, "File deleted successfully.")
     except Exception as e:
         messages.error(request, f"Failed to delete file: {str(e)}")
     
-    return redirect('file_list')
\ No newline at end of file
+    return redirect('file_list')
+
+# Bulk endpoints: POST a JSON body (or form fields) with a list of file_ids and get one result per file
+def _bulk_payload(request):
+    """Return (payload, file_ids) from a bulk request body; raises ValueError on a bad request"""
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            raise ValueError("Invalid JSON body.")
+        if not isinstance(payload, dict):
+            raise ValueError("Invalid JSON body.")
+    else:
+        payload = {key: request.POST.get(key) for key in request.POST}
+        payload['file_ids'] = request.POST.getlist('file_ids')
+    return payload, bulk.parse_file_ids(payload.get('file_ids'))
+
+@login_required
+@require_http_methods(["POST"])
+def bulk_delete_files(request):
+    try:
+        _, file_ids = _bulk_payload(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    files, results = bulk.load_files(request, file_ids, DELETE)
+    try:
+        results.extend(bulk.delete_files(files))
+    except Exception as e:
+        results.extend(bulk.failure(file.pk, f"Failed to delete file: {str(e)}") for file in files)
+    return JsonResponse({'results': results})
+
+@login_required
+@require_http_methods(["POST"])
+def bulk_share_files(request):
+    try:
+        payload, file_ids = _bulk_payload(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    permission = payload.get('permission') or 'download'
+    if permission not in ('view', 'download'):
+        return JsonResponse({'error': "permission must be 'view' or 'download'."}, status=400)
+    shared_with_user = User.objects.filter(username=payload.get('username') or '').first()
+    if shared_with_user is None:
+        return JsonResponse({'error': "User not found."}, status=400)
+    if shared_with_user == request.user:
+        return JsonResponse({'error': "You cannot share a file with yourself."}, status=400)
+
+    files, results = bulk.load_files(request, file_ids, SHARE)
+    force = payload.get('force_share') in (True, '1', 'true', 'on')
+    results.extend(bulk.share_files(files, request.user, shared_with_user, permission, force))
+    return JsonResponse({'results': results})
+
+@login_required
+@require_http_methods(["POST"])
+def bulk_generate_links(request):
+    try:
+        _, file_ids = _bulk_payload(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    files, results = bulk.load_files(request, file_ids, SHARE)
+    results.extend(bulk.create_links(
+        files, lambda token: request.build_absolute_uri(reverse('access_shared_file', args=[token]))
+    ))
+    return JsonResponse({'results': results})
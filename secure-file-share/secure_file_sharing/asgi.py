@@ -1,7 +1,13 @@
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "secure_file_sharing.settings")
+os.environ.setdefault("ASYNC_TRANSFERS", "1")
 
-application = get_asgi_application()
+# What get_asgi_application() does, with a handler that keeps spooled request bodies encrypted
+django.setup(set_prefix=False)
+
+from fileapp.asgi import EncryptedBodyASGIHandler  # noqa: E402
+
+application = EncryptedBodyASGIHandler()
@@ -0,0 +1,70 @@
+"""
+Builds DATABASES['default'] from environment variables:
+
+DB_ENGINE        sqlite (default) or postgres
+DB_NAME          database name, or the SQLite file path (default BASE_DIR/db.sqlite3)
+DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+                 PostgreSQL connection parameters
+DB_CONN_MAX_AGE  seconds a connection is reused across requests (default 60; 0 closes it per request)
+DB_POOL          1 to serve PostgreSQL connections from a psycopg pool instead (needs psycopg[pool])
+DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT
+                 pool bounds and seconds to wait for a free connection (defaults 2, 20, 10)
+DB_SQLITE_TUNING 0 to leave SQLite in its default rollback-journal mode
+DB_BUSY_TIMEOUT  seconds SQLite waits on a locked database before failing (default 20)
+"""
+import os
+
+# WAL lets readers proceed while one connection writes; synchronous=NORMAL is durable
+# against application crashes in WAL mode and only risks the last commits on power loss
+SQLITE_INIT_COMMAND = 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL'
+
+
+def database_config(base_dir, environ=None):
+    environ = os.environ if environ is None else environ
+    engine = environ.get('DB_ENGINE', 'sqlite')
+    conn_max_age = int(environ.get('DB_CONN_MAX_AGE', 60))
+
+    if engine == 'sqlite':
+        config = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': environ.get('DB_NAME') or os.path.join(base_dir, 'db.sqlite3'),
+            'CONN_MAX_AGE': conn_max_age,
+            'OPTIONS': {},
+        }
+        if environ.get('DB_SQLITE_TUNING', '1') != '0':
+            config['OPTIONS'] = {
+                'init_command': SQLITE_INIT_COMMAND,
+                'timeout': float(environ.get('DB_BUSY_TIMEOUT', 20)),
+                # Take the write lock at BEGIN: a deferred transaction that upgrades from
+                # read to write fails with "database is locked" without waiting on the timeout
+                'transaction_mode': 'IMMEDIATE',
+            }
+        return config
+
+    if engine == 'postgres':
+        config = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': environ.get('DB_NAME', 'secure_file_share'),
+            'USER': environ.get('DB_USER', ''),
+            'PASSWORD': environ.get('DB_PASSWORD', ''),
+            'HOST': environ.get('DB_HOST', ''),
+            'PORT': environ.get('DB_PORT', ''),
+            'CONN_MAX_AGE': conn_max_age,
+            # Persistent connections are pinged before reuse, so a restarted server costs no failed request
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+        if environ.get('DB_POOL') == '1':
+            from psycopg_pool import ConnectionPool
+
+            # The pool replaces persistent connections; Django rejects both at once
+            config['CONN_MAX_AGE'] = 0
+            config['OPTIONS']['pool'] = {
+                'min_size': int(environ.get('DB_POOL_MIN_SIZE', 2)),
+                'max_size': int(environ.get('DB_POOL_MAX_SIZE', 20)),
+                'timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+                'check': ConnectionPool.check_connection,
+            }
+        return config
+
+    raise ValueError(f"Unsupported DB_ENGINE: {engine}")
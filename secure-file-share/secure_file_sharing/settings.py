@@ -1,5 +1,8 @@
+import os
 from pathlib import Path
 
+from .database import database_config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -29,6 +32,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "fileapp.middleware.PhaseTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -62,11 +66,9 @@ WSGI_APPLICATION = "secure_file_sharing.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Configured from DB_* environment variables; see database.py. SQLite runs in WAL mode by default
 DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
-    }
+    "default": database_config(BASE_DIR),
 }
 
 
@@ -115,4 +117,109 @@ MEDIA_ROOT = BASE_DIR / 'media'
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 LOGIN_REDIRECT_URL = 'file_list'
-LOGIN_URL = 'login'
\ No newline at end of file
+LOGIN_URL = 'login'
+
+# File encryption
+# Threads used to encrypt uploads while the request body is still being parsed; 0 encrypts inline
+
+FILE_ENCRYPTION_WORKERS = 4
+
+# How uploads are stored: 'blob' keeps one deduplicated ciphertext per distinct file,
+# 'chunked' splits files into content-defined chunks so revisions only store changed bytes
+FILE_STORAGE_MODE = 'blob'
+
+# Seconds a resumable upload session may sit idle before it is garbage-collected
+UPLOAD_SESSION_EXPIRY = 24 * 60 * 60
+
+# Files and shares rendered per page of the file list; further pages load on scroll
+FILE_LIST_PAGE_SIZE = 50
+
+# Seconds a non-owner's file permissions stay cached; sharing and deleting invalidate them sooner.
+# Invalidation reaches the configured CACHES backend, so with several processes and a TTL above 0 use a
+# shared backend (Redis, Memcached); the default per-process cache lets revoked access linger up to the TTL
+FILE_ACL_CACHE_TTL = 30
+
+# Seconds between background janitor sweeps in each process; None leaves cleanup to `manage.py run_janitor`
+JANITOR_INTERVAL = None
+
+# Bytes per second the janitor may delete from disk; 0 removes the limit
+JANITOR_IO_RATE = 50 * 1024 * 1024
+
+# Route uploads and downloads to the async views; asgi.py turns this on for ASGI servers
+ASYNC_TRANSFERS = os.environ.get('ASYNC_TRANSFERS') == '1'
+
+# Threads the async views use for blocking view code, decryption and disk reads
+FILE_TRANSFER_WORKERS = 16
+
+# Per-phase timing histograms served on /metrics; off by default so the hot paths stay untimed
+FILE_METRICS_ENABLED = False
+
+# Also send each request's phase totals in a Server-Timing header (needs FILE_METRICS_ENABLED)
+FILE_METRICS_SERVER_TIMING = False
+
+# Where ciphertext lives: {'driver': 'local'} under MEDIA_ROOT, or an S3-compatible store with
+# {'driver': 's3', 'endpoint': ..., 'bucket': ..., 'access_key': ..., 'secret_key': ...}
+FILE_STORAGE_BACKEND = {'driver': 'local'}
+
+# Seconds between background integrity scrubs in each process; None leaves them to `manage.py scrub_files`
+SCRUB_INTERVAL = None
+
+# Bytes per second the scrubber may read back from storage; 0 removes the limit
+SCRUB_IO_RATE = 20 * 1024 * 1024
+
+# Files one bulk delete, share or link request may name
+BULK_MAX_FILES = 500
+
+# Threads used to remove ciphertext after a bulk delete; deletes are latency-bound, so they overlap well
+FILE_DELETE_WORKERS = 8
+
+# Deflate entries of ZIP exports; stored entries stream at disk speed and most uploads compress poorly anyway
+FILE_EXPORT_DEFLATE = False
+
+# Cache-Control on downloads. 'no-cache' lets browsers keep files but revalidate each use, which
+# re-checks access and costs a 304 instead of a decrypt; 'private, max-age=N' skips revalidation for N seconds
+FILE_DOWNLOAD_CACHE_CONTROL = 'private, no-cache'
+
+# Admission control for encryption and decryption jobs in each process: at most FILE_CRYPTO_MAX_JOBS
+# run at once within FILE_CRYPTO_MEMORY_BUDGET bytes of working memory; others queue for up to
+# FILE_CRYPTO_QUEUE_TIMEOUT seconds and are then answered 503 with Retry-After. Downloads and exports
+# need a job slot to start but then stream holding only their memory, so slow clients don't use up the slots
+FILE_CRYPTO_MAX_JOBS = 32
+FILE_CRYPTO_MEMORY_BUDGET = 256 * 1024 * 1024
+FILE_CRYPTO_QUEUE_TIMEOUT = 2
+FILE_CRYPTO_RETRY_AFTER = 5
+
+# Files up to this many bytes are transferred without waiting for admission
+FILE_CRYPTO_BYPASS_SIZE = 1024 * 1024
+
+# Master keys wrapping per-file data keys, as FILE_MASTER_KEYS="id:urlsafe-base64-key,...". New data keys
+# are wrapped under FILE_ACTIVE_MASTER_KEY (default: the last listed); `manage.py rotate_keys` re-wraps the
+# rest, after which retired keys can be dropped. Unset, FERNET_KEY from .env is the only master key, with id
+# 'fernet'; list it alongside new keys until they have been rotated away from it
+FILE_MASTER_KEYS = dict(
+    item.strip().split(':', 1) for item in os.environ.get('FILE_MASTER_KEYS', '').split(',') if item.strip()
+)
+FILE_ACTIVE_MASTER_KEY = os.environ.get('FILE_ACTIVE_MASTER_KEY') or None
+
+# Unwrapped data keys and segment ciphers each process keeps, and for how many seconds
+FILE_KEY_CACHE_SIZE = 1024
+FILE_KEY_CACHE_TTL = 300
+
+# Run background jobs (upload finalization) in the request that queued them. Set JOB_RUN_INLINE=0 once
+# `manage.py run_workers` is deployed: uploads then answer as soon as their bytes are stored, uploads reusing
+# stored content nobody has verified yet are read back first, and the file list shows each file's progress
+JOB_RUN_INLINE = os.environ.get('JOB_RUN_INLINE', '1') == '1'
+
+# Seconds a leased job stays hidden from other workers. Running jobs keep extending it, so it only
+# bounds how long the job of a crashed worker waits before another worker takes it over
+JOB_VISIBILITY_TIMEOUT = 300
+
+# Attempts per job before it fails for good, JOB_RETRY_BACKOFF * 2^n seconds apart
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 10
+
+# Seconds an idle worker waits before looking for due jobs again
+JOB_POLL_INTERVAL = 1
+
+# Seconds finished and failed jobs are kept before the janitor deletes them
+JOB_RETENTION = 7 * 24 * 60 * 60
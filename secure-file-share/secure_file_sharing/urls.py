@@ -2,19 +2,30 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
-from fileapp import views
+from fileapp import async_views, views
 from django.contrib.auth import views as auth_views
 from django.contrib.auth.views import LogoutView
 
+# Under ASGI the transfer views stream from the event loop instead of holding a thread per client
+transfer_views = async_views if settings.ASYNC_TRANSFERS else views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.file_list, name='file_list'),
-    path('upload/', views.upload_file, name='upload_file'),
+    path('upload/', transfer_views.upload_file, name='upload_file'),
+    path('uploads/', views.create_upload_session, name='create_upload_session'),
+    path('uploads/<uuid:session_id>/', views.upload_session, name='upload_session'),
     path('generate-shareable-link/<int:file_id>/', views.generate_shareable_link, name='generate_share_link'),
-    path('file/share/<str:token>/', views.access_shared_file, name='access_shared_file'),
+    path('file/share/<str:token>/', transfer_views.access_shared_file, name='access_shared_file'),
     path('share/<int:file_id>/', views.share_file, name='share_file'),
-    path('download/<int:file_id>/', views.download_file, name='download_file'),
+    path('download/<int:file_id>/', transfer_views.download_file, name='download_file'),
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),
+    path('export/', transfer_views.export_files, name='export_files'),
+    path('bulk/delete/', views.bulk_delete_files, name='bulk_delete_files'),
+    path('bulk/share/', views.bulk_share_files, name='bulk_share_files'),
+    path('bulk/links/', views.bulk_generate_links, name='bulk_generate_links'),
+    path('files/status/', views.file_status, name='file_status'),
+    path('metrics', views.metrics_view, name='metrics'),
     
     # Authentication URLs
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),